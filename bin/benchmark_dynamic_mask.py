@@ -0,0 +1,69 @@
+"""Benchmarks the vectorized dynamic masking engine used by
+`texar.utils.prepare_template` against its per-example reference
+implementation.
+
+Example:
+
+    python bin/benchmark_dynamic_mask.py --batch_sizes 10 100 400 \
+        --blank_nums 1 2 4
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from texar.utils.transformer_utils import \
+    _fill_dynamic_mask_np, _fill_dynamic_mask_reference
+
+
+def _make_batch(batch_size, blank_num, max_seq_length, rng):
+    lengths = rng.randint(min(2 * blank_num + 2, max_seq_length),
+                          max_seq_length + 1, size=batch_size)
+    inputs = rng.randint(5, 10000, size=(batch_size, max_seq_length))
+    return inputs.astype(np.int64), lengths.astype(np.int32)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--batch_sizes", type=int, nargs="+",
+                        default=[10, 100, 400, 1600])
+    parser.add_argument("--blank_nums", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--max_seq_length", type=int, default=18,
+                        help="Padded length of the batch, incl. BOS/EOS.")
+    parser.add_argument("--present_rate", type=float, default=0.5)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(1234)
+    present_rate = np.float32(args.present_rate)
+    print('%10s %10s %14s %14s %8s' %
+          ('batch_size', 'blank_num', 'reference(ms)', 'vectorized(ms)',
+           'speedup'))
+    for batch_size in args.batch_sizes:
+        for blank_num in args.blank_nums:
+            inputs, lengths = _make_batch(
+                batch_size, blank_num, args.max_seq_length, rng)
+            fn_args = (inputs, lengths, present_rate, 1, 2, 0, blank_num)
+            for ref, new in zip(_fill_dynamic_mask_reference(*fn_args),
+                                _fill_dynamic_mask_np(*fn_args)):
+                np.testing.assert_array_equal(ref, new)
+            ref_time = min(timeit.repeat(
+                lambda: _fill_dynamic_mask_reference(*fn_args),
+                number=1, repeat=args.repeats))
+            new_time = min(timeit.repeat(
+                lambda: _fill_dynamic_mask_np(*fn_args),
+                number=1, repeat=args.repeats))
+            print('%10d %10d %14.3f %14.3f %7.1fx' %
+                  (batch_size, blank_num, ref_time * 1e3, new_time * 1e3,
+                   ref_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#
+"""Precomputes text infilling templates and answers into TFRecord shards,
+to be read with :class:`texar.data.TemplateShardData`.
+
+Each record is one batch, masked exactly as :func:`texar.utils.prepare_template`
+would mask it in the graph. Shards are named after `--split`, `--mask_rate` and
+`--blank_num`, see :func:`texar.data.template_shard_file_pattern`.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# pylint: disable=invalid-name
+
+import os
+
+import tensorflow as tf
+
+import texar as tx
+from texar.data import SpecialTokens
+
+flags = tf.flags
+
+flags.DEFINE_string("files", "./", "Path to the data file.")
+flags.DEFINE_string("vocab_file", "./vocab.txt", "Path to the vocab file.")
+flags.DEFINE_string("output_dir", "./template_shards/",
+                    "Directory to write the shards to.")
+flags.DEFINE_string("split", "train",
+                    "Name of the data split, used as the shard file prefix, "
+                    "e.g., 'yahoo.train'.")
+flags.DEFINE_float("mask_rate", 0.5, "Portion of words masked out.")
+flags.DEFINE_integer("blank_num", 1, "Number of blanks in the template.")
+flags.DEFINE_integer("batch_size", 400, "Batch size.")
+flags.DEFINE_integer("max_seq_length", 16, "Maximum sequence length.")
+flags.DEFINE_integer("num_epochs", 1,
+                     "Number of passes over the data. Each pass is shuffled "
+                     "differently if `--shuffle` is set.")
+flags.DEFINE_boolean("shuffle", False, "Whether to shuffle the data.")
+flags.DEFINE_integer("seed", 1234, "Random seed of the shuffling.")
+flags.DEFINE_integer("shard_size", 1000, "Number of batches per shard.")
+flags.DEFINE_string("mask_token", "<m>", "The token of the masks.")
+flags.DEFINE_string("boa_token", "<BOA>",
+                    "The token at the beginning of the answers.")
+flags.DEFINE_string("eoa_token", "<EOA>",
+                    "The token at the end of the answers.")
+flags.DEFINE_string("pad_token", "<PAD>", "The token of the padding.")
+
+FLAGS = flags.FLAGS
+
+
+def main(_):
+    """Makes template shards.
+    """
+    data = tx.data.MonoTextData({
+        "num_epochs": FLAGS.num_epochs,
+        "seed": FLAGS.seed,
+        "shuffle": FLAGS.shuffle,
+        "dataset": {
+            "files": FLAGS.files,
+            "vocab_file": FLAGS.vocab_file,
+            "max_seq_length": FLAGS.max_seq_length,
+            "bos_token": SpecialTokens.BOS,
+            "eos_token": SpecialTokens.EOS,
+            "length_filter_mode": "truncate",
+        },
+        "batch_size": FLAGS.batch_size,
+        "allow_smaller_final_batch": True,
+    })
+    token_to_id = data.vocab.token_to_id_map_py
+    mask_id = token_to_id[FLAGS.mask_token]
+    boa_id = token_to_id[FLAGS.boa_token]
+    eoa_id = token_to_id[FLAGS.eoa_token]
+    pad_id = token_to_id[FLAGS.pad_token]
+
+    iterator = tx.data.DataIterator(data)
+    data_batch = iterator.get_next()
+    filename = os.path.join(
+        FLAGS.output_dir, '{}.mask{}.blank{}-{{:05d}}.tfrecord'.format(
+            FLAGS.split, FLAGS.mask_rate, FLAGS.blank_num))
+    tf.gfile.MakeDirs(FLAGS.output_dir)
+
+    with tf.Session() as sess:
+        sess.run(tf.tables_initializer())
+        iterator.switch_to_dataset(sess)
+        writer, cnt = None, 0
+        while True:
+            try:
+                batch = sess.run(data_batch)
+            except tf.errors.OutOfRangeError:
+                break
+            template_pack, answer_packs = tx.utils.prepare_template_np(
+                batch['text_ids'], batch['length'], 1 - FLAGS.mask_rate,
+                FLAGS.blank_num, mask_id, boa_id, eoa_id, pad_id)
+            if cnt % FLAGS.shard_size == 0:
+                if writer is not None:
+                    writer.close()
+                writer = tf.python_io.TFRecordWriter(
+                    filename.format(cnt // FLAGS.shard_size))
+            example = tx.data.make_template_shard_example(
+                batch, template_pack, answer_packs)
+            writer.write(example.SerializeToString())
+            cnt += 1
+        if writer is not None:
+            writer.close()
+    print('Wrote {} batches to {}'.format(cnt, FLAGS.output_dir))
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -1,4 +1,5 @@
 import tensorflow as tf
+from tensorflow.python.ops import inplace_ops
 
 from texar import context
 
@@ -8,7 +9,10 @@ __all__ = [
     'attention_bias_lower_triangle',
     'attention_bias_ignore_padding',
     'attention_bias_local',
+    'gather_local_memory',
     'multihead_attention',
+    'memory_keys_values',
+    'load_unfused_attention_checkpoint',
 ]
 def attention_bias_lower_triangle(length):
     """Create an bias tensor to be added to attention logits.
@@ -24,7 +28,8 @@ def attention_bias_local(length, max_backward, max_forward):
     """Create an bias tensor to be added to attention logits.
     A position may attend to positions at most max_distance from it,
     forward and backwards.
-    This does not actually save any computation.
+    This does not actually save any computation, unlike
+    :func:`gather_local_memory`.
     Args:
         length: int
         max_backward: int, maximum distance backward to attend. Negative values
@@ -54,6 +59,61 @@ def attention_bias_ignore_padding(memory_padding):
     ret = memory_padding * -1e18
     return tf.expand_dims(tf.expand_dims(ret, axis=1), axis=1)
 
+def gather_local_memory(memory, memory_attention_bias, starts, width,
+                        global_mask):
+    """Gathers the positions of :attr:`memory` that the queries of every
+    row attend to: the :attr:`width` positions from :attr:`starts` on, and
+    the global positions of :attr:`global_mask` outside them. Attending to
+    the gathered memory with the returned bias equals attending to the whole
+    memory with the other positions masked out, but costs
+    `O(length_query * (width + number of global positions))`.
+
+    Args:
+        memory: A tensor of shape `[batch, length_memory, depth]`.
+        memory_attention_bias: `None`, or a tensor of shape
+            `[batch, 1, 1, length_memory]`, e.g., from
+            :func:`attention_bias_ignore_padding`.
+        starts: An int32 tensor of shape `[batch]`, moved into the memory
+            if the window exceeds it.
+        width: An int.
+        global_mask: A bool tensor of shape `[batch, length_memory]`.
+    Returns:
+        A tuple `(memory, memory_attention_bias)` of the gathered positions,
+        of shapes `[batch, length, depth]` and `[batch, 1, 1, length]`, where
+        `length` is :attr:`width` plus the largest number of global
+        positions of a row.
+    """
+    batch_size = tf.shape(memory)[0]
+    length = tf.shape(memory)[1]
+    starts = tf.minimum(tf.maximum(starts, 0), tf.maximum(length - width, 0))
+    window = tf.expand_dims(starts, 1) + tf.range(width)
+    window_valid = window < length
+    window = tf.minimum(window, length - 1)
+
+    positions = tf.expand_dims(tf.range(length), 0)
+    in_window = tf.logical_and(
+        positions >= tf.expand_dims(starts, 1),
+        positions < tf.expand_dims(starts, 1) + width)
+    global_mask = tf.logical_and(global_mask, tf.logical_not(in_window))
+    num_globals = tf.reduce_max(tf.reduce_sum(tf.to_int32(global_mask), 1))
+    # the global positions of every row in order, followed by others
+    global_scores, globals_ = tf.nn.top_k(
+        tf.where(global_mask,
+                 tf.tile(length - positions, tf.stack([batch_size, 1])),
+                 tf.zeros_like(global_mask, dtype=tf.int32)),
+        k=num_globals)
+
+    indices = tf.concat([window, globals_], axis=1)
+    valid = tf.concat([window_valid, global_scores > 0], axis=1)
+    rows = tf.tile(tf.expand_dims(tf.range(batch_size), 1),
+                   tf.stack([1, tf.shape(indices)[1]]))
+    indices = tf.stack([rows, indices], axis=2)
+    bias = -1e18 * (1. - tf.to_float(valid))
+    if memory_attention_bias is not None:
+        bias += tf.gather_nd(memory_attention_bias[:, 0, 0], indices)
+    return (tf.gather_nd(memory, indices),
+            tf.expand_dims(tf.expand_dims(bias, 1), 1))
+
 def multihead_attention(queries,
                         memory_attention_bias=None,
                         memory=None,
@@ -61,7 +121,10 @@ def multihead_attention(queries,
                         num_units=None,
                         dropout_rate=0,
                         cache=None,
-                        scope='multihead_attention'):
+                        scope='multihead_attention',
+                        decode_step=None,
+                        fused=False,
+                        dropout_fn=None):
     '''Applies multihead attention.
     Args:
       queries: A 3d tensor with shape of [batch, length_query, depth_query].
@@ -70,6 +133,33 @@ def multihead_attention(queries,
         equals to depth_query if not given.
       dropout_rate: A floating point number.
       num_heads: An int. Number of heads with calculating attention.
+      cache: Optional dict. In self attention, holds the `self_keys` and
+        `self_values` of the previous steps and is updated in place. In
+        encoder-decoder attention, may hold the `memory_keys` and
+        `memory_values` computed by :func:`memory_keys_values`, which are
+        then used instead of projecting :attr:`memory` again. These may be
+        of a batch of `batch / n` memories, each shared by `n` consecutive
+        queries, e.g., by the beams of a batch element in beam search.
+      decode_step: Optional scalar tensor, the current step of dynamic
+        decoding with a single query. If given, `self_keys` and
+        `self_values` of `cache` are preallocated buffers of shape
+        `[max_length, batch, num_units]`, into which the keys and values of
+        the step are written in place, and the positions after the step
+        are masked out.
+      fused: Whether to project the queries, keys and values of self
+        attention with a single `qkv` variable, and the keys and values of
+        the memory with a single `kv` variable, and to keep them in
+        head-major layout `[batch, num_heads, length, num_units/num_heads]`
+        up to the output transform. The cached `self_keys` and
+        `self_values`, and `memory_keys` and `memory_values` from
+        :func:`memory_keys_values` with :attr:`num_heads`, are then
+        head-major too, except the preallocated buffers. Checkpoints of the
+        unfused variables are loaded with
+        :func:`load_unfused_attention_checkpoint`.
+      dropout_fn: Optional function `dropout_fn(weights, dropout_rate)`
+        applying dropout to the attention weights instead of
+        `tf.layers.dropout`, e.g., from
+        :func:`~texar.core.layers.seeded_dropout`.
       scope: Optional scope for `variable_scope`.
       reuse: Boolean, whether to reuse the weights of a previous layer
         by the same name.
@@ -84,39 +174,14 @@ def multihead_attention(queries,
             raise ValueError("Value depth (%d) must be divisible by the number"
                              "of attention heads (%d)." % (\
                             num_units, num_heads))
-        if memory is None:
-            #'self attention'
-            Q = tf.layers.dense(queries, num_units, use_bias=False, name='q')
-            K = tf.layers.dense(queries, num_units, use_bias=False, name='k')
-            V = tf.layers.dense(queries, num_units, use_bias=False, name='v')
-            if cache is not None:
-                # 'decoder self attention when dynamic decoding'
-                K = tf.concat([cache['self_keys'], K], axis=1)
-                V = tf.concat([cache['self_values'], V], axis=1)
-                cache['self_keys'] = K
-                cache['self_values'] = V
+        if fused:
+            Q_, K_, V_, unfolded_Q, memory_attention_bias = _fused_qkv(
+                queries, memory, memory_attention_bias, num_heads, num_units,
+                cache, decode_step)
         else:
-            # 'encoder decoder attention'
-            Q = tf.layers.dense(queries, num_units, use_bias=False, name='q')
-            if cache is not None:
-                K, V = tf.cond(
-                    tf.equal(tf.shape(cache["memory_keys"])[1], 0),
-                    true_fn=lambda: \
-                        [tf.layers.dense(memory, num_units, \
-                            use_bias=False, name='k'), \
-                        tf.layers.dense(memory, num_units, \
-                            use_bias=False, name='v')],
-                    false_fn=lambda: \
-                        [cache["memory_keys"], cache["memory_values"]])
-            else:
-                K, V = [tf.layers.dense(memory, num_units, \
-                            use_bias=False, name='k'),
-                        tf.layers.dense(memory, num_units, \
-                            use_bias=False, name='v')]
-
-        Q_ = _split_heads(Q, num_heads)
-        K_ = _split_heads(K, num_heads)
-        V_ = _split_heads(V, num_heads)
+            Q_, K_, V_, unfolded_Q, memory_attention_bias = _qkv(
+                queries, memory, memory_attention_bias, num_heads, num_units,
+                cache, decode_step)
         #[batch_size, num_heads, seq_length, memory_depth]
         key_depth_per_head = num_units // num_heads
         Q_ *= key_depth_per_head**-0.5
@@ -125,16 +190,231 @@ def multihead_attention(queries,
         if memory_attention_bias is not None:
             logits += memory_attention_bias
         weights = tf.nn.softmax(logits, name="attention_weights")
-        weights = tf.layers.dropout(weights, \
-            rate=dropout_rate, training=context.global_mode_train())
+        if dropout_fn is None:
+            weights = tf.layers.dropout(weights, \
+                rate=dropout_rate, training=context.global_mode_train())
+        else:
+            weights = dropout_fn(weights, dropout_rate)
         outputs = tf.matmul(weights, V_)
 
-        outputs = _combine_heads(outputs)
-        outputs = tf.layers.dense(outputs, num_units,\
-            use_bias=False, name='output_transform')
+        if fused:
+            # combines the heads in the output transform
+            with tf.variable_scope('output_transform'):
+                kernel = tf.get_variable('kernel', [num_units, num_units])
+            outputs = tf.einsum(
+                'bhtd,hdc->btc', outputs,
+                tf.reshape(kernel, [num_heads, key_depth_per_head, num_units]))
+            if unfolded_Q is not None:
+                outputs = tf.reshape(outputs, tf.shape(unfolded_Q))
+                outputs.set_shape(unfolded_Q.shape)
+        else:
+            outputs = _combine_heads(outputs)
+            if unfolded_Q is not None:
+                outputs = tf.reshape(outputs, tf.shape(unfolded_Q))
+                outputs.set_shape(unfolded_Q.shape)
+            outputs = tf.layers.dense(outputs, num_units,\
+                use_bias=False, name='output_transform')
         #(batch_size, length_query, attention_depth)
     return outputs
 
+def _length_bias(keys, decode_step, memory_attention_bias):
+    """Masks out the positions of the preallocated buffers after
+    :attr:`decode_step`.
+    """
+    unwritten = tf.to_float(tf.range(tf.shape(keys)[0]) > decode_step)
+    length_bias = tf.reshape(-1e18 * unwritten, [1, 1, 1, -1])
+    return length_bias if memory_attention_bias is None \
+        else memory_attention_bias + length_bias
+
+def _qkv(queries, memory, memory_attention_bias, num_heads, num_units,
+         cache, decode_step):
+    """Projects the queries, keys and values of :func:`multihead_attention`
+    with separate `q`, `k` and `v` variables, and splits their heads.
+    """
+    unfolded_Q = None
+    if memory is None:
+        #'self attention'
+        Q = tf.layers.dense(queries, num_units, use_bias=False, name='q')
+        K = tf.layers.dense(queries, num_units, use_bias=False, name='k')
+        V = tf.layers.dense(queries, num_units, use_bias=False, name='v')
+        if cache is not None and decode_step is not None:
+            # 'decoder self attention with preallocated
+            # [max_length, batch, num_units] buffers, written in place'
+            keys = inplace_ops.alias_inplace_update(
+                cache['self_keys'], decode_step, K[:, 0])
+            values = inplace_ops.alias_inplace_update(
+                cache['self_values'], decode_step, V[:, 0])
+            cache['self_keys'] = keys
+            cache['self_values'] = values
+            K = tf.transpose(keys, [1, 0, 2])
+            V = tf.transpose(values, [1, 0, 2])
+            memory_attention_bias = _length_bias(
+                keys, decode_step, memory_attention_bias)
+        elif cache is not None:
+            # 'decoder self attention when dynamic decoding'
+            K = tf.concat([cache['self_keys'], K], axis=1)
+            V = tf.concat([cache['self_values'], V], axis=1)
+            cache['self_keys'] = K
+            cache['self_values'] = V
+    else:
+        # 'encoder decoder attention'
+        Q = tf.layers.dense(queries, num_units, use_bias=False, name='q')
+        if cache is not None and 'memory_keys' in cache:
+            # projected once per memory, see `memory_keys_values`
+            K, V = cache['memory_keys'], cache['memory_values']
+            # the queries sharing a memory are folded into its length
+            unfolded_Q = Q
+            Q = tf.reshape(Q, [tf.shape(K)[0], -1, num_units])
+        else:
+            K, V = _project_memory(memory, num_units)
+
+    return (_split_heads(Q, num_heads), _split_heads(K, num_heads),
+            _split_heads(V, num_heads), unfolded_Q, memory_attention_bias)
+
+def _fused_qkv(queries, memory, memory_attention_bias, num_heads, num_units,
+               cache, decode_step):
+    """Projects the queries, keys and values of :func:`multihead_attention`
+    with the fused `qkv` or `kv` variables, directly into head-major layout.
+    """
+    unfolded_Q = None
+    if memory is None:
+        #'self attention'
+        Q_, K_, V_ = tf.unstack(_project_heads(
+            queries, 3, num_heads, num_units, name='qkv'))
+        if cache is not None and decode_step is not None:
+            # the preallocated buffers keep their [max_length, batch,
+            # num_units] layout, so that the step is written in one row
+            batch_size = tf.shape(queries)[0]
+            keys = inplace_ops.alias_inplace_update(
+                cache['self_keys'], decode_step,
+                tf.reshape(K_, [batch_size, num_units]))
+            values = inplace_ops.alias_inplace_update(
+                cache['self_values'], decode_step,
+                tf.reshape(V_, [batch_size, num_units]))
+            cache['self_keys'] = keys
+            cache['self_values'] = values
+            K_ = _split_heads_time_major(keys, num_heads)
+            V_ = _split_heads_time_major(values, num_heads)
+            memory_attention_bias = _length_bias(
+                keys, decode_step, memory_attention_bias)
+        elif cache is not None:
+            K_ = tf.concat([cache['self_keys'], K_], axis=2)
+            V_ = tf.concat([cache['self_values'], V_], axis=2)
+            cache['self_keys'] = K_
+            cache['self_values'] = V_
+    else:
+        # 'encoder decoder attention'
+        Q = tf.layers.dense(queries, num_units, use_bias=False, name='q')
+        if cache is not None and 'memory_keys' in cache:
+            # projected once per memory, see `memory_keys_values`
+            K_, V_ = cache['memory_keys'], cache['memory_values']
+            # the queries sharing a memory are folded into its length
+            unfolded_Q = Q
+            Q = tf.reshape(Q, [tf.shape(K_)[0], -1, num_units])
+        else:
+            K_, V_ = tf.unstack(_project_heads(
+                memory, 2, num_heads, num_units, name='kv'))
+        Q_ = _split_heads(Q, num_heads)
+    return Q_, K_, V_, unfolded_Q, memory_attention_bias
+
+def _project_heads(inputs, num, num_heads, num_units, name):
+    """Projects :attr:`inputs` with a single fused variable into :attr:`num`
+    tensors of head-major layout, stacked as
+    `[num, batch, num_heads, length, num_units/num_heads]`.
+    """
+    outputs = tf.layers.dense(inputs, num * num_units, use_bias=False,
+                              name=name)
+    outputs = tf.reshape(outputs, [tf.shape(inputs)[0], tf.shape(inputs)[1],
+                                   num, num_heads, num_units // num_heads])
+    return tf.transpose(outputs, [2, 0, 3, 1, 4])
+
+def _split_heads_time_major(x, num_heads):
+    """[length, batch, depth] -> [batch, num_heads, length, depth/num_heads]
+    """
+    depth = x.get_shape()[-1]
+    splitted_x = tf.reshape(x, [tf.shape(x)[0], tf.shape(x)[1], \
+        num_heads, depth // num_heads])
+    return tf.transpose(splitted_x, [1, 2, 0, 3])
+
+def memory_keys_values(memory, num_units, scope='multihead_attention',
+                       num_heads=None):
+    """Projects the memory of an encoder-decoder :func:`multihead_attention`
+    into its keys and values, with the variables of the attention under
+    :attr:`scope`.
+
+    In dynamic decoding the memory is the same in every step, so the keys
+    and values can be computed once and passed to
+    :func:`multihead_attention` in `cache`.
+
+    If :attr:`num_heads` is given, the memory is projected for the `fused`
+    attention instead, into head-major keys and values.
+
+    Returns:
+        A tuple `(keys, values)` of tensors of shape
+        `[batch, length_memory, num_units]`, or
+        `[batch, num_heads, length_memory, num_units/num_heads]` if
+        :attr:`num_heads` is given.
+    """
+    with tf.variable_scope(scope):
+        if num_heads is not None:
+            return tuple(tf.unstack(_project_heads(
+                memory, 2, num_heads, num_units, name='kv')))
+        return _project_memory(memory, num_units)
+
+def _project_memory(memory, num_units):
+    keys = tf.layers.dense(memory, num_units, use_bias=False, name='k')
+    values = tf.layers.dense(memory, num_units, use_bias=False, name='v')
+    return keys, values
+
+def load_unfused_attention_checkpoint(session, checkpoint_path,
+                                      var_list=None):
+    """Loads a checkpoint of :func:`multihead_attention` with separate `q`,
+    `k` and `v` variables into a model built with `fused=True`. The fused
+    `qkv` and `kv` variables (and their optimizer slots) are loaded with the
+    concatenation of the corresponding `q`, `k` and `v` variables of the
+    checkpoint, and the other variables are loaded as they are.
+
+    Args:
+        session: The session to load the variables in.
+        checkpoint_path: The checkpoint file, or the directory of the
+            latest checkpoint.
+        var_list (optional): The variables to load. If `None`, all the
+            global variables are loaded.
+
+    Returns:
+        The list of variables not found in the checkpoint, which are left
+        as they are.
+    """
+    if tf.gfile.IsDirectory(checkpoint_path):
+        checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    if var_list is None:
+        var_list = tf.global_variables()
+
+    missing = []
+    for var in var_list:
+        name = var.op.name
+        if reader.has_tensor(name):
+            value = reader.get_tensor(name)
+        else:
+            value = None
+            for fused, parts in [('/qkv/', ['q', 'k', 'v']),
+                                 ('/kv/', ['k', 'v'])]:
+                if fused not in name:
+                    continue
+                part_names = [name.replace(fused, '/{}/'.format(part), 1)
+                              for part in parts]
+                if all(reader.has_tensor(part) for part in part_names):
+                    value = np.concatenate(
+                        [reader.get_tensor(part) for part in part_names],
+                        axis=-1)
+                break
+        if value is None:
+            missing.append(var)
+        else:
+            var.load(value, session)
+    return missing
+
 def layer_normalize(inputs,
                     epsilon=1e-8,
                     scope='ln',
@@ -0,0 +1,214 @@
+#
+"""
+Unit tests for attentions.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import tempfile
+
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.python.ops import inplace_ops
+
+from texar.core import attentions
+
+# pylint: disable=invalid-name
+
+
+class MultiheadAttentionTest(tf.test.TestCase):
+    """Tests :func:`texar.core.attentions.multihead_attention`.
+    """
+
+    def test_memory_cache(self):
+        """Tests that encoder-decoder attention with the memory keys and
+        values in cache equals that projecting the memory itself.
+        """
+        queries = tf.random_uniform([3, 1, 16])
+        memory = tf.random_uniform([3, 7, 16])
+        with tf.variable_scope('encdec_attention'):
+            outputs = attentions.multihead_attention(
+                queries, memory=memory, num_heads=4, num_units=16)
+        with tf.variable_scope('encdec_attention', reuse=True):
+            keys, values = attentions.memory_keys_values(memory, 16)
+            cache = {'memory_keys': keys, 'memory_values': values}
+            cached_outputs = attentions.multihead_attention(
+                queries, memory=memory, num_heads=4, num_units=16, cache=cache)
+        self.assertEqual(len(tf.trainable_variables()), 4)
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs_, cached_outputs_ = sess.run([outputs, cached_outputs])
+            np.testing.assert_allclose(outputs_, cached_outputs_, rtol=1e-5)
+
+    def test_shared_memory_cache(self):
+        """Tests that a memory shared by consecutive queries in cache equals
+        the memory tiled to the queries.
+        """
+        queries = tf.random_uniform([6, 1, 16])
+        memory = tf.random_uniform([2, 7, 16])
+        tiled_memory = tf.reshape(
+            tf.tile(tf.expand_dims(memory, 1), [1, 3, 1, 1]), [6, 7, 16])
+        with tf.variable_scope('encdec_attention'):
+            outputs = attentions.multihead_attention(
+                queries, memory=tiled_memory, num_heads=4, num_units=16)
+        with tf.variable_scope('encdec_attention', reuse=True):
+            keys, values = attentions.memory_keys_values(memory, 16)
+            cache = {'memory_keys': keys, 'memory_values': values}
+            shared_outputs = attentions.multihead_attention(
+                queries, memory=memory, num_heads=4, num_units=16, cache=cache)
+        self.assertEqual(shared_outputs.shape.as_list(), [6, 1, 16])
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs_, shared_outputs_ = sess.run([outputs, shared_outputs])
+            np.testing.assert_allclose(outputs_, shared_outputs_, rtol=1e-5)
+
+    def test_preallocated_cache(self):
+        """Tests that self attention writing each step into preallocated
+        buffers equals that concatenating the steps.
+        """
+        max_length, batch_size = 5, 3
+        inputs = tf.random_uniform([batch_size, max_length, 16])
+        cache = {'self_keys': tf.zeros([batch_size, 0, 16]),
+                 'self_values': tf.zeros([batch_size, 0, 16])}
+        buffers = {
+            'self_keys': inplace_ops.empty(
+                [max_length, batch_size, 16], tf.float32, init=True),
+            'self_values': inplace_ops.empty(
+                [max_length, batch_size, 16], tf.float32, init=True)}
+        outputs, preallocated_outputs = [], []
+        for step in range(3):
+            with tf.variable_scope('self_attention', reuse=step > 0):
+                outputs.append(attentions.multihead_attention(
+                    inputs[:, step:step+1], num_heads=4, num_units=16,
+                    cache=cache))
+            with tf.variable_scope('self_attention', reuse=True):
+                preallocated_outputs.append(attentions.multihead_attention(
+                    inputs[:, step:step+1], num_heads=4, num_units=16,
+                    cache=buffers, decode_step=tf.constant(step)))
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs_, preallocated_outputs_ = sess.run(
+                [outputs, preallocated_outputs])
+            np.testing.assert_allclose(outputs_, preallocated_outputs_,
+                                       rtol=1e-5)
+
+    def _attention_outputs(self, queries, memory, fused):
+        """Self attention and encoder-decoder attention, the latter with
+        the memory projected in cache, and the former step by step with
+        the keys and values in cache.
+        """
+        bias = attentions.attention_bias_lower_triangle(5)
+        with tf.variable_scope('self_attention'):
+            self_outputs = attentions.multihead_attention(
+                queries, memory_attention_bias=bias, num_heads=4,
+                num_units=16, fused=fused)
+        with tf.variable_scope('encdec_attention'):
+            encdec_outputs = attentions.multihead_attention(
+                queries, memory=memory, num_heads=4, num_units=16,
+                fused=fused)
+        with tf.variable_scope('encdec_attention', reuse=True):
+            keys, values = attentions.memory_keys_values(
+                memory, 16, num_heads=4 if fused else None)
+            cached_encdec_outputs = attentions.multihead_attention(
+                queries, memory=memory, num_heads=4, num_units=16,
+                cache={'memory_keys': keys, 'memory_values': values},
+                fused=fused)
+        if fused:
+            cache = {'self_keys': tf.zeros([3, 4, 0, 4]),
+                     'self_values': tf.zeros([3, 4, 0, 4])}
+        else:
+            cache = {'self_keys': tf.zeros([3, 0, 16]),
+                     'self_values': tf.zeros([3, 0, 16])}
+        step_outputs = []
+        for step in range(5):
+            with tf.variable_scope('self_attention', reuse=True):
+                step_outputs.append(attentions.multihead_attention(
+                    queries[:, step:step+1], num_heads=4, num_units=16,
+                    cache=cache, fused=fused))
+        return [self_outputs, encdec_outputs, cached_encdec_outputs,
+                tf.concat(step_outputs, axis=1)]
+
+    def test_fused_attention(self):
+        """Tests that the fused attention, loaded from a checkpoint of the
+        unfused one, gives the same outputs.
+        """
+        queries_ = np.random.rand(3, 5, 16).astype(np.float32)
+        memory_ = np.random.rand(3, 7, 16).astype(np.float32)
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), 'model.ckpt')
+        with tf.Graph().as_default() as graph:
+            outputs = self._attention_outputs(
+                tf.constant(queries_), tf.constant(memory_), fused=False)
+            with self.test_session(graph=graph) as sess:
+                sess.run(tf.global_variables_initializer())
+                outputs_ = sess.run(outputs)
+                tf.train.Saver().save(sess, checkpoint_path)
+
+        with tf.Graph().as_default() as graph:
+            fused_outputs = self._attention_outputs(
+                tf.constant(queries_), tf.constant(memory_), fused=True)
+            self.assertEqual(len(tf.trainable_variables()), 5)
+            with self.test_session(graph=graph) as sess:
+                missing = attentions.load_unfused_attention_checkpoint(
+                    sess, checkpoint_path)
+                self.assertEqual(missing, [])
+                fused_outputs_ = sess.run(fused_outputs)
+
+        for output_, fused_output_ in zip(outputs_, fused_outputs_):
+            np.testing.assert_allclose(output_, fused_output_, rtol=1e-5)
+        np.testing.assert_allclose(fused_outputs_[0], fused_outputs_[3],
+                                   rtol=1e-5)
+        np.testing.assert_allclose(fused_outputs_[1], fused_outputs_[2],
+                                   rtol=1e-5)
+
+    def test_gather_local_memory(self):
+        """Tests that attending to the gathered local memory equals
+        attending to the whole memory with the other positions masked out.
+        """
+        queries = tf.random_uniform([3, 2, 16])
+        memory = tf.random_uniform([3, 10, 16])
+        padding = np.zeros([3, 10], dtype=np.float32)
+        padding[1, 8:] = 1.
+        global_mask = np.zeros([3, 10], dtype=bool)
+        global_mask[0, [5, 9]] = True
+        global_mask[1, [0, 5, 9]] = True
+        starts = np.array([-2, 4, 8], dtype=np.int32)
+        # the windows moved into the memory
+        attended = np.copy(global_mask)
+        for row, start in enumerate([0, 4, 6]):
+            attended[row, start:start + 4] = True
+        bias = attentions.attention_bias_ignore_padding(tf.constant(padding))
+
+        local_memory, local_bias = attentions.gather_local_memory(
+            memory, bias, tf.constant(starts), 4, tf.constant(global_mask))
+        self.assertEqual(local_memory.shape.as_list()[-1], 16)
+        with tf.variable_scope('encdec_attention'):
+            outputs = attentions.multihead_attention(
+                queries, memory=memory, num_heads=4, num_units=16,
+                memory_attention_bias=bias + tf.reshape(
+                    -1e18 * (1. - attended.astype(np.float32)),
+                    [3, 1, 1, 10]))
+        with tf.variable_scope('encdec_attention', reuse=True):
+            local_outputs = attentions.multihead_attention(
+                queries, memory=local_memory, num_heads=4, num_units=16,
+                memory_attention_bias=local_bias)
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            local_memory_, outputs_, local_outputs_ = sess.run(
+                [local_memory, outputs, local_outputs])
+            # the window, and the global positions out of it of the row
+            # with the most
+            self.assertEqual(local_memory_.shape[1], 4 + 2)
+            np.testing.assert_allclose(outputs_, local_outputs_, rtol=1e-5)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -57,6 +57,8 @@ __all__ = [
     #TODO(haoran): the reorganizing of following functions
     "multihead_attention",
     "layer_normalize",
+    "seeded_dropout",
+    "recompute_grad",
 ]
 
 def default_rnn_cell_hparams():
@@ -1309,3 +1311,80 @@ def ones_matrix_band_part(rows, cols, num_lower, num_upper, out_shape=None):
         if out_shape:
             band = tf.reshape(band, out_shape)
     return band
+
+
+def seeded_dropout(seed):
+    """Returns a function `dropout(inputs, rate)` applying dropout in the
+    training mode, as :tf_main:`tf.layers.dropout <layers/dropout>`, but
+    with masks determined by :attr:`seed` and the number of its previous
+    calls. Calling the function again in the same order on a new
+    `seeded_dropout(seed)` gives the same masks, e.g., when
+    :func:`recompute_grad` computes a function again.
+
+    Args:
+        seed: A int64 tensor of shape `[2]`.
+    """
+    num_calls = [0]
+    def _dropout(inputs, rate):
+        num_calls[0] += 1
+        call_seed = seed + tf.constant([0, num_calls[0]], dtype=tf.int64)
+        def _drop():
+            uniform = tf.contrib.stateless.stateless_random_uniform(
+                tf.shape(inputs), call_seed, dtype=inputs.dtype)
+            return tf.where(uniform >= rate, inputs / (1. - rate),
+                            tf.zeros_like(inputs))
+        return tf.cond(context.global_mode_train(), _drop, lambda: inputs)
+    return _dropout
+
+
+def recompute_grad(fn, inputs):
+    """Calls `fn(*inputs)` without keeping the intermediate activations of
+    `fn` for the backward pass, which calls `fn` again instead, trading
+    computation for memory.
+
+    `fn` must create its variables in the current variable scope, which
+    are reused, and must give the same outputs when called again, e.g.,
+    with dropout from :func:`seeded_dropout`. If the variables do not exist
+    yet, `fn` is called once more beforehand to create them.
+
+    Args:
+        fn: A function taking the tensors in :attr:`inputs` and returning
+            a tensor.
+        inputs: A list of float tensors.
+
+    Returns:
+        The output of `fn`.
+    """
+    scope = tf.get_variable_scope()
+    def _get_variables():
+        return [var for var in tf.trainable_variables()
+                if var.op.name.startswith(scope.name + '/')]
+    fn_variables = _get_variables()
+    if not fn_variables:
+        fn(*inputs)
+        fn_variables = _get_variables()
+    num_inputs = len(inputs)
+
+    @tf.custom_gradient
+    def _fn(*args):
+        # The values of `fn_variables` are inputs too, so that they get their
+        # gradients, but `fn` reads them from the variable scope.
+        with tf.variable_scope(scope, reuse=True):
+            outputs = fn(*args[:num_inputs])
+
+        def _grad(grad_outputs, variables=None):
+            with tf.control_dependencies([grad_outputs]):
+                inputs_ = [tf.identity(x) for x in args[:num_inputs]]
+            with tf.variable_scope(scope, reuse=True):
+                outputs_ = fn(*inputs_)
+            grads = tf.gradients(outputs_, inputs_ + fn_variables,
+                                 grad_ys=grad_outputs)
+            if variables is None:
+                return grads
+            # The variables read in `fn`, with resource variables, have got
+            # their gradients as the inputs above.
+            return grads, [None] * len(variables)
+
+        return outputs, _grad
+
+    return _fn(*(list(inputs) + fn_variables))
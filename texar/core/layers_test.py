@@ -17,6 +17,7 @@ import texar as tx
 from texar import context
 from texar.hyperparams import HParams
 from texar.core import layers
+from texar.core import attentions
 
 # pylint: disable=no-member, protected-access, invalid-name
 
@@ -304,6 +305,47 @@ class SequentialLayerTest(tf.test.TestCase):
             self.assertEqual(outputs_.shape[0], 10)
             self.assertEqual(outputs_.shape[1], 200)
 
+class RecomputeGradTest(tf.test.TestCase):
+    """Tests :func:`texar.core.layers.recompute_grad`.
+    """
+
+    def test_recompute_grad(self):
+        """Tests that a layer with dropout computed again in the backward
+        pass has the same outputs and gradients as the layer itself.
+        """
+        inputs = tf.random_uniform([3, 5, 16])
+        seed = tf.constant([1, 2], dtype=tf.int64)
+
+        def _layer(x):
+            dropout = layers.seeded_dropout(seed)
+            with tf.variable_scope('self_attention'):
+                x = x + dropout(attentions.multihead_attention(
+                    layers.layer_normalize(x), num_heads=4, num_units=16,
+                    dropout_rate=0.5, dropout_fn=dropout), 0.5)
+            return x + dropout(tf.layers.dense(x, 16, name='dense'), 0.5)
+
+        with tf.variable_scope('layer'):
+            recomputed_outputs = layers.recompute_grad(_layer, [inputs])
+        with tf.variable_scope('layer', reuse=True):
+            outputs = _layer(inputs)
+        variables = tf.trainable_variables()
+        self.assertEqual(len(variables), 8)
+        grads = tf.gradients(tf.reduce_sum(tf.square(outputs)),
+                             [inputs] + variables)
+        recomputed_grads = tf.gradients(
+            tf.reduce_sum(tf.square(recomputed_outputs)), [inputs] + variables)
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs_, recomputed_outputs_, grads_, recomputed_grads_ = \
+                sess.run([outputs, recomputed_outputs, grads,
+                          recomputed_grads])
+            np.testing.assert_allclose(outputs_, recomputed_outputs_,
+                                       rtol=1e-5)
+            for grad_, recomputed_grad_ in zip(grads_, recomputed_grads_):
+                np.testing.assert_allclose(grad_, recomputed_grad_,
+                                           rtol=1e-4, atol=1e-5)
+
 
 if __name__ == "__main__":
     tf.test.main()
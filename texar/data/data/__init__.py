@@ -15,5 +15,7 @@ from texar.data.data.text_data_base import *
 from texar.data.data.mono_text_data import *
 from texar.data.data.paired_text_data import *
 from texar.data.data.multi_aligned_data import *
+from texar.data.data.template_shard_data import *
+from texar.data.data.infilling_text_data import *
 from texar.data.data.data_iterators import *
 from texar.data.data.dataset_utils import *
@@ -0,0 +1,138 @@
+#
+"""
+Mono text data that also builds text infilling templates and answers
+within the input pipeline.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from texar.data.data.mono_text_data import MonoTextData, \
+    _default_mono_text_dataset_hparams
+from texar.data.data.template_shard_data import TemplateShardData, \
+    flatten_template_packs
+from texar.utils.transformer_utils import prepare_template
+
+# pylint: disable=invalid-name, arguments-differ, not-context-manager
+
+__all__ = [
+    "_default_infilling_text_dataset_hparams",
+    "InfillingTextData"
+]
+
+
+def _default_infilling_text_dataset_hparams():
+    """Returns hyperparameters of an infilling text dataset with default
+    values.
+    """
+    hparams = _default_mono_text_dataset_hparams()
+    hparams.update({
+        "present_rate": 0.5,
+        "blank_num": 1,
+        "mask_strategy": "random",
+        "blank_length": 1,
+        "mask_token": "<m>",
+        "boa_token": "<BOA>",
+        "eoa_token": "<EOA>",
+        "pad_token": "<PAD>"
+    })
+    return hparams
+
+
+class InfillingTextData(MonoTextData):
+    """Text data that masks every batch into a template and answers, as
+    :func:`~texar.utils.prepare_template` does, inside the input pipeline.
+
+    Masking runs as a batch-level `dataset.map` with
+    :attr:`"num_parallel_calls"` parallel calls, before prefetching, so that
+    template construction of the next batches overlaps with the training
+    step. It is built with native TF ops only (`in_graph=True`).
+
+    Besides the fields of :class:`~texar.data.MonoTextData`, each batch holds
+    the template pack under keys prefixed with `"template_"`, and the answer
+    pack of the i-th blank under keys prefixed with `"answer{i}_"`. Use
+    :meth:`unpack` to recover the structures returned by
+    :func:`~texar.utils.prepare_template`.
+
+    Args:
+        hparams: A `dict` or instance of :class:`~texar.HParams` containing
+            hyperparameters. See :meth:`default_hparams` for the defaults.
+    """
+
+    def __init__(self, hparams):
+        MonoTextData.__init__(self, hparams)
+
+    @staticmethod
+    def default_hparams():
+        """Returns a dicitionary of default hyperparameters.
+
+        The `"dataset"` field extends that of
+        :meth:`~texar.data.MonoTextData.default_hparams` with:
+
+        "present_rate" : float
+            Portion of the tokens kept in the template.
+
+        "blank_num" : int
+            Number of blanks in the template.
+
+        "mask_strategy" : str
+            `"random"` masks a `1 - present_rate` portion of every example
+            into blanks of varying lengths. `"equal_length"` masks blanks of
+            exactly `"blank_length"` tokens each, with answers of fixed
+            shape.
+
+        "blank_length" : int
+            Number of tokens of every blank, if `"mask_strategy"` is
+            `"equal_length"`.
+
+        "mask_token", "boa_token", "eoa_token", "pad_token" : str
+            The special tokens of the blanks and answers. Must be in the
+            vocabulary.
+        """
+        hparams = MonoTextData.default_hparams()
+        hparams["name"] = "infilling_text_data"
+        hparams.update({
+            "dataset": _default_infilling_text_dataset_hparams()
+        })
+        return hparams
+
+    def _make_template_fn(self):
+        dataset_hparams = self._hparams.dataset
+        token_to_id = self._vocab.token_to_id_map_py
+        mask_id = token_to_id[dataset_hparams.mask_token]
+        boa_id = token_to_id[dataset_hparams.boa_token]
+        eoa_id = token_to_id[dataset_hparams.eoa_token]
+        pad_id = token_to_id[dataset_hparams.pad_token]
+        text_id_name, length_name = self.text_id_name, self.length_name
+
+        def _make_template(data_batch):
+            inputs = {
+                'text_ids': data_batch[text_id_name],
+                'length': data_batch[length_name]
+            }
+            template_pack, answer_packs = prepare_template(
+                inputs, dataset_hparams, mask_id, boa_id, eoa_id, pad_id,
+                in_graph=True)
+            data_batch = dict(data_batch)
+            data_batch.update(flatten_template_packs(template_pack, answer_packs))
+            return data_batch
+
+        return _make_template
+
+    def _make_batch(self, dataset, hparams, element_length_func,
+                    padded_shapes=None, padding_values=None):
+        # Masks after batching, so that the templates and answers are
+        # padded as in `prepare_template`.
+        dataset = MonoTextData._make_batch(
+            dataset, hparams, element_length_func, padded_shapes, padding_values)
+        return dataset.map(self._make_template_fn(),
+                           num_parallel_calls=hparams["num_parallel_calls"])
+
+    @staticmethod
+    def unpack(data_batch, blank_num):
+        """Splits a batch into `(template_pack, answer_packs)`, structured as
+        returned by :func:`~texar.utils.prepare_template`.
+        """
+        return TemplateShardData.unpack(data_batch, blank_num)
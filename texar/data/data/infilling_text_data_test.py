@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Unit tests for infilling text data.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import tempfile
+import numpy as np
+
+import tensorflow as tf
+
+import texar as tx
+from texar.utils.transformer_utils import prepare_template_np
+
+# pylint: disable=invalid-name
+
+class InfillingTextDataTest(tf.test.TestCase):
+    """Tests infilling text data class.
+    """
+
+    def setUp(self):
+        tf.test.TestCase.setUp(self)
+
+        # Create test data
+        vocab_list = ['<m>', '<BOA>', '<EOA>', 'a', 'b', 'c', 'd', 'e']
+        vocab_file = tempfile.NamedTemporaryFile()
+        vocab_file.write('\n'.join(vocab_list).encode("utf-8"))
+        vocab_file.flush()
+        self._vocab_file = vocab_file
+
+        text = ['a b c d e a b c d e', 'e d c b a', 'a a b b c c d d e e',
+                'c d e a b c', 'b c d e a b c d e a b', 'd e a b c d e a']
+        text_file = tempfile.NamedTemporaryFile()
+        text_file.write('\n'.join(text).encode("utf-8"))
+        text_file.flush()
+        self._text_file = text_file
+
+        self._hparams = {
+            "num_epochs": 2,
+            "batch_size": 4,
+            "shuffle": False,
+            "num_parallel_calls": 2,
+            "prefetch_buffer_size": 2,
+            "dataset": {
+                "files": self._text_file.name,
+                "vocab_file": self._vocab_file.name,
+                "present_rate": 0.5,
+                "blank_num": 2
+            }
+        }
+
+    def test_templates(self):
+        """Tests that the templates match those of `prepare_template`.
+        """
+        data = tx.data.InfillingTextData(self._hparams)
+        token_to_id = data.vocab.token_to_id_map_py
+        special_ids = [token_to_id[token]
+                       for token in ['<m>', '<BOA>', '<EOA>', '<PAD>']]
+
+        iterator = tx.data.DataIterator(data)
+        data_batch = iterator.get_next()
+        template_pack, answer_packs = tx.data.InfillingTextData.unpack(data_batch, 2)
+
+        with self.test_session() as sess:
+            sess.run(tf.tables_initializer())
+            iterator.switch_to_dataset(sess)
+            batch_cnt = 0
+            while True:
+                try:
+                    rtns = sess.run([data_batch, template_pack, answer_packs])
+                except tf.errors.OutOfRangeError:
+                    break
+                template_pack_, answer_packs_ = prepare_template_np(
+                    rtns[0]['text_ids'], rtns[0]['length'], 0.5, 2, *special_ids)
+                for pack, pack_ in zip([rtns[1]] + rtns[2],
+                                       [template_pack_] + answer_packs_):
+                    for key, value in pack_.items():
+                        np.testing.assert_array_equal(pack[key], value)
+                batch_cnt += 1
+            self.assertEqual(batch_cnt, 3)
+
+if __name__ == "__main__":
+    tf.test.main()
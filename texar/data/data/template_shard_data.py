@@ -0,0 +1,241 @@
+#
+"""
+Data class that reads precomputed text infilling templates and answers
+from TFRecord shards.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from texar.data.data.data_base import DataBase
+from texar.data.data.mono_text_data import MonoTextData
+
+# pylint: disable=invalid-name, arguments-differ, not-context-manager
+
+__all__ = [
+    "_default_template_shard_dataset_hparams",
+    "template_shard_file_pattern",
+    "flatten_template_packs",
+    "make_template_shard_example",
+    "TemplateShardData"
+]
+
+_TEMPLATE_KEYS = {
+    'masks': tf.int64,
+    'text_ids': tf.int64,
+    'segment_ids': tf.int64,
+    'offsets': tf.int64,
+    'templates': tf.int64,
+    'start_positions': tf.int64,
+    'end_positions': tf.int64,
+    'template_lengths': tf.int32
+}
+
+_ANSWER_KEYS = {
+    'text_ids': tf.int64,
+    'segment_ids': tf.int64,
+    'offsets': tf.int64,
+    'lengths': tf.int32
+}
+
+_DATA_KEYS = {
+    'text_ids': tf.int64,
+    'length': tf.int32
+}
+
+
+def _default_template_shard_dataset_hparams():
+    """Returns hyperparameters of a template shard dataset with default
+    values.
+    """
+    return {
+        "files": [],
+        "compression_type": None,
+        "blank_num": 1,
+        "vocab_file": "",
+        "bos_token": None,
+        "eos_token": None,
+        "@no_typecheck": ["files"]
+    }
+
+
+def template_shard_file_pattern(data_dir, split, mask_rate, blank_num):
+    """Returns the file pattern of the shards of :attr:`split` (e.g.,
+    `"yahoo.train"`) built with the given masking configuration.
+    """
+    return os.path.join(
+        data_dir, '{}.mask{}.blank{}-*.tfrecord'.format(split, mask_rate, blank_num))
+
+
+def _feature_names(blank_num):
+    names = {'template_' + key: dtype for key, dtype in _TEMPLATE_KEYS.items()}
+    for idx in range(blank_num):
+        for key, dtype in _ANSWER_KEYS.items():
+            names['answer{}_{}'.format(idx, key)] = dtype
+    names.update(_DATA_KEYS)
+    return names
+
+
+def flatten_template_packs(template_pack, answer_packs):
+    """Flattens the packs returned by :func:`~texar.utils.prepare_template`
+    into a single dict, with the template pack under keys prefixed with
+    `"template_"`, and the answer pack of the i-th blank under keys
+    prefixed with `"answer{i}_"`. This is the inverse of
+    :meth:`TemplateShardData.unpack`.
+    """
+    rst = {'template_' + key: template_pack[key] for key in _TEMPLATE_KEYS}
+    for idx, answer_pack in enumerate(answer_packs):
+        for key in _ANSWER_KEYS:
+            rst['answer{}_{}'.format(idx, key)] = answer_pack[key]
+    return rst
+
+
+def make_template_shard_example(data_batch, template_pack, answer_packs):
+    """Serializes one batch of packs into a :tf_main:`tf.train.Example
+    <train/Example>`.
+
+    Args:
+        data_batch (dict): A batch of :class:`~texar.data.MonoTextData`,
+            holding at least `"text_ids"` and `"length"` as numpy arrays.
+        template_pack (dict): The template pack of the batch, e.g., as
+            returned by :func:`~texar.utils.prepare_template_np`.
+        answer_packs (list): The answer packs of the batch.
+
+    Returns:
+        A `tf.train.Example`.
+    """
+    arrays = flatten_template_packs(template_pack, answer_packs)
+    for key in _DATA_KEYS:
+        arrays[key] = data_batch[key]
+
+    feature = {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        feature[name] = tf.train.Feature(
+            int64_list=tf.train.Int64List(value=array.reshape(-1).tolist()))
+        feature[name + '/shape'] = tf.train.Feature(
+            int64_list=tf.train.Int64List(value=list(array.shape)))
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+class TemplateShardData(DataBase):
+    """Text infilling data where every record of the files is one batch of
+    precomputed templates and answers, as written by
+    `bin/make_template_shards.py`.
+
+    Each element of :attr:`dataset` is a dict holding the original
+    `"text_ids"` and `"length"` of the batch, the template pack under keys
+    prefixed with `"template_"`, and the answer pack of the i-th blank under
+    keys prefixed with `"answer{i}_"`. Use :meth:`unpack` to recover the
+    structures returned by :func:`~texar.utils.prepare_template`.
+
+    Since the records are batches already, hyperparameter `"batch_size"` is
+    ignored, and shuffling permutes whole batches.
+
+    Args:
+        hparams (dict): Hyperparameters. See :meth:`default_hparams` for the
+            defaults.
+    """
+
+    def __init__(self, hparams):
+        DataBase.__init__(self, hparams)
+        with tf.name_scope(self.name, self.default_hparams()["name"]):
+            self._make_data()
+
+    @staticmethod
+    def default_hparams():
+        """Returns a dicitionary of default hyperparameters.
+
+        `"dataset"` holds the shard `"files"`, the `"blank_num"` the shards
+        were built with, and optionally a `"vocab_file"` (together with
+        `"bos_token"` and `"eos_token"`) to create :attr:`vocab` from.
+        """
+        hparams = DataBase.default_hparams()
+        hparams["name"] = "template_shard_data"
+        hparams["shuffle_buffer_size"] = 256
+        hparams.update({
+            "dataset": _default_template_shard_dataset_hparams()
+        })
+        return hparams
+
+    def _make_parser(self):
+        features = _feature_names(self._hparams.dataset.blank_num)
+        feature_specs = {}
+        for name in features:
+            feature_specs[name] = tf.VarLenFeature(tf.int64)
+            feature_specs[name + '/shape'] = tf.VarLenFeature(tf.int64)
+
+        def _parse(serialized):
+            parsed = tf.parse_single_example(serialized, feature_specs)
+            rst = {}
+            for name, dtype in features.items():
+                value = tf.sparse_tensor_to_dense(parsed[name])
+                shape = tf.sparse_tensor_to_dense(parsed[name + '/shape'])
+                rst[name] = tf.cast(tf.reshape(value, shape), dtype)
+            return rst
+
+        return _parse
+
+    def _make_data(self):
+        dataset_hparams = self._hparams.dataset
+        if dataset_hparams.vocab_file:
+            self._vocab = MonoTextData.make_vocab(dataset_hparams)
+        else:
+            self._vocab = None
+
+        files = tf.gfile.Glob(dataset_hparams.files) \
+            if isinstance(dataset_hparams.files, str) else dataset_hparams.files
+        dataset = tf.data.TFRecordDataset(
+            files, compression_type=dataset_hparams.compression_type)
+        if self._hparams.shuffle:
+            dataset = dataset.shuffle(self._hparams.shuffle_buffer_size,
+                                      seed=self._hparams.seed)
+        dataset = dataset.map(self._make_parser(),
+                              num_parallel_calls=self._hparams.num_parallel_calls)
+        dataset = dataset.take(self._hparams.max_dataset_size)
+        dataset = dataset.repeat(self._hparams.num_epochs)
+        if self._hparams.prefetch_buffer_size > 0:
+            dataset = dataset.prefetch(self._hparams.prefetch_buffer_size)
+        self._dataset = dataset
+
+    @staticmethod
+    def unpack(data_batch, blank_num):
+        """Splits an element of :attr:`dataset` into `(template_pack,
+        answer_packs)`, structured as returned by
+        :func:`~texar.utils.prepare_template`.
+        """
+        template_pack = {key: data_batch['template_' + key]
+                         for key in _TEMPLATE_KEYS}
+        answer_packs = []
+        for idx in range(blank_num):
+            answer_packs.append({key: data_batch['answer{}_{}'.format(idx, key)]
+                                 for key in _ANSWER_KEYS})
+        return template_pack, answer_packs
+
+    def list_items(self):
+        """Returns the list of item names that the data can produce.
+
+        Returns:
+            A list of strings.
+        """
+        return list(self._dataset.output_types.keys())
+
+    @property
+    def dataset(self):
+        """The dataset.
+        """
+        return self._dataset
+
+    @property
+    def vocab(self):
+        """The vocabulary, an instance of :class:`~texar.data.Vocab`, or
+        `None` if `"vocab_file"` is not given.
+        """
+        return self._vocab
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Unit tests for template shard data.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import tempfile
+import numpy as np
+
+import tensorflow as tf
+
+import texar as tx
+from texar.utils.transformer_utils import prepare_template_np
+
+
+class TemplateShardDataTest(tf.test.TestCase):
+    """Tests template shard data class.
+    """
+
+    def setUp(self):
+        tf.test.TestCase.setUp(self)
+
+        rng = np.random.RandomState(1234)
+        self._batches = []
+        shard_file = tempfile.NamedTemporaryFile()
+        writer = tf.python_io.TFRecordWriter(shard_file.name)
+        for batch_size, max_seq_length in [(4, 12), (3, 9)]:
+            batch = {
+                'text_ids': rng.randint(5, 50, size=(batch_size, max_seq_length)),
+                'length': np.full([batch_size], max_seq_length, dtype=np.int32)
+            }
+            packs = prepare_template_np(batch['text_ids'], batch['length'],
+                                        0.5, 2, 1, 2, 3, 0)
+            example = tx.data.make_template_shard_example(batch, *packs)
+            writer.write(example.SerializeToString())
+            self._batches.append((batch, packs))
+        writer.close()
+        self._shard_file = shard_file
+
+        self._hparams = {
+            "num_epochs": 1,
+            "shuffle": False,
+            "dataset": {
+                "files": [self._shard_file.name],
+                "blank_num": 2
+            }
+        }
+
+    def test_read(self):
+        """Tests that the packs are read back unchanged.
+        """
+        data = tx.data.TemplateShardData(self._hparams)
+        iterator = data.dataset.make_initializable_iterator()
+        data_batch = iterator.get_next()
+        template_pack, answer_packs = \
+            tx.data.TemplateShardData.unpack(data_batch, 2)
+
+        with self.test_session() as sess:
+            sess.run(iterator.initializer)
+            for batch, (template_pack_, answer_packs_) in self._batches:
+                rtns = sess.run([data_batch, template_pack, answer_packs])
+                for key in ['text_ids', 'length']:
+                    np.testing.assert_array_equal(rtns[0][key], batch[key])
+                for pack, pack_ in zip([rtns[1]] + rtns[2],
+                                       [template_pack_] + answer_packs_):
+                    for key, value in pack_.items():
+                        np.testing.assert_array_equal(pack[key], value)
+            with self.assertRaises(tf.errors.OutOfRangeError):
+                sess.run(data_batch)
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -378,6 +378,75 @@ class BasicPositionalRNNDecoder(RNNDecoderBase):
     def set_segment_id(self, segment_id):
         self.current_segment_id = segment_id
 
+    def _position_embeds(self, length, channels, offsets):
+        batch_size = tf.shape(offsets)[0]
+        return self.position_embedder(
+            length=length,
+            channels=channels,
+            segment_ids=tf.cast(tf.fill([batch_size, length], self.current_segment_id),
+                                dtype=tf.int64),
+            offsets=tf.cast(offsets, dtype=tf.int64))
+
+    def draft(self, initial_state, embedding, ids, lengths, num_tokens):
+        """Greedily continues every prefix in :attr:`ids` by
+        :attr:`num_tokens` tokens, e.g., as the draft to verify in
+        speculative decoding. The prefixes are read in one pass of the cell,
+        with the same inputs as decoding them with strategy
+        `"infer_positional"`, so that the draft of a prefix decoded by the
+        decoder is the continuation the decoder would decode.
+
+        The decoder must have been called before, which builds its cell and
+        output layer.
+
+        Args:
+            initial_state: The initial state of the cell.
+            embedding: A callable that returns embedding vectors of ids, or
+                the :attr:`params` argument of
+                :tf_main:`tf.nn.embedding_lookup <nn/embedding_lookup>`.
+            ids: An int Tensor of shape `[batch_size, max_time]`, the
+                prefixes, each starting with the start token.
+            lengths: An int Tensor of shape `[batch_size]`, the lengths of
+                the prefixes, at least 1.
+            num_tokens (int): The number of tokens to draft.
+
+        Returns:
+            An int32 Tensor of shape `[batch_size, num_tokens]`.
+        """
+        if callable(embedding):
+            embedding_fn = embedding
+        else:
+            embedding_fn = lambda ids: tf.nn.embedding_lookup(embedding, ids)
+
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            inputs = embedding_fn(ids)
+            batch_size = tf.shape(ids)[0]
+            max_time, channels = shape_list(inputs)[1:]
+            # the input at time `t > 0` is embedded with offset `t - 1`
+            positions = tf.tile(tf.expand_dims(tf.range(max_time), 0),
+                                tf.stack([batch_size, 1]))
+            pos_embeds = self._position_embeds(
+                max_time, channels, tf.maximum(positions - 1, 0))
+            inputs += pos_embeds * tf.expand_dims(
+                tf.to_float(positions > 0), -1)
+            cell_outputs, state = tf.nn.dynamic_rnn(
+                self._cell, inputs, sequence_length=lengths,
+                initial_state=initial_state)
+            cell_output = tf.gather_nd(
+                cell_outputs, tf.stack([tf.range(batch_size), lengths - 1], 1))
+
+            draft_ids = []
+            for idx in range(num_tokens):
+                sample_id = tf.argmax(self._output_layer(cell_output), -1,
+                                      output_type=tf.int32)
+                draft_ids.append(sample_id)
+                if idx + 1 < num_tokens:
+                    next_inputs = embedding_fn(sample_id) + tf.reshape(
+                        self._position_embeds(
+                            1, channels, tf.expand_dims(lengths + idx - 1, 1)),
+                        [batch_size, channels])
+                    cell_output, state = self._cell(next_inputs, state)
+            return tf.stack(draft_ids, axis=1)
+
 
 #TODO(zhiting): allow a list of Attention Mechanisms
 class AttentionRNNDecoder(RNNDecoderBase):
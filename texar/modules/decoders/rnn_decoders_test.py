@@ -13,9 +13,12 @@ import tensorflow as tf
 
 from texar.modules.decoders.rnn_decoders import BasicRNNDecoderOutput
 from texar.modules.decoders.rnn_decoders import BasicRNNDecoder
+from texar.modules.decoders.rnn_decoders import BasicPositionalRNNDecoder
 from texar.modules.decoders.rnn_decoders import AttentionRNNDecoderOutput
 from texar.modules.decoders.rnn_decoders import AttentionRNNDecoder
 from texar.modules.decoders.rnn_decoder_helpers import get_helper
+from texar.modules.embedders.position_embedders import \
+    SinusoidsSegmentalPositionEmbedder
 from texar import context
 
 # pylint: disable=no-member, too-many-locals, too-many-instance-attributes
@@ -201,6 +204,53 @@ class BasicRNNDecoderTest(tf.test.TestCase):
                              (self._batch_size, cell_dim))
 
 
+class BasicPositionalRNNDecoderTest(tf.test.TestCase):
+    """Tests
+    :class:`~texar.modules.decoders.rnn_decoders.BasicPositionalRNNDecoder`.
+    """
+
+    def setUp(self):
+        tf.test.TestCase.setUp(self)
+        self._vocab_size = 10
+        self._max_time = 8
+        self._batch_size = 4
+        self._emb_dim = 20
+        self._embedding = tf.random_uniform(
+            [self._vocab_size, self._emb_dim], maxval=1., dtype=tf.float32)
+
+    def test_draft(self):
+        """Tests that drafting after a prefix decoded by the decoder gives
+        the tokens it decodes next.
+        """
+        decoder = BasicPositionalRNNDecoder(
+            vocab_size=self._vocab_size,
+            position_embedder=SinusoidsSegmentalPositionEmbedder())
+        decoder.set_segment_id(1)
+        start_tokens = tf.fill([self._batch_size], 1)
+        outputs, _, _ = decoder(
+            decoding_strategy="infer_positional",
+            embedding=self._embedding,
+            start_tokens=start_tokens,
+            end_token=self._vocab_size,
+            max_decoding_length=self._max_time)
+        ids = tf.concat(
+            [tf.expand_dims(start_tokens, 1), outputs.sample_id], axis=1)
+        lengths = tf.constant([1, 2, 4, 5])
+        draft_ids = decoder.draft(
+            decoder.zero_state(self._batch_size, tf.float32), self._embedding,
+            ids, lengths, 3)
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            ids_, draft_ids_ = sess.run(
+                [ids, draft_ids],
+                feed_dict={context.global_mode():
+                           tf.estimator.ModeKeys.PREDICT})
+            for idx, length in enumerate([1, 2, 4, 5]):
+                np.testing.assert_array_equal(
+                    draft_ids_[idx], ids_[idx, length:length + 3])
+
+
 class AttentionRNNDecoderTest(tf.test.TestCase):
     """Tests :class:`~texar.modules.decoders.rnn_decoders.AttentionRNNDecoder`.
     """
@@ -8,6 +8,7 @@ from __future__ import print_function
 
 import tensorflow as tf
 from tensorflow.python.framework import tensor_shape, dtypes
+from tensorflow.python.ops import inplace_ops
 from tensorflow.python.util import nest
 
 from texar.core import layers, attentions
@@ -18,6 +19,7 @@ from texar.modules.decoders.transformer_decoders import TransformerDecoderOutput
 from texar.modules.embedders import embedder_utils
 from texar.modules.embedders import position_embedders
 from texar.utils import beam_search
+from texar.utils import transformer_utils
 from texar.utils import utils
 from texar.utils.shapes import shape_list
 
@@ -39,6 +41,15 @@ class TemplateTransformerDecoder(ModuleBase):
                     position_embedders.SinusoidsSegmentalPositionEmbedder( \
                     self._hparams.position_embedder.hparams)
 
+            # Built once here instead of in every call, so that calling the
+            # decoder repeatedly, e.g., in a loop over blanks, reuses the
+            # same networks.
+            self.poswise_networks = []
+            for i in range(self._hparams.num_blocks):
+                with tf.variable_scope('layer_{}'.format(i)):
+                    self.poswise_networks.append(FeedForwardNetwork( \
+                        hparams=self._hparams['poswise_feedforward']))
+
         if self._hparams.use_embedding:
             if embedding is None and vocab_size is None:
                 raise ValueError("""If 'embedding' is not provided,
@@ -58,10 +69,54 @@ class TemplateTransformerDecoder(ModuleBase):
                 self._vocab_size = self._embedding.get_shape().as_list()[0]
         self.output_layer = \
             self.build_output_layer(shape_list(self._embedding)[-1])
+        if self._hparams.non_autoregressive:
+            # predicts the length of a blank from the output at its <BOA>
+            with tf.variable_scope(self.variable_scope):
+                self._length_kernel = tf.get_variable(
+                    'length_kernel',
+                    [shape_list(self._embedding)[-1],
+                     self._hparams.maximum_decode_length])
+                self._length_bias = tf.get_variable(
+                    'length_bias', [self._hparams.maximum_decode_length],
+                    initializer=tf.zeros_initializer())
     @staticmethod
     def default_hparams():
         """default hyperrams for transformer deocder.
             sampling_method: argmax or sample. To choose the function transforming the logits to the sampled id in the next position when inferencing.
+            preallocate_decode_cache: whether greedy decoding writes the self
+                attention keys and values of each step in place into buffers
+                of `maximum_decode_length` steps, instead of concatenating
+                them, so that the decoding loop has static shapes.
+            compact_finished_every: if positive, every this many steps greedy
+                decoding gathers the rows that have not finished into a
+                smaller batch, together with their caches and position
+                signals, so that finished rows are not run through the
+                layers any more. The outputs are scattered back to the
+                original order, with `eos` after the end of every row.
+            non_autoregressive: whether to build the length predictor of
+                the blanks, so that the decoder can also be trained to fill
+                masked tokens of a blank at once (calling it with
+                `non_autoregressive=True`) and decode with :meth:`nat_decode`.
+            fused_attention: whether the attention layers project with fused
+                `qkv` and `kv` variables and keep head-major layouts, see
+                :func:`~texar.core.attentions.multihead_attention`.
+            recompute_grad: whether the activations of every layer are
+                computed again in the backward pass of training instead of
+                kept, see :func:`~texar.core.layers.recompute_grad`. The
+                dropout masks are then drawn from a seed per layer.
+            remove_padding: whether the position-wise feed-forward networks
+                skip the padded positions of the blanks in training, and the
+                templates given no `encoder_decoder_attention_bias` are
+                attended to except their padding.
+            pad_idx: the id padding the blanks and the templates.
+            template_attention_window: if positive, every blank attends
+                only to this many positions of the template around its own
+                mask, and to the masks of the other blanks and the first
+                token of every segment, which are gathered from the template
+                once, see :func:`~texar.core.attentions.gather_local_memory`.
+                The encoder-decoder attention then costs
+                `O(blank length * window)` instead of
+                `O(blank length * template length)`.
         """
         return {
             'sampling_method': 'argmax',
@@ -88,6 +143,14 @@ class TemplateTransformerDecoder(ModuleBase):
             'num_units':512,
             'eos_idx': 2,
             'bos_idx': 1,
+            'pad_idx': 0,
+            'preallocate_decode_cache': False,
+            'compact_finished_every': 0,
+            'non_autoregressive': False,
+            'fused_attention': False,
+            'recompute_grad': False,
+            'remove_padding': False,
+            'template_attention_window': 0,
         }
 
     def prepare_tokens_to_embeds(self, tokens):
@@ -95,9 +158,11 @@ class TemplateTransformerDecoder(ModuleBase):
         token_emb = tf.nn.embedding_lookup(self._embedding, tokens)
         return token_emb
 
-    def _symbols_to_logits_fn(self, embedding_fn, max_length, segment_ids, offsets):
+    def _symbols_to_logits_fn(self, embedding_fn, max_length, segment_ids, offsets,
+                              preallocated=False, compact=False):
         channels = shape_list(self._embedding)[-1]
-        timing_signal = self.position_embedder(max_length, channels, segment_ids, offsets)
+        if not compact:
+            timing_signal = self.position_embedder(max_length, channels, segment_ids, offsets)
 
         """ the function is normally called in dynamic decoding mode.
                 the ids should be `next_id` with the shape [batch_size, 1]
@@ -113,13 +178,23 @@ class TemplateTransformerDecoder(ModuleBase):
                 inputs *= self._embedding.shape.as_list()[-1]**0.5
             else:
                 assert NotImplementedError
-            inputs += timing_signal[:, step:step+1]
+            if compact:
+                # gathered together with the unfinished rows
+                signal = cache['timing_signal'][:, step:step+1]
+            else:
+                signal = timing_signal[:, step:step+1]
+            # in beam search, the signal of a batch element is shared by its
+            # beams, which are consecutive rows of the inputs
+            inputs = tf.reshape(
+                tf.reshape(inputs, [tf.shape(signal)[0], -1, channels]) + signal,
+                [-1, 1, channels])
 
             outputs = self._self_attention_stack(
                 inputs,
                 template_input=cache['memory'],
                 cache=cache,
                 decoder_self_attention_bias=decoder_self_attention_bias,
+                decode_step=step if preallocated else None,
             )
             logits = self.output_layer(outputs)
             logits = tf.squeeze(logits, axis=[1])
@@ -127,45 +202,130 @@ class TemplateTransformerDecoder(ModuleBase):
             return logits, cache
 
         return _impl
+    def _embed_inputs(self, ids, segment_ids, offsets):
+        """Embeds the tokens of the blanks together with their positions.
+        """
+        word_embeds = tf.nn.embedding_lookup(self._embedding, ids)
+        if self._hparams.multiply_embedding_mode == 'sqrt_depth':
+            word_embeds = word_embeds * \
+                (self._embedding.shape.as_list()[-1]**0.5)
+        length = shape_list(word_embeds)[1]
+        channels = shape_list(word_embeds)[2]
+        pos_embeds = self.position_embedder(length, channels,
+                                            segment_ids, offsets)
+        return word_embeds + pos_embeds
+
+    def _embed_template(self, template_input_pack):
+        """Embeds the templates, which are the memory of the decoder.
+        """
+        template = template_input_pack['templates']
+        template_word_embeds = tf.nn.embedding_lookup(self._embedding, template)
+        template_length = shape_list(template)[1]
+        channels = shape_list(template_word_embeds)[2]
+        template_pos_embeds = self.position_embedder(template_length, channels,
+                                                     template_input_pack['segment_ids'],
+                                                     template_input_pack['offsets'])
+        return template_word_embeds + template_pos_embeds
+
+    def _template_attention_bias(self, template_input_pack,
+                                 encoder_decoder_attention_bias):
+        """The attention bias ignoring the padding of the templates if
+        `remove_padding` and none is given.
+        """
+        if encoder_decoder_attention_bias is not None or \
+                not self._hparams.remove_padding:
+            return encoder_decoder_attention_bias
+        return attentions.attention_bias_ignore_padding(
+            tf.to_float(tf.equal(template_input_pack['templates'],
+                                 self._hparams.pad_idx)))
+
+    def _local_template(self, template_inputs, encoder_decoder_attention_bias,
+                        template_input_pack, blank_segment_ids=None,
+                        blank_num=None):
+        """The positions of the templates that the blanks of
+        `blank_segment_ids` attend to if `template_attention_window`, with
+        the template rows tiled `blank_num` times if given. Without
+        `blank_segment_ids`, the blank is the first mask of every template,
+        as in the templates updated blank by blank with
+        :func:`~texar.utils.transformer_utils.update_template_pack`, which
+        renumbers their segments.
+        """
+        width = self._hparams.template_attention_window
+        if width <= 0:
+            return template_inputs, encoder_decoder_attention_bias
+        segment_ids = tf.to_int32(template_input_pack['segment_ids'])
+        if blank_num is not None:
+            segment_ids = self._tile_blanks(segment_ids, blank_num)
+        # the window is centered at the mask of the blank
+        if blank_segment_ids is None:
+            is_blank = tf.equal(segment_ids % 2, 1)
+        else:
+            is_blank = tf.equal(
+                segment_ids,
+                tf.expand_dims(tf.to_int32(blank_segment_ids), 1))
+        starts = tf.to_int32(tf.argmax(tf.to_int32(is_blank), axis=1)) - \
+            width // 2
+        # the masks have odd segment ids
+        previous_segment_ids = tf.concat(
+            [tf.fill([tf.shape(segment_ids)[0], 1], -1),
+             segment_ids[:, :-1]], axis=1)
+        global_mask = tf.logical_or(
+            tf.equal(segment_ids % 2, 1),
+            tf.not_equal(segment_ids, previous_segment_ids))
+        return attentions.gather_local_memory(
+            template_inputs, encoder_decoder_attention_bias, starts, width,
+            global_mask)
+
     #pylint:disable=arguments-differ
     def _build(self, decoder_input_pack, template_input_pack,
-               encoder_decoder_attention_bias, args):
+               encoder_decoder_attention_bias, args, non_autoregressive=False):
         """
             this function is called on training generally.
             Args:
                 targets: [bath_size, target_length], generally begins with [bos] token
                 template_input: [batch_size, source_length, channels]
                 segment_ids: [batch_size, source_length], which segment this word belongs to
+                non_autoregressive: if `True`, `decoder_input_pack` holds the
+                    tokens of the blank after [bos], some of them masked, and
+                    their `lengths`. Every position attends to all the tokens
+                    of the blank, and is predicted at once.
             outputs:
                 logits: [batch_size, target_length, vocab_size]
                 preds: [batch_size, target_length]
         """
-        input = decoder_input_pack['text_ids'][:, :-1]
-        decoder_self_attention_bias = (
-            attentions.attention_bias_lower_triangle(
-                shape_list(input)[1]))
-        input_word_embeds = tf.nn.embedding_lookup(self._embedding, input)
-        if self._hparams.multiply_embedding_mode == 'sqrt_depth':
-            input_word_embeds = input_word_embeds * \
-                (self._embedding.shape.as_list()[-1]**0.5)
-        length = shape_list(input_word_embeds)[1]
-        channels = shape_list(input_word_embeds)[2]
-        input_pos_embeds = self.position_embedder(length, channels,
-                                                  decoder_input_pack['segment_ids'][:, :-1],
-                                                  decoder_input_pack['offsets'][:, :-1])
-        inputs = input_word_embeds + input_pos_embeds
+        if non_autoregressive:
+            input = decoder_input_pack['text_ids']
+            segment_ids = decoder_input_pack['segment_ids']
+            offsets = decoder_input_pack['offsets']
+            decoder_self_attention_bias = self._padding_bias(
+                decoder_input_pack['lengths'], shape_list(input)[1])
+        else:
+            input = decoder_input_pack['text_ids'][:, :-1]
+            segment_ids = decoder_input_pack['segment_ids'][:, :-1]
+            offsets = decoder_input_pack['offsets'][:, :-1]
+            decoder_self_attention_bias = (
+                attentions.attention_bias_lower_triangle(
+                    shape_list(input)[1]))
+        inputs = self._embed_inputs(input, segment_ids, offsets)
 
-        template = template_input_pack['templates']
-        template_word_embeds = tf.nn.embedding_lookup(self._embedding, template)
-        template_length = shape_list(template)[1]
-        template_pos_embeds = self.position_embedder(template_length, channels,
-                                                     template_input_pack['segment_ids'],
-                                                     template_input_pack['offsets'])
-        template_inputs = template_word_embeds + template_pos_embeds
+        template_inputs = self._embed_template(template_input_pack)
+        encoder_decoder_attention_bias = self._template_attention_bias(
+            template_input_pack, encoder_decoder_attention_bias)
+        # the blanks are trained one by one on the updated templates, or
+        # all on the original ones if non-autoregressive
+        template_inputs, encoder_decoder_attention_bias = self._local_template(
+            template_inputs, encoder_decoder_attention_bias,
+            template_input_pack,
+            segment_ids[:, 0] if non_autoregressive else None)
+        padding = None
+        if self._hparams.remove_padding:
+            padding = tf.to_float(tf.equal(input, self._hparams.pad_idx))
         self.decoder_output = self._self_attention_stack(
             inputs,
             template_inputs,
             decoder_self_attention_bias=decoder_self_attention_bias,
+            encoder_decoder_attention_bias=encoder_decoder_attention_bias,
+            padding=padding,
         )
 
         logits = self.output_layer(self.decoder_output)
@@ -177,21 +337,172 @@ class TemplateTransformerDecoder(ModuleBase):
 
         return logits, preds
 
+    @staticmethod
+    def _padding_bias(lengths, max_length):
+        """The self attention bias over the first `lengths` positions only.
+        """
+        return attentions.attention_bias_ignore_padding(
+            1. - tf.to_float(tf.sequence_mask(lengths, max_length)))
+
+    def _fold_blanks(self, template_input_pack,
+                     encoder_decoder_attention_bias, blank_num):
+        """Embeds the templates and tiles them and their attention bias
+        `blank_num` times, for the blanks folded into the batch dimension,
+        row `b * blank_num + i` attending to the template as the i-th blank.
+        Returns the template inputs, the attention bias and the batch size.
+        """
+        template_inputs = self._embed_template(template_input_pack)
+        encoder_decoder_attention_bias = self._template_attention_bias(
+            template_input_pack, encoder_decoder_attention_bias)
+        batch_size = tf.shape(template_inputs)[0]
+        template_inputs = self._tile_blanks(template_inputs, blank_num)
+        if encoder_decoder_attention_bias is not None:
+            encoder_decoder_attention_bias = self._tile_blanks(
+                encoder_decoder_attention_bias, blank_num)
+        template_inputs, encoder_decoder_attention_bias = \
+            self._local_template(
+                template_inputs, encoder_decoder_attention_bias,
+                template_input_pack,
+                self._blank_segment_ids(batch_size, blank_num, 1,
+                                        tf.int32)[:, 0],
+                blank_num)
+        return template_inputs, encoder_decoder_attention_bias, batch_size
+
+    @staticmethod
+    def _blank_segment_ids(batch_size, blank_num, length, dtype):
+        """The segment ids of the blanks folded into the batch, i.e., row
+        `b * blank_num + i` has segment id `2 * i + 1`.
+        """
+        return tf.tile(
+            tf.expand_dims(tf.range(1, 2 * blank_num, 2, dtype=dtype), 1),
+            tf.stack([batch_size, length]))
+
+    def _length_logits(self, template_inputs, encoder_decoder_attention_bias,
+                       blank_num, bos_id):
+        """Computes the length logits of the blanks folded into the batch,
+        from the decoder output at the [bos] of each blank.
+        """
+        num_rows = tf.shape(template_inputs)[0]
+        ids = tf.fill([num_rows, 1], bos_id)
+        segment_ids = self._blank_segment_ids(
+            num_rows // blank_num, blank_num, 1, tf.int64)
+        offsets = tf.zeros([num_rows, 1], dtype=tf.int64)
+        outputs = self._self_attention_stack(
+            self._embed_inputs(ids, segment_ids, offsets),
+            template_inputs,
+            decoder_self_attention_bias=tf.zeros([1, 1, 1, 1]),
+            encoder_decoder_attention_bias=encoder_decoder_attention_bias,
+        )
+        return tf.matmul(outputs[:, 0], self._length_kernel) + \
+            self._length_bias
+
+    def predict_lengths(self, template_input_pack,
+                        encoder_decoder_attention_bias, blank_num, bos_id):
+        """
+            predicts the number of tokens of every blank, to train the length
+            predictor of :meth:`nat_decode`.
+            outputs:
+                length_logits: [batch_size, blank_num, maximum_decode_length]
+        """
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            template_inputs, encoder_decoder_attention_bias, batch_size = \
+                self._fold_blanks(template_input_pack,
+                                  encoder_decoder_attention_bias, blank_num)
+            length_logits = self._length_logits(
+                template_inputs, encoder_decoder_attention_bias,
+                blank_num, bos_id)
+            return tf.reshape(
+                length_logits,
+                tf.stack([batch_size, blank_num,
+                          self._hparams.maximum_decode_length]))
+
+    def nat_decode(self, template_input_pack, encoder_decoder_attention_bias,
+                   blank_num, bos_id, eos_id, mask_id, iterations=4):
+        """
+            decodes all the blanks of the templates non-autoregressively, in
+            test mode, with mask-predict. The length of every blank is
+            predicted first, and all its tokens are masked. Then each of
+            the `iterations` passes of the decoder predicts the masked
+            tokens at once, and masks again the tokens of the lowest
+            probabilities, fewer every pass, to be predicted in the next
+            one. As in :meth:`parallel_decode`, the blanks are folded into
+            the batch dimension.
+            outputs:
+                sampled_ids: [batch_size, blank_num, maximum_decode_length],
+                    the tokens of each blank, followed by `eos_id`
+                log_probs: [batch_size, blank_num]
+        """
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            template_inputs, encoder_decoder_attention_bias, batch_size = \
+                self._fold_blanks(template_input_pack,
+                                  encoder_decoder_attention_bias, blank_num)
+            max_length = self._hparams.maximum_decode_length
+
+            lengths = tf.to_int32(tf.argmax(
+                self._length_logits(template_inputs,
+                                    encoder_decoder_attention_bias,
+                                    blank_num, bos_id),
+                axis=-1))
+            num_rows = tf.shape(lengths)[0]
+            segment_ids = self._blank_segment_ids(
+                batch_size, blank_num, max_length, tf.int64)
+            # the tokens follow [bos] at offset 0
+            offsets = tf.tile(
+                tf.expand_dims(tf.range(1, max_length + 1, dtype=tf.int64), 0),
+                tf.stack([num_rows, 1]))
+            # [eos] is given at the predicted length, and attended to
+            decoder_self_attention_bias = self._padding_bias(
+                lengths + 1, max_length)
+            tokens = tf.sequence_mask(lengths, max_length)
+            mask_ids = tf.fill([num_rows, max_length], mask_id)
+            ids = tf.where(tokens, mask_ids,
+                           tf.fill([num_rows, max_length], eos_id))
+            scores = tf.zeros([num_rows, max_length])
+
+            for it in range(iterations):
+                outputs = self._self_attention_stack(
+                    self._embed_inputs(ids, segment_ids, offsets),
+                    template_inputs,
+                    decoder_self_attention_bias=decoder_self_attention_bias,
+                    encoder_decoder_attention_bias=encoder_decoder_attention_bias,
+                )
+                log_probs = tf.nn.log_softmax(self.output_layer(outputs))
+                masked = tf.logical_and(tokens, tf.equal(ids, mask_id))
+                ids = tf.where(
+                    masked, tf.argmax(log_probs, axis=-1, output_type=tf.int32),
+                    ids)
+                scores = tf.where(
+                    masked, tf.reduce_max(log_probs, axis=-1), scores)
+                if it + 1 < iterations:
+                    num = lengths * (iterations - it - 1) // iterations
+                    ids = tf.where(
+                        transformer_utils.lowest_scores_mask(
+                            scores, lengths, num),
+                        mask_ids, ids)
+
+            predictions = {
+                'sampled_ids': tf.reshape(
+                    ids, tf.stack([batch_size, blank_num, max_length])),
+                'log_probs': tf.reshape(
+                    tf.reduce_sum(scores * tf.to_float(tokens), axis=-1),
+                    tf.stack([batch_size, blank_num])),
+            }
+            return predictions
+
     def dynamic_decode(self, template_input_pack, encoder_decoder_attention_bias,
                        segment_ids, offsets, bos_id, eos_id):
         """
             this function is called on in test mode, without the target input.
         """
         with tf.variable_scope(self.variable_scope, reuse=True):
-            template = template_input_pack['templates']
-            template_word_embeds = tf.nn.embedding_lookup(self._embedding, template)
-            batch_size = tf.shape(template)[0]
-            template_length = shape_list(template)[1]
-            channels = shape_list(template_word_embeds)[2]
-            template_pos_embeds = self.position_embedder(template_length, channels,
-                                                         template_input_pack['segment_ids'],
-                                                         template_input_pack['offsets'])
-            template_inputs = template_word_embeds + template_pos_embeds
+            template_inputs = self._embed_template(template_input_pack)
+            encoder_decoder_attention_bias = self._template_attention_bias(
+                template_input_pack, encoder_decoder_attention_bias)
+            template_inputs, encoder_decoder_attention_bias = \
+                self._local_template(
+                    template_inputs, encoder_decoder_attention_bias,
+                    template_input_pack, segment_ids[:, 0])
+            batch_size = tf.shape(template_inputs)[0]
 
             # batch_size = tf.shape(template_inputs)[0]
             beam_width = self._hparams.beam_width
@@ -228,14 +539,190 @@ class TemplateTransformerDecoder(ModuleBase):
             }
         return predictions
 
+    def parallel_decode(self, template_input_pack, encoder_decoder_attention_bias,
+                        blank_num, offsets, bos_id, eos_id):
+        """
+            decodes all the blanks of the templates at once, in test mode.
+            The blanks are folded into the batch dimension, so that row
+            `b * blank_num + i` decodes the i-th blank of the b-th template,
+            with segment id `2 * i + 1` as that blank has in the template.
+            Every blank is conditioned on the original template, i.e., not
+            on the predictions of the other blanks.
+            Args:
+                offsets: [batch_size, maximum_decode_length + 1]
+            outputs:
+                sampled_ids: [batch_size, blank_num, decoded_length], the best
+                    hypothesis of each blank
+                log_probs: [batch_size, blank_num]
+        """
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            template_inputs, encoder_decoder_attention_bias, batch_size = \
+                self._fold_blanks(template_input_pack,
+                                  encoder_decoder_attention_bias, blank_num)
+            offsets = self._tile_blanks(offsets, blank_num)
+            segment_ids = self._blank_segment_ids(
+                batch_size, blank_num, tf.shape(offsets)[1], offsets.dtype)
+
+            beam_width = self._hparams.beam_width
+            maximum_decode_length = self.hparams.maximum_decode_length
+            start_tokens = tf.cast(tf.fill([batch_size * blank_num], bos_id), dtype=tf.int32)
+            if beam_width <= 1:
+                sampled_ids, log_probs = self.greedy_decode(
+                    self.prepare_tokens_to_embeds,
+                    start_tokens,
+                    eos_id,
+                    decode_length=maximum_decode_length,
+                    memory=template_inputs,
+                    encoder_decoder_attention_bias=\
+                        encoder_decoder_attention_bias,
+                    segment_ids=segment_ids,
+                    offsets=offsets,
+                )
+            else:
+                sampled_ids, log_probs = self.beam_decode(
+                    self.prepare_tokens_to_embeds,
+                    start_tokens,
+                    eos_id,
+                    beam_width=beam_width,
+                    decode_length=maximum_decode_length,
+                    memory=template_inputs,
+                    encoder_decoder_attention_bias=\
+                        encoder_decoder_attention_bias,
+                    segment_ids=segment_ids,
+                    offsets=offsets
+                )
+            predictions = {
+                'sampled_ids': tf.reshape(sampled_ids[:, 0],
+                                          tf.stack([batch_size, blank_num, -1])),
+                'log_probs': tf.reshape(log_probs[:, 0], tf.stack([batch_size, blank_num]))
+            }
+        return predictions
+
+    def speculative_decode(self, template_input_pack, encoder_decoder_attention_bias,
+                           segment_ids, offsets, bos_id, eos_id, draft_fn,
+                           num_draft_tokens):
+        """
+            decodes greedily in test mode, verifying tokens drafted by a
+            cheaper model instead of running the decoder once per token.
+            Every round, `draft_fn` continues the decoded prefixes by
+            `num_draft_tokens` tokens, and a single teacher-forced pass of
+            the decoder over the prefixes and drafts predicts the token
+            following each of them. The longest prefix of a draft agreeing
+            with the predictions is accepted, followed by the prediction
+            after it, i.e., the correction of the first mismatch. The
+            outputs are thus those of greedy decoding, at up to
+            `num_draft_tokens + 1` tokens per pass of the decoder.
+            Args:
+                segment_ids: [batch_size,
+                    maximum_decode_length + num_draft_tokens + 1]
+                offsets: [batch_size,
+                    maximum_decode_length + num_draft_tokens + 1]
+                draft_fn: a callable taking `(ids, lengths, num_tokens)`,
+                    i.e., the prefixes decoded so far, starting with
+                    `bos_id`, and their lengths, and returning the drafts
+                    of shape [batch_size, num_tokens]
+            outputs:
+                sampled_ids: [batch_size, 1, maximum_decode_length], followed
+                    by `eos_id` after the end of each row
+                log_probs: [batch_size, 1], up to the end of each row
+        """
+        with tf.variable_scope(self.variable_scope, reuse=True):
+            template_inputs = self._embed_template(template_input_pack)
+            encoder_decoder_attention_bias = self._template_attention_bias(
+                template_input_pack, encoder_decoder_attention_bias)
+            template_inputs, encoder_decoder_attention_bias = \
+                self._local_template(
+                    template_inputs, encoder_decoder_attention_bias,
+                    template_input_pack, segment_ids[:, 0])
+            batch_size = tf.shape(template_inputs)[0]
+            maximum_decode_length = self._hparams.maximum_decode_length
+            max_length = maximum_decode_length + num_draft_tokens + 1
+            decoder_self_attention_bias = (
+                attentions.attention_bias_lower_triangle(max_length))
+            positions = tf.expand_dims(tf.range(max_length), 0)
+
+            def _gather_after(tensor, lengths, num):
+                # tensor[b, lengths[b] + j] for j < num
+                indices = tf.expand_dims(lengths, 1) + tf.range(num)
+                batch_indices = tf.tile(
+                    tf.expand_dims(tf.range(batch_size), 1), [1, num])
+                return tf.gather_nd(tensor,
+                                    tf.stack([batch_indices, indices], -1))
+
+            def _scatter_after(ids, lengths, values, num):
+                # writes values[b, j] to ids[b, lengths[b] + j] for j < num[b]
+                rel = positions - tf.expand_dims(lengths, 1)
+                written = tf.reduce_sum(
+                    tf.one_hot(rel, shape_list(values)[1], dtype=ids.dtype) *
+                    tf.expand_dims(values, 1), -1)
+                return tf.where(
+                    tf.logical_and(rel >= 0, rel < tf.expand_dims(num, 1)),
+                    written, ids)
+
+            def _body(ids, lengths, finished, log_prob):
+                draft_ids = draft_fn(ids, lengths, num_draft_tokens)
+                inputs = _scatter_after(
+                    ids, lengths, draft_ids,
+                    tf.fill([batch_size], num_draft_tokens))
+                outputs = self._self_attention_stack(
+                    self._embed_inputs(inputs, segment_ids, offsets),
+                    template_inputs,
+                    decoder_self_attention_bias=decoder_self_attention_bias,
+                    encoder_decoder_attention_bias=encoder_decoder_attention_bias,
+                )
+                log_probs = tf.nn.log_softmax(self.output_layer(outputs))
+                # the predictions after the prefix and after each draft token
+                step_log_probs = _gather_after(
+                    log_probs, lengths - 1, num_draft_tokens + 1)
+                pred_ids = tf.argmax(step_log_probs, -1, output_type=tf.int32)
+                agreed = tf.cumprod(
+                    tf.to_int32(tf.equal(draft_ids, pred_ids[:, :-1])), axis=1)
+                num = tf.reduce_sum(agreed, axis=1) + 1
+                # no token is accepted after `eos`, or beyond the maximum length
+                before_eos = tf.reduce_sum(tf.cumprod(
+                    tf.to_int32(tf.not_equal(pred_ids, eos_id)), axis=1), axis=1)
+                num = tf.minimum(num, before_eos + 1)
+                num = tf.minimum(num, maximum_decode_length + 1 - lengths)
+                num *= 1 - tf.to_int32(finished)
+
+                ids = _scatter_after(ids, lengths, pred_ids, num)
+                accepted = tf.sequence_mask(num, num_draft_tokens + 1)
+                log_prob += tf.reduce_sum(
+                    tf.reduce_max(step_log_probs, -1) * tf.to_float(accepted),
+                    axis=1)
+                finished |= tf.logical_or(
+                    before_eos < num, lengths + num > maximum_decode_length)
+                return ids, lengths + num, finished, log_prob
+
+            ids = tf.concat([tf.fill([batch_size, 1], bos_id),
+                             tf.fill([batch_size, max_length - 1], eos_id)], 1)
+            ids, _, _, log_prob = tf.while_loop(
+                lambda ids, lengths, finished, log_prob: \
+                    tf.logical_not(tf.reduce_all(finished)),
+                _body,
+                loop_vars=(ids, tf.ones([batch_size], dtype=tf.int32),
+                           tf.fill([batch_size], False),
+                           tf.zeros([batch_size])))
+            predictions = {
+                'sampled_ids': tf.expand_dims(
+                    ids[:, 1:maximum_decode_length + 1], 1),
+                'log_probs': tf.expand_dims(log_prob, 1),
+            }
+        return predictions
+
     def _self_attention_stack(self,
                               inputs,
                               template_input,
                               decoder_self_attention_bias=None,
                               encoder_decoder_attention_bias=None,
-                              cache=None):
+                              cache=None,
+                              decode_step=None,
+                              padding=None):
         """
             stacked multihead attention module.
+            padding: [batch_size, length], ones at the padded positions of
+                the inputs, which the position-wise feed-forward networks
+                skip.
         """
         inputs = tf.layers.dropout(inputs,
                                    rate=self._hparams.embedding_dropout,
@@ -246,54 +733,101 @@ class TemplateTransformerDecoder(ModuleBase):
         else:
             assert decoder_self_attention_bias is not None
 
+        pad_remover = None
+        if padding is not None:
+            pad_remover = transformer_utils.PadRemover(padding)
         x = inputs
         for i in range(self._hparams.num_blocks):
             layer_name = 'layer_{}'.format(i)
             layer_cache = cache[layer_name] if cache is not None else None
             with tf.variable_scope(layer_name):
-                with tf.variable_scope("self_attention"):
-                    selfatt_output = attentions.multihead_attention(
-                        queries=layers.layer_normalize(x),
-                        memory=None,
-                        memory_attention_bias=decoder_self_attention_bias,
-                        num_units=self._hparams.num_units,
-                        num_heads=self._hparams.num_heads,
-                        dropout_rate=self._hparams.attention_dropout,
-                        cache=layer_cache,
-                        scope="multihead_attention",
-                    )
-                    x = x + tf.layers.dropout(
-                        selfatt_output,
-                        rate=self._hparams.residual_dropout,
-                        training=context.global_mode_train()
-                    )
-                if template_input is not None:
-                    with tf.variable_scope('encdec_attention'):
-                        encdec_output = attentions.multihead_attention(
-                            queries=layers.layer_normalize(x),
-                            memory=template_input,
-                            memory_attention_bias=encoder_decoder_attention_bias,
-                            num_units=self._hparams.num_units,
-                            num_heads=self._hparams.num_heads,
-                            dropout_rate=self._hparams.attention_dropout,
-                            scope="multihead_attention"
-                        )
-                        x = x + tf.layers.dropout(encdec_output, \
-                            rate=self._hparams.residual_dropout, \
-                            training=context.global_mode_train()
-                        )
-                poswise_network = FeedForwardNetwork( \
-                    hparams=self._hparams['poswise_feedforward'])
-                with tf.variable_scope(poswise_network.variable_scope):
-                    sub_output = tf.layers.dropout(
-                        poswise_network(layers.layer_normalize(x)),
-                        rate=self._hparams.residual_dropout,
-                        training=context.global_mode_train()
-                    )
-                    x = x + sub_output
+                if self._hparams.recompute_grad and cache is None:
+                    # dropout masks from a seed, to be the same when the
+                    # layer is computed again in the backward pass
+                    seed = tf.random_uniform(
+                        [2], maxval=tf.int64.max, dtype=tf.int64)
+                    def _layer(x, template_input=None, i=i, seed=seed):
+                        return self._layer(
+                            i, x, template_input, decoder_self_attention_bias,
+                            encoder_decoder_attention_bias,
+                            pad_remover=pad_remover,
+                            dropout_fn=layers.seeded_dropout(seed))
+                    x = layers.recompute_grad(
+                        _layer, [x] if template_input is None \
+                            else [x, template_input])
+                else:
+                    x = self._layer(
+                        i, x, template_input, decoder_self_attention_bias,
+                        encoder_decoder_attention_bias, layer_cache,
+                        decode_step, pad_remover)
 
         return layers.layer_normalize(x)
 
+    def _layer(self, i, x, template_input, decoder_self_attention_bias,
+               encoder_decoder_attention_bias, layer_cache=None,
+               decode_step=None, pad_remover=None, dropout_fn=None):
+        """The `i`-th layer of the stack, in its variable scope.
+        `pad_remover`, if given, removes the padding before the
+        position-wise feed-forward network, and `dropout_fn` applies all the
+        dropout of the layer.
+        """
+        if dropout_fn is None:
+            def _dropout(inputs, rate):
+                return tf.layers.dropout(inputs, rate=rate,
+                                         training=context.global_mode_train())
+        else:
+            _dropout = dropout_fn
+        with tf.variable_scope("self_attention"):
+            selfatt_output = attentions.multihead_attention(
+                queries=layers.layer_normalize(x),
+                memory=None,
+                memory_attention_bias=decoder_self_attention_bias,
+                num_units=self._hparams.num_units,
+                num_heads=self._hparams.num_heads,
+                dropout_rate=self._hparams.attention_dropout,
+                cache=layer_cache,
+                scope="multihead_attention",
+                decode_step=decode_step,
+                fused=self._hparams.fused_attention,
+                dropout_fn=dropout_fn,
+            )
+            x = x + _dropout(selfatt_output, self._hparams.residual_dropout)
+        if template_input is not None:
+            with tf.variable_scope('encdec_attention'):
+                encdec_output = attentions.multihead_attention(
+                    queries=layers.layer_normalize(x),
+                    memory=template_input,
+                    memory_attention_bias=encoder_decoder_attention_bias,
+                    num_units=self._hparams.num_units,
+                    num_heads=self._hparams.num_heads,
+                    dropout_rate=self._hparams.attention_dropout,
+                    cache=layer_cache,
+                    scope="multihead_attention",
+                    fused=self._hparams.fused_attention,
+                    dropout_fn=dropout_fn,
+                )
+                x = x + _dropout(encdec_output,
+                                 self._hparams.residual_dropout)
+        poswise_network = self.poswise_networks[i]
+        # a scope entered by object does not inherit the reuse of the
+        # enclosing one, e.g., in a later call of the module
+        with tf.variable_scope(poswise_network.variable_scope,
+                               reuse=tf.get_variable_scope().reuse):
+            y = layers.layer_normalize(x)
+            if pad_remover is not None:
+                original_shape = shape_list(y)
+                y = tf.reshape(y, [-1, self._hparams.num_units])
+                #[1, number of tokens, hidden_dim]
+                y = tf.expand_dims(pad_remover.remove(y), axis=0)
+            sub_output = _dropout(
+                poswise_network(y, dropout_fn=dropout_fn),
+                self._hparams.residual_dropout)
+            if pad_remover is not None:
+                sub_output = tf.reshape(pad_remover.restore(tf.squeeze(
+                    sub_output, axis=0)), original_shape)
+            x = x + sub_output
+        return x
+
     def build_output_layer(self, num_units):
         if self._hparams.share_embed_and_transform:
             if self._hparams.transform_with_bias:
@@ -302,6 +836,7 @@ class TemplateTransformerDecoder(ModuleBase):
                         [self._vocab_size])
             else:
                 affine_bias = None
+            self._affine_bias = affine_bias
             def outputs_to_logits(outputs):
                 shape = shape_list(outputs)
                 outputs = tf.reshape(outputs, [-1, num_units])
@@ -317,6 +852,24 @@ class TemplateTransformerDecoder(ModuleBase):
             layer.build([None, num_units])
             return layer
 
+    def chunked_loss(self, outputs, labels, loss_fn, chunk_size):
+        """Projects the decoder `outputs` (e.g., `self.decoder_output` after
+        calling the decoder) to the vocabulary and computes `loss_fn` of
+        `labels` `chunk_size` positions at a time, see
+        :func:`~texar.utils.transformer_utils.chunked_projection_loss`.
+        The logits returned by the call are then not needed for training.
+
+        Returns:
+            the loss, `[batch_size, length]`.
+        """
+        if self._hparams.share_embed_and_transform:
+            kernel, bias = self._embedding, self._affine_bias
+        else:
+            kernel = tf.transpose(self.output_layer.kernel)
+            bias = self.output_layer.bias
+        return transformer_utils.chunked_projection_loss(
+            outputs, labels, kernel, bias, loss_fn, chunk_size)
+
     @property
     def output_size(self):
         """
@@ -336,22 +889,84 @@ class TemplateTransformerDecoder(ModuleBase):
         return TransformerDecoderOutput(
             output_logits=dtypes.float32, sample_id=dtypes.int32)
 
-    def _init_cache(self, memory, encoder_decoder_attention_bias):
+    def _init_cache(self, memory, encoder_decoder_attention_bias,
+                    decode_length=None):
         cache = {'memory': memory}
         if encoder_decoder_attention_bias is not None:
             cache['encoder_decoder_attention_bias'] = \
                 encoder_decoder_attention_bias
         batch_size = tf.shape(memory)[0]
         depth = memory.get_shape().as_list()[-1]
+        if self._hparams.fused_attention:
+            # head-major, see `attentions.multihead_attention`
+            num_heads = self._hparams.num_heads
+            self_shape = [batch_size, num_heads, 0,
+                          self._hparams.num_units // num_heads]
+        else:
+            num_heads = None
+            self_shape = [batch_size, 0, depth]
         for l in range(self._hparams.num_blocks):
+            # the memory is projected once here instead of in every step
+            with tf.variable_scope('layer_{}/encdec_attention'.format(l)):
+                memory_keys, memory_values = attentions.memory_keys_values(
+                    memory, self._hparams.num_units, num_heads=num_heads)
+            if decode_length is None:
+                self_keys = tf.zeros(self_shape)
+                self_values = tf.zeros(self_shape)
+            else:
+                # preallocated, see `attentions.multihead_attention`. The
+                # buffers are written in place, so they must not be constants
+                # that would be reused across runs.
+                self_shape = [decode_length, batch_size, self._hparams.num_units]
+                self_keys = inplace_ops.empty(self_shape, tf.float32, init=True)
+                self_values = inplace_ops.empty(self_shape, tf.float32, init=True)
             cache['layer_{}'.format(l)] = {
-                'self_keys': tf.zeros([batch_size, 0, depth]),
-                'self_values': tf.zeros([batch_size, 0, depth]),
-                'memory_keys': tf.zeros([batch_size, 0, depth]),
-                'memory_values': tf.zeros([batch_size, 0, depth]),
+                'self_keys': self_keys,
+                'self_values': self_values,
+                'memory_keys': memory_keys,
+                'memory_values': memory_values,
             }
         return cache
 
+    def _gather_rows(self, cache, indices, preallocated):
+        """
+        :param cache: the decoding cache, with tensors of [batch_size, ...],
+            except the preallocated self attention buffers of
+            [decode_length, batch_size, num_units]
+        :param indices: [new_batch_size], the rows to keep
+        :return: the cache of the kept rows
+        """
+        rst = {}
+        for key, value in cache.items():
+            if isinstance(value, dict):
+                rst[key] = self._gather_rows(value, indices, preallocated)
+            elif preallocated and key in ('self_keys', 'self_values'):
+                rst[key] = tf.gather(value, indices, axis=1)
+            else:
+                rst[key] = tf.gather(value, indices)
+        return rst
+
+    def _compact_shape_invariants(self, cache, preallocated):
+        """
+        the shape invariants of the cache when its rows are gathered by
+        :meth:`_gather_rows` during decoding.
+        """
+        rst = {}
+        for key, value in cache.items():
+            if isinstance(value, dict):
+                rst[key] = self._compact_shape_invariants(value, preallocated)
+                continue
+            shape = value.shape.as_list()
+            if preallocated and key in ('self_keys', 'self_values'):
+                shape[1] = None
+            else:
+                shape[0] = None
+                if key in ('self_keys', 'self_values'):
+                    # the time dimension, after the heads if head-major
+                    shape[-2] = None
+            rst[key] = tf.TensorShape(shape)
+        return rst
+
     def greedy_decode(self,
                       embedding_fn,
                       start_tokens,
@@ -364,17 +979,38 @@ class TemplateTransformerDecoder(ModuleBase):
         batch_size = tf.shape(start_tokens)[0]
         finished = tf.fill([batch_size], False)
         step = tf.constant(0)
-        decoded_ids = tf.zeros([batch_size, 0], dtype=tf.int32)
+        preallocated = self._hparams.preallocate_decode_cache
+        if preallocated:
+            decoded_ids = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+        else:
+            decoded_ids = tf.zeros([batch_size, 0], dtype=tf.int32)
         next_id = tf.expand_dims(start_tokens, 1)
         print('next id:{}'.format(next_id.shape))
         log_prob = tf.zeros([batch_size], dtype=tf.float32)
 
-        cache = self._init_cache(memory, encoder_decoder_attention_bias)
+        compact_every = self._hparams.compact_finished_every
+        compact = compact_every > 0
+        # the original rows of the rows being decoded
+        alive_idx = tf.range(batch_size)
+
+        cache = self._init_cache(memory, encoder_decoder_attention_bias,
+            decode_length=decode_length if preallocated else None)
+        if compact:
+            cache['timing_signal'] = self.position_embedder(
+                decode_length+1, shape_list(self._embedding)[-1],
+                segment_ids, offsets)
         symbols_to_logits_fn = self._symbols_to_logits_fn(embedding_fn,
-            max_length=decode_length+1, segment_ids=segment_ids,
-            offsets=offsets)
+            preallocated=preallocated, max_length=decode_length+1, segment_ids=segment_ids,
+            offsets=offsets, compact=compact)
+
+        def _compact(finished, next_id, cache, alive_idx):
+            alive = tf.to_int32(tf.where(tf.logical_not(finished))[:, 0])
+            return (tf.gather(finished, alive),
+                    tf.gather(next_id, alive),
+                    self._gather_rows(cache, alive, preallocated),
+                    tf.gather(alive_idx, alive))
 
-        def _body(step, finished, next_id, decoded_ids, cache, log_prob):
+        def _body(step, finished, next_id, decoded_ids, cache, log_prob, alive_idx):
 
             logits, cache = symbols_to_logits_fn(next_id, step, cache)
             log_probs = logits - \
@@ -386,46 +1022,86 @@ class TemplateTransformerDecoder(ModuleBase):
                 next_id = tf.argmax(logits, -1, output_type=tf.int32)
             elif self.sampling_method == 'sample':
                 next_id = tf.multinomial(logits, 1).squeeze(axis=1)
-            finished |= tf.equal(next_id, EOS)
+            if compact:
+                # rows finished since the last compaction stay finished
+                next_id = tf.where(
+                    finished, tf.fill(tf.shape(next_id), EOS), next_id)
             log_prob_indices = tf.stack(
-                [tf.range(tf.to_int32(batch_size)), next_id], axis=1)
-            log_prob += tf.gather_nd(log_probs, log_prob_indices)
+                [tf.range(tf.shape(next_id)[0]), next_id], axis=1)
+            step_log_prob = tf.gather_nd(log_probs, log_prob_indices)
+            # the rows are scored up to their `EOS`, whether they are
+            # compacted or not
+            step_log_prob *= 1. - tf.to_float(finished)
+            if compact:
+                indices = tf.expand_dims(alive_idx, 1)
+                log_prob += tf.scatter_nd(indices, step_log_prob, [batch_size])
+                # the removed rows are filled with `EOS`
+                step_ids = tf.scatter_nd(indices, next_id - EOS, [batch_size]) + EOS
+            else:
+                log_prob += step_log_prob
+                step_ids = next_id
+            finished |= tf.equal(next_id, EOS)
 
+            if preallocated:
+                decoded_ids = decoded_ids.write(step, step_ids)
             next_id = tf.expand_dims(next_id, axis=1)
             #keep the shape as [batch_size, seq_len]
 
-            decoded_ids = tf.concat([decoded_ids, next_id], axis=1)
-            return step+1, finished, next_id, decoded_ids, cache, log_prob
+            if not preallocated:
+                decoded_ids = tf.concat(
+                    [decoded_ids, tf.expand_dims(step_ids, axis=1)], axis=1)
+            if compact:
+                finished, next_id, cache, alive_idx = tf.cond(
+                    tf.equal((step + 1) % compact_every, 0) & \
+                        tf.reduce_any(finished),
+                    lambda: _compact(finished, next_id, cache, alive_idx),
+                    lambda: (finished, next_id, cache, alive_idx))
+            return step+1, finished, next_id, decoded_ids, cache, log_prob, alive_idx
 
         def is_not_finished(i, finished, *_):
             return (i < decode_length) & tf.logical_not(tf.reduce_all(finished))
 
-        _, _, _, decoded_ids, _, log_prob = tf.while_loop(
+        if compact:
+            cache_shape_invariants = self._compact_shape_invariants(cache, preallocated)
+        elif preallocated:
+            cache_shape_invariants = nest.map_structure(lambda t: t.shape, cache)
+        else:
+            cache_shape_invariants = nest.map_structure(
+                beam_search.get_state_shape_invariants, cache)
+
+        _, _, _, decoded_ids, _, log_prob, _ = tf.while_loop(
             is_not_finished,
             _body,
-            loop_vars=(step, finished, next_id, decoded_ids, cache, log_prob),
+            loop_vars=(step, finished, next_id, decoded_ids, cache, log_prob,
+                       alive_idx),
             shape_invariants=(
                 tf.TensorShape([]),
                 tf.TensorShape([None]),
                 tf.TensorShape([None, None]),
-                tf.TensorShape([None, None]),
-                nest.map_structure(beam_search.get_state_shape_invariants, cache),
+                tf.TensorShape(None) if preallocated else tf.TensorShape([None, None]),
+                cache_shape_invariants,
+                tf.TensorShape([None]),
                 tf.TensorShape([None]),
             ))
+        if preallocated:
+            decoded_ids = tf.transpose(decoded_ids.stack(), [1, 0])
 
         outputs = tf.expand_dims(decoded_ids, 1)
         log_prob = tf.expand_dims(log_prob, 1)
         return (outputs, log_prob)
 
-    def _expand_to_beam_width(self, tensor, beam_width):
+    def _tile_blanks(self, tensor, blank_num):
         """
-        :param tensor: [batch_size, max_len]
-        :param beam_width:
-        :return: [batch_size*beam_width, max_len]
+        :param tensor: [batch_size, ...]
+        :param blank_num:
+        :return: [batch_size*blank_num, ...], each row repeated blank_num times
         """
-        batch_size = shape_list(tensor)[0]
-        expanded = tf.tile(tf.expand_dims(tensor, axis=1), [1, beam_width, 1])
-        return tf.reshape(expanded, [batch_size * beam_width, -1])
+        shape = tf.shape(tensor)
+        multiples = [1, blank_num] + [1] * (tensor.shape.ndims - 1)
+        tiled = tf.tile(tf.expand_dims(tensor, axis=1), multiples)
+        tiled = tf.reshape(tiled, tf.concat([[shape[0] * blank_num], shape[1:]], 0))
+        tiled.set_shape(tf.TensorShape([None]).concatenate(tensor.shape[1:]))
+        return tiled
 
     def beam_decode(self,
                     embedding_fn,
@@ -438,10 +1114,12 @@ class TemplateTransformerDecoder(ModuleBase):
                     decode_length=256,
                     beam_width=5,):
         cache = self._init_cache(memory, encoder_decoder_attention_bias)
+        # the template memory, its keys and values, and the position signals
+        # are kept per batch element, and shared by its beams
         symbols_to_logits_fn = self._symbols_to_logits_fn(embedding_fn,
             max_length=decode_length+1,
-            segment_ids=self._expand_to_beam_width(segment_ids, beam_width),
-            offsets=self._expand_to_beam_width(offsets, beam_width))
+            segment_ids=segment_ids,
+            offsets=offsets)
         outputs, log_probs = beam_search.beam_search(
             symbols_to_logits_fn,
             start_tokens,
@@ -450,7 +1128,10 @@ class TemplateTransformerDecoder(ModuleBase):
             self._vocab_size,
             self._hparams.alpha,
             states=cache,
-            eos_id=EOS)
+            eos_id=EOS,
+            beam_invariant_keys=('memory', 'encoder_decoder_attention_bias',
+                                 'memory_keys', 'memory_values'),
+            two_stage_topk=True)
 
         outputs = outputs[:, :, 1:]  # ignore <BOS>
         return (outputs, log_probs)
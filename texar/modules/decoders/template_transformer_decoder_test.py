@@ -0,0 +1,432 @@
+"""
+Unit tests for the template transformer decoder.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+import tensorflow as tf
+
+from texar.modules.decoders.template_transformer_decoder import \
+    TemplateTransformerDecoder
+from texar.core import attentions
+from texar import context
+
+# pylint: disable=no-member, too-many-locals, too-many-instance-attributes
+# pylint: disable=too-many-arguments, protected-access
+
+
+class TemplateTransformerDecoderTest(tf.test.TestCase):
+    """Tests :class:`~texar.modules.decoders.template_transformer_decoder.
+    TemplateTransformerDecoder`.
+    """
+
+    def setUp(self):
+        tf.test.TestCase.setUp(self)
+        self._vocab_size = 12
+        self._batch_size = 6
+        self._max_decode_length = 6
+        self._emb_dim = 16
+        self._bos_id = 1
+        self._mask_id = 3
+        rng = np.random.RandomState(0)
+        # initialized as in the example
+        self._embedding = tf.constant(
+            self._emb_dim**-0.5 *
+            rng.randn(self._vocab_size, self._emb_dim).astype(np.float32))
+        self._hparams = {
+            'num_blocks': 2,
+            'num_heads': 2,
+            'num_units': self._emb_dim,
+            'maximum_decode_length': self._max_decode_length,
+            # a separate output layer, so that the untrained decoder does
+            # not just repeat its inputs
+            'share_embed_and_transform': False,
+            'position_embedder': {
+                'name': 'sinusoids',
+                'hparams': None,
+            },
+            'poswise_feedforward': {
+                'name': 'ffn',
+                'layers': [
+                    {
+                        'type': 'Dense',
+                        'kwargs': {
+                            'name': 'conv1',
+                            'units': self._emb_dim * 2,
+                            'activation': 'relu',
+                        }
+                    },
+                    {
+                        'type': 'Dense',
+                        'kwargs': {
+                            'name': 'conv2',
+                            'units': self._emb_dim,
+                        }
+                    }
+                ],
+            },
+        }
+        # two blanks, with segment ids 1 and 3
+        template_segment_ids = [0, 0, 1, 2, 2, 2, 3, 4, 4]
+        templates = rng.randint(4, self._vocab_size,
+                                size=[self._batch_size, 9])
+        templates[:, [2, 6]] = self._mask_id
+        self._template_pack = {
+            'templates': tf.constant(templates, dtype=tf.int64),
+            'segment_ids': tf.constant(
+                [template_segment_ids] * self._batch_size, dtype=tf.int64),
+            'offsets': tf.constant(
+                [[0, 1, 0, 0, 1, 2, 0, 0, 1]] * self._batch_size,
+                dtype=tf.int64),
+        }
+
+    def _decoder(self, **hparams):
+        """Creates a decoder and its variables by calling it in training.
+        """
+        decoder_hparams = dict(self._hparams, **hparams)
+        decoder = TemplateTransformerDecoder(embedding=self._embedding,
+                                             hparams=decoder_hparams)
+        length = 4
+        decoder(decoder_input_pack={
+                    'text_ids': tf.ones([self._batch_size, length],
+                                        dtype=tf.int64),
+                    'segment_ids': tf.ones([self._batch_size, length],
+                                           dtype=tf.int64),
+                    'offsets': tf.tile(
+                        tf.expand_dims(tf.range(length, dtype=tf.int64), 0),
+                        [self._batch_size, 1])},
+                template_input_pack=self._template_pack,
+                encoder_decoder_attention_bias=None,
+                args=None)
+        return decoder
+
+    def _positions(self, length, segment_id=1):
+        """The segment ids and offsets of decoding a blank. Every row starts
+        from another offset, so that the untrained decoder decodes
+        different rows.
+        """
+        segment_ids = tf.fill([self._batch_size, length],
+                              tf.constant(segment_id, dtype=tf.int64))
+        offsets = tf.expand_dims(tf.range(length, dtype=tf.int64), 0) + \
+            tf.expand_dims(5 * tf.range(self._batch_size, dtype=tf.int64), 1)
+        return segment_ids, offsets
+
+    def _eos_id(self, sampled_ids):
+        """Returns an id that the rows of `sampled_ids`, decoded without
+        `eos`, emit first at different steps, or not at all. Decoding again
+        with it as `eos` then has rows finishing at different steps and
+        rows reaching `maximum_decode_length`.
+        """
+        def _end_steps(token):
+            return [list(row).index(token) if token in row else len(row)
+                    for row in sampled_ids]
+        def _score(token):
+            steps = _end_steps(token)
+            return (len(set(steps)), max(steps) == sampled_ids.shape[1])
+        eos_id = max(range(self._bos_id + 1, self._vocab_size), key=_score)
+        steps = _end_steps(eos_id)
+        self.assertGreater(len(set(steps)), 2)
+        self.assertEqual(max(steps), sampled_ids.shape[1])
+        return eos_id
+
+    def _run(self, sess, fetches):
+        return sess.run(
+            fetches,
+            feed_dict={context.global_mode(): tf.estimator.ModeKeys.PREDICT})
+
+    def _assert_same_decoding(self, sampled_ids, log_probs, ref_sampled_ids,
+                              ref_log_probs, eos_id):
+        """Asserts that the ids up to `eos_id` and the log probabilities
+        equal those of the reference.
+        """
+        for row, ref_row in zip(sampled_ids, ref_sampled_ids):
+            ref_row = list(ref_row)
+            if eos_id in ref_row:
+                ref_row = ref_row[:ref_row.index(eos_id) + 1]
+            self.assertEqual(list(row[:len(ref_row)]), ref_row)
+        np.testing.assert_allclose(log_probs, ref_log_probs, rtol=1e-4,
+                                   atol=1e-4)
+
+    def test_remove_padding(self):
+        """Tests that skipping the padding of the blanks and the templates
+        keeps the outputs at the other positions.
+        """
+        pad_id = 2
+        decoder = self._decoder(pad_idx=pad_id)
+        rng = np.random.RandomState(1)
+        # 0 is a token, not padding
+        templates = rng.randint(4, self._vocab_size,
+                                size=[self._batch_size, 9])
+        templates[:, 0] = 0
+        templates[:, [2, 6]] = self._mask_id
+        templates[:3, 7:] = pad_id
+        text_ids = rng.randint(4, self._vocab_size,
+                               size=[self._batch_size, 6])
+        text_ids[:, 0] = self._bos_id
+        text_ids[:, 1] = 0
+        for row, length in enumerate([6, 4, 3, 6, 2, 5]):
+            text_ids[row, length:] = pad_id
+        template_pack = dict(self._template_pack,
+                             templates=tf.constant(templates, dtype=tf.int64))
+        segment_ids, offsets = self._positions(6)
+        decoder_input_pack = {'text_ids': tf.constant(text_ids),
+                              'segment_ids': segment_ids,
+                              'offsets': offsets}
+
+        decoder.hparams.remove_padding = True
+        logits, _ = decoder(decoder_input_pack, template_pack, None, None)
+        decoder.hparams.remove_padding = False
+        bias = attentions.attention_bias_ignore_padding(
+            tf.to_float(tf.equal(template_pack['templates'], pad_id)))
+        ref_logits, _ = decoder(decoder_input_pack, template_pack, bias, None)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            logits_, ref_logits_ = self._run(sess, [logits, ref_logits])
+            tokens = text_ids[:, :-1] != pad_id
+            np.testing.assert_allclose(logits_[tokens], ref_logits_[tokens],
+                                       rtol=1e-5, atol=1e-5)
+
+    def _local_bias(self, segment_ids, blank_positions, width):
+        """The bias of attending only to the `width` positions of the
+        templates around `blank_positions`, the masks and the first token of
+        every segment.
+        """
+        length = segment_ids.shape[1]
+        attended = np.zeros(segment_ids.shape, dtype=bool)
+        for row, position in enumerate(blank_positions):
+            start = min(max(position - width // 2, 0), length - width)
+            attended[row, start:start + width] = True
+            attended[row] |= segment_ids[row] % 2 == 1
+            attended[row, 0] = True
+            attended[row, 1:] |= segment_ids[row, 1:] != segment_ids[row, :-1]
+        return tf.constant(np.reshape(
+            -1e18 * (1. - attended.astype(np.float32)),
+            [-1, 1, 1, length]))
+
+    def test_template_attention_window(self):
+        """Tests that attending to a window of the templates around the
+        blank, the masks and the first token of every segment equals
+        attending to the whole templates with the other positions masked
+        out, in training blank by blank, in non-autoregressive training and
+        in decoding every blank.
+        """
+        width = 4
+        decoder = self._decoder()
+        rng = np.random.RandomState(1)
+        # the template of the second of three blanks in training, where
+        # the first blank is filled and the remaining ones are renumbered
+        updated_segment_ids = np.array(
+            [[0] * 6 + [1] + [2] * 3 + [3] + [4] * 3] * self._batch_size)
+        templates = rng.randint(4, self._vocab_size,
+                                size=updated_segment_ids.shape)
+        templates[:, [6, 10]] = self._mask_id
+        updated_template_pack = {
+            'templates': tf.constant(templates, dtype=tf.int64),
+            'segment_ids': tf.constant(updated_segment_ids, dtype=tf.int64),
+            'offsets': tf.constant(
+                [list(range(6)) + [0, 0, 1, 2, 0, 0, 1, 2]] * self._batch_size,
+                dtype=tf.int64),
+        }
+        text_ids = rng.randint(4, self._vocab_size,
+                               size=[self._batch_size, 5])
+        text_ids[:, 0] = self._bos_id
+        _, offsets = self._positions(5)
+        # the segment id of the second blank in the original template
+        hole = {'text_ids': tf.constant(text_ids),
+                'segment_ids': self._positions(5, 3)[0],
+                'offsets': offsets,
+                'lengths': tf.fill([self._batch_size], 4)}
+        segment_ids = np.array([[0, 0, 1, 2, 2, 2, 3, 4, 4]] *
+                               self._batch_size)
+        mask_positions = [2, 6]
+        length = self._max_decode_length + 1
+        _, decode_offsets = self._positions(length)
+
+        outputs = {}
+        for window in [width, 0]:
+            decoder.hparams.template_attention_window = window
+            def _bias(segment_ids, position, window=window):
+                if window > 0:
+                    return None
+                return self._local_bias(
+                    segment_ids, [position] * self._batch_size, width)
+            outputs[('train', window)], _ = decoder(
+                hole, updated_template_pack,
+                _bias(updated_segment_ids, 6), None)
+            outputs[('nat', window)], _ = decoder(
+                dict(hole, **{key: hole[key][:, 1:] for key in
+                              ['text_ids', 'segment_ids', 'offsets']}),
+                self._template_pack,
+                _bias(segment_ids, mask_positions[1]), None,
+                non_autoregressive=True)
+            for i, position in enumerate(mask_positions):
+                outputs[('decode', i, window)] = decoder.dynamic_decode(
+                    self._template_pack, _bias(segment_ids, position),
+                    self._positions(length, 2 * i + 1)[0], decode_offsets,
+                    self._bos_id, self._vocab_size)
+        decoder.hparams.template_attention_window = width
+        outputs['parallel'] = decoder.parallel_decode(
+            self._template_pack, None, len(mask_positions), decode_offsets,
+            self._bos_id, self._vocab_size)
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            outputs_ = self._run(sess, outputs)
+            for name in ['train', 'nat']:
+                np.testing.assert_allclose(outputs_[(name, width)],
+                                           outputs_[(name, 0)],
+                                           rtol=1e-5, atol=1e-5)
+            for i in range(len(mask_positions)):
+                output_ = outputs_[('decode', i, width)]
+                for ref_ in [outputs_[('decode', i, 0)],
+                             {'sampled_ids': outputs_['parallel'][
+                                 'sampled_ids'][:, i:i + 1],
+                              'log_probs': outputs_['parallel'][
+                                  'log_probs'][:, i:i + 1]}]:
+                    np.testing.assert_array_equal(output_['sampled_ids'],
+                                                  ref_['sampled_ids'])
+                    np.testing.assert_allclose(output_['log_probs'],
+                                               ref_['log_probs'],
+                                               rtol=1e-4, atol=1e-4)
+
+    def test_greedy_decode_compaction(self):
+        """Tests that compacting the finished rows out of greedy decoding
+        gives the same results.
+        """
+        decoder = self._decoder()
+        segment_ids, offsets = self._positions(self._max_decode_length + 1)
+        def _decode(eos_id):
+            return decoder.dynamic_decode(
+                self._template_pack, None, segment_ids, offsets,
+                self._bos_id, eos_id)
+
+        probe = _decode(self._vocab_size)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            eos_id = self._eos_id(self._run(sess, probe)['sampled_ids'][:, 0])
+
+            outputs = {}
+            for preallocate in [False, True]:
+                for every in [0, 1, 2]:
+                    decoder.hparams.preallocate_decode_cache = preallocate
+                    decoder.hparams.compact_finished_every = every
+                    outputs[(preallocate, every)] = _decode(eos_id)
+            outputs_ = self._run(sess, outputs)
+
+            ref = outputs_[(False, 0)]
+            for preallocate in [False, True]:
+                for every in [0, 1, 2]:
+                    output = outputs_[(preallocate, every)]
+                    self._assert_same_decoding(
+                        output['sampled_ids'][:, 0], output['log_probs'],
+                        ref['sampled_ids'][:, 0], ref['log_probs'], eos_id)
+                    if every > 0:
+                        # the removed rows are filled with `eos`
+                        for row in output['sampled_ids'][:, 0]:
+                            end = list(row).index(eos_id) \
+                                if eos_id in row else len(row)
+                            self.assertTrue(np.all(row[end:] == eos_id))
+
+    def test_parallel_decode(self):
+        """Tests that parallel decoding decodes the i-th blank of every
+        template as decoding that blank alone, with segment id `2 * i + 1`.
+        """
+        decoder = self._decoder()
+        blank_num = 2
+        length = self._max_decode_length + 1
+        _, offsets = self._positions(length)
+        def _decode_blanks(eos_id):
+            return [decoder.dynamic_decode(
+                self._template_pack, None,
+                self._positions(length, 2 * i + 1)[0], offsets,
+                self._bos_id, eos_id) for i in range(blank_num)]
+
+        probe = _decode_blanks(self._vocab_size)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            probe_ = self._run(sess, probe)
+            eos_id = self._eos_id(np.concatenate(
+                [blank['sampled_ids'][:, 0] for blank in probe_]))
+
+            for beam_width in [1, 2]:
+                decoder.hparams.beam_width = beam_width
+                outputs_, blanks_ = self._run(sess, [
+                    decoder.parallel_decode(
+                        self._template_pack, None, blank_num, offsets,
+                        self._bos_id, eos_id),
+                    _decode_blanks(eos_id)])
+                self.assertEqual(outputs_['sampled_ids'].shape[:2],
+                                 (self._batch_size, blank_num))
+                for i, blank_ in enumerate(blanks_):
+                    self._assert_same_decoding(
+                        outputs_['sampled_ids'][:, i],
+                        outputs_['log_probs'][:, i],
+                        blank_['sampled_ids'][:, 0],
+                        blank_['log_probs'][:, 0], eos_id)
+
+    def test_speculative_decode(self):
+        """Tests that speculative decoding gives the ids and log
+        probabilities of greedy decoding, whether the drafts are right,
+        wrong or random.
+        """
+        decoder = self._decoder()
+        num_draft_tokens = 3
+        segment_ids, offsets = self._positions(self._max_decode_length + 1)
+        def _decode(eos_id):
+            return decoder.dynamic_decode(
+                self._template_pack, None, segment_ids, offsets,
+                self._bos_id, eos_id)
+
+        probe = _decode(self._vocab_size)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            eos_id = self._eos_id(self._run(sess, probe)['sampled_ids'][:, 0])
+
+            greedy = _decode(eos_id)
+            # the right drafts of every prefix, followed by `eos`
+            width = self._max_decode_length + num_draft_tokens
+            greedy_ids = greedy['sampled_ids'][:, 0]
+            greedy_ids = tf.pad(
+                greedy_ids, [[0, 0], [0, width - tf.shape(greedy_ids)[1]]],
+                constant_values=eos_id)
+            def _right_drafts(ids, lengths, num_tokens):
+                indices = tf.expand_dims(lengths - 1, 1) + tf.range(num_tokens)
+                batch_indices = tf.tile(
+                    tf.expand_dims(tf.range(tf.shape(ids)[0]), 1),
+                    [1, num_tokens])
+                return tf.gather_nd(
+                    greedy_ids, tf.stack([batch_indices, indices], -1))
+            def _wrong_drafts(ids, lengths, num_tokens):
+                return (_right_drafts(ids, lengths, num_tokens) + 1) % \
+                    self._vocab_size
+            def _random_drafts(ids, lengths, num_tokens):
+                return tf.random_uniform([tf.shape(ids)[0], num_tokens],
+                                         maxval=self._vocab_size,
+                                         dtype=tf.int32)
+
+            segment_ids, offsets = self._positions(
+                self._max_decode_length + num_draft_tokens + 1)
+            outputs = [
+                decoder.speculative_decode(
+                    self._template_pack, None, segment_ids, offsets,
+                    self._bos_id, eos_id, draft_fn, num_draft_tokens)
+                for draft_fn in [_right_drafts, _wrong_drafts,
+                                 _random_drafts]]
+            greedy_, outputs_ = self._run(sess, [greedy, outputs])
+            for output_ in outputs_:
+                self.assertEqual(output_['sampled_ids'].shape,
+                                 (self._batch_size, 1,
+                                  self._max_decode_length))
+                self._assert_same_decoding(
+                    output_['sampled_ids'][:, 0], output_['log_probs'],
+                    greedy_['sampled_ids'][:, 0], greedy_['log_probs'],
+                    eos_id)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -13,6 +13,7 @@ import collections
 
 import tensorflow as tf
 from tensorflow.python.framework import tensor_shape, dtypes
+from tensorflow.python.ops import inplace_ops
 from tensorflow.python.util import nest
 
 from texar.core import layers, attentions
@@ -69,6 +70,13 @@ class TransformerDecoder(ModuleBase):
     def default_hparams():
         """default hyperrams for transformer deocder.
             sampling_method: argmax or sample. To choose the function transforming the logits to the sampled id in the next position when inferencing.
+            preallocate_decode_cache: whether greedy decoding writes the self
+                attention keys and values of each step in place into buffers
+                of `maximum_decode_length` steps, instead of concatenating
+                them, so that the decoding loop has static shapes.
+            fused_attention: whether the attention layers project with fused
+                `qkv` and `kv` variables and keep head-major layouts, see
+                :func:`~texar.core.attentions.multihead_attention`.
         """
         return {
             'sampling_method': 'argmax',
@@ -95,6 +103,8 @@ class TransformerDecoder(ModuleBase):
             'num_units':512,
             'eos_idx': 2,
             'bos_idx': 1,
+            'preallocate_decode_cache': False,
+            'fused_attention': False,
         }
 
     def prepare_tokens_to_embeds(self, tokens):
@@ -102,7 +112,7 @@ class TransformerDecoder(ModuleBase):
         token_emb = tf.nn.embedding_lookup(self._embedding, tokens)
         return token_emb
 
-    def _symbols_to_logits_fn(self, embedding_fn, max_length):
+    def _symbols_to_logits_fn(self, embedding_fn, max_length, preallocated=False):
         channels = shape_list(self._embedding)[-1]
         timing_signal = self.position_embedder(max_length, channels)
 
@@ -123,6 +133,7 @@ class TransformerDecoder(ModuleBase):
                 inputs,
                 encoder_output=cache['memory'],
                 cache=cache,
+                decode_step=step if preallocated else None,
             )
             #outputs = outputs[:, -1:, :]
             logits = self.output_layer(outputs)
@@ -218,7 +229,8 @@ class TransformerDecoder(ModuleBase):
                               decoder_self_attention_bias=None,
                               encoder_decoder_attention_bias=None,
                               cache=None,
-                              mode=None):
+                              mode=None,
+                              decode_step=None):
         """
             stacked multihead attention module.
         """
@@ -246,6 +258,8 @@ class TransformerDecoder(ModuleBase):
                         dropout_rate=self._hparams.attention_dropout,
                         cache=layer_cache,
                         scope="multihead_attention",
+                        decode_step=decode_step,
+                        fused=self._hparams.fused_attention,
                     )
                     x = x + tf.layers.dropout(
                         selfatt_output,
@@ -261,7 +275,9 @@ class TransformerDecoder(ModuleBase):
                             num_units=self._hparams.num_units,
                             num_heads=self._hparams.num_heads,
                             dropout_rate=self._hparams.attention_dropout,
-                            scope="multihead_attention"
+                            cache=layer_cache,
+                            scope="multihead_attention",
+                            fused=self._hparams.fused_attention,
                         )
                         x = x + tf.layers.dropout(encdec_output, \
                             rate=self._hparams.residual_dropout, \
@@ -321,19 +337,42 @@ class TransformerDecoder(ModuleBase):
         return TransformerDecoderOutput(
             output_logits=dtypes.float32, sample_id=dtypes.int32)
 
-    def _init_cache(self, memory, encoder_decoder_attention_bias):
+    def _init_cache(self, memory, encoder_decoder_attention_bias,
+                    decode_length=None):
         cache = {
             'memory': memory,
             'encoder_decoder_attention_bias': encoder_decoder_attention_bias,
         }
         batch_size = tf.shape(memory)[0]
         depth = memory.get_shape().as_list()[-1]
+        if self._hparams.fused_attention:
+            # head-major, see `attentions.multihead_attention`
+            num_heads = self._hparams.num_heads
+            self_shape = [batch_size, num_heads, 0,
+                          self._hparams.num_units // num_heads]
+        else:
+            num_heads = None
+            self_shape = [batch_size, 0, depth]
         for l in range(self._hparams.num_blocks):
+            # the memory is projected once here instead of in every step
+            with tf.variable_scope('layer_{}/encdec_attention'.format(l)):
+                memory_keys, memory_values = attentions.memory_keys_values(
+                    memory, self._hparams.num_units, num_heads=num_heads)
+            if decode_length is None:
+                self_keys = tf.zeros(self_shape)
+                self_values = tf.zeros(self_shape)
+            else:
+                # preallocated, see `attentions.multihead_attention`. The
+                # buffers are written in place, so they must not be constants
+                # that would be reused across runs.
+                self_shape = [decode_length, batch_size, self._hparams.num_units]
+                self_keys = inplace_ops.empty(self_shape, tf.float32, init=True)
+                self_values = inplace_ops.empty(self_shape, tf.float32, init=True)
             cache['layer_{}'.format(l)] = {
-                'self_keys': tf.zeros([batch_size, 0, depth]),
-                'self_values': tf.zeros([batch_size, 0, depth]),
-                'memory_keys': tf.zeros([batch_size, 0, depth]),
-                'memory_values': tf.zeros([batch_size, 0, depth]),
+                'self_keys': self_keys,
+                'self_values': self_values,
+                'memory_keys': memory_keys,
+                'memory_values': memory_values,
             }
         return cache
 
@@ -347,14 +386,19 @@ class TransformerDecoder(ModuleBase):
         batch_size = tf.shape(start_tokens)[0]
         finished = tf.fill([batch_size], False)
         step = tf.constant(0)
-        decoded_ids = tf.zeros([batch_size, 0], dtype=tf.int32)
+        preallocated = self._hparams.preallocate_decode_cache
+        if preallocated:
+            decoded_ids = tf.TensorArray(tf.int32, size=0, dynamic_size=True)
+        else:
+            decoded_ids = tf.zeros([batch_size, 0], dtype=tf.int32)
         next_id = tf.expand_dims(start_tokens, 1)
         print('next id:{}'.format(next_id.shape))
         log_prob = tf.zeros([batch_size], dtype=tf.float32)
 
-        cache = self._init_cache(memory, encoder_decoder_attention_bias)
+        cache = self._init_cache(memory, encoder_decoder_attention_bias,
+            decode_length=decode_length if preallocated else None)
         symbols_to_logits_fn = self._symbols_to_logits_fn(embedding_fn,
-            max_length=decode_length+1)
+            preallocated=preallocated, max_length=decode_length+1)
 
         def _body(step, finished, next_id, decoded_ids, cache, log_prob):
 
@@ -373,10 +417,13 @@ class TransformerDecoder(ModuleBase):
                 [tf.range(tf.to_int32(batch_size)), next_id], axis=1)
             log_prob += tf.gather_nd(log_probs, log_prob_indices)
 
+            if preallocated:
+                decoded_ids = decoded_ids.write(step, next_id)
             next_id = tf.expand_dims(next_id, axis=1)
             #keep the shape as [batch_size, seq_len]
 
-            decoded_ids = tf.concat([decoded_ids, next_id], axis=1)
+            if not preallocated:
+                decoded_ids = tf.concat([decoded_ids, next_id], axis=1)
             return step+1, finished, next_id, decoded_ids, cache, log_prob
 
         def is_not_finished(i, finished, *_):
@@ -390,10 +437,13 @@ class TransformerDecoder(ModuleBase):
                 tf.TensorShape([]),
                 tf.TensorShape([None]),
                 tf.TensorShape([None, None]),
-                tf.TensorShape([None, None]),
-                nest.map_structure(beam_search.get_state_shape_invariants, cache),
+                tf.TensorShape(None) if preallocated else tf.TensorShape([None, None]),
+                nest.map_structure(lambda t: t.shape, cache) if preallocated \
+                    else nest.map_structure(beam_search.get_state_shape_invariants, cache),
                 tf.TensorShape([None]),
             ))
+        if preallocated:
+            decoded_ids = tf.transpose(decoded_ids.stack(), [1, 0])
 
         outputs = tf.expand_dims(decoded_ids, 1)
         log_prob = tf.expand_dims(log_prob, 1)
@@ -418,7 +468,10 @@ class TransformerDecoder(ModuleBase):
             self._vocab_size,
             self._hparams.alpha,
             states=cache,
-            eos_id=EOS)
+            eos_id=EOS,
+            beam_invariant_keys=('memory', 'encoder_decoder_attention_bias',
+                                 'memory_keys', 'memory_values'),
+            two_stage_topk=True)
 
         outputs = outputs[:, :, 1:] # ignore <BOS>
         return (outputs, log_probs)
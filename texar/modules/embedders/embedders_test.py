@@ -15,7 +15,8 @@ import numpy as np
 import tensorflow as tf
 
 from texar.modules.embedders.embedders import WordEmbedder
-from texar.modules.embedders.position_embedders import PositionEmbedder
+from texar.modules.embedders.position_embedders import PositionEmbedder, \
+    SinusoidsSegmentalPositionEmbedder
 from texar.context import global_mode
 
 class EmbedderTest(tf.test.TestCase):
@@ -199,5 +200,36 @@ class EmbedderTest(tf.test.TestCase):
             outputs_, soft_outputs_ = sess.run([outputs, soft_outputs])
             self.assertEqual(outputs_, soft_outputs_)
 
+    def test_sinusoids_segmental_position_embedder(self):
+        """Tests :class:`texar.modules.SinusoidsSegmentalPositionEmbedder`.
+        """
+        embedder = SinusoidsSegmentalPositionEmbedder()
+        other_embedder = SinusoidsSegmentalPositionEmbedder()
+        segment_ids = np.random.randint(0, 32, size=(4, 9))
+        offsets = np.random.randint(0, 256, size=(4, 9))
+        outputs = embedder(9, 16, tf.constant(segment_ids, dtype=tf.int64),
+                           tf.constant(offsets, dtype=tf.int64))
+        other_outputs = other_embedder(1, 16, tf.zeros([4, 1], dtype=tf.int64),
+                                       tf.zeros([4, 1], dtype=tf.int64))
+        self.assertEqual(outputs.shape.as_list(), [4, 9, 16])
+        # the table is built once per graph, from ops rather than a constant
+        graph = tf.get_default_graph()
+        self.assertEqual(len([op for op in graph.get_operations()
+                              if op.name.startswith('sinusoid_table_')]), 0)
+        self.assertLess(graph.as_graph_def().ByteSize(), 32 * 256 * 16 * 4)
+        out_of_table = embedder(1, 16, tf.constant([[32]], dtype=tf.int64),
+                                tf.zeros([1, 1], dtype=tf.int64))
+
+        position = 256 * segment_ids + offsets
+        inv_timescales = np.exp(np.arange(8) * -np.log(1.0e4) / 7)
+        scaled_time = position[:, :, None] * inv_timescales
+        expected = np.concatenate([np.sin(scaled_time), np.cos(scaled_time)], axis=2)
+        with self.test_session() as sess:
+            outputs_, other_outputs_ = sess.run([outputs, other_outputs])
+            np.testing.assert_allclose(outputs_, expected, atol=1e-6)
+            np.testing.assert_allclose(other_outputs_[:, 0, 8:], 1.)
+            with self.assertRaises(tf.errors.InvalidArgumentError):
+                sess.run(out_of_table)
+
 if __name__ == "__main__":
     tf.test.main()
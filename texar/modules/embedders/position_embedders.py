@@ -8,6 +8,7 @@ from __future__ import division
 from __future__ import print_function
 
 import math
+import weakref
 
 import tensorflow as tf
 
@@ -259,6 +260,39 @@ class SinusoidsPositionEmbedder(EmbedderBase):
         return signal
 
 
+# Sinusoid tables of each graph, keyed by their configurations
+_sinusoid_tables = weakref.WeakKeyDictionary()
+
+
+def _sinusoid_table(num_positions, channels, min_timescale, max_timescale):
+    """Returns a `[num_positions, channels]` table of the sinusoid signals
+    of positions `0, ..., num_positions - 1`, computed in double precision.
+    The table is created once per graph and configuration, outside of any
+    control flow context, so that all modules of the graph share it. It is
+    built from ops rather than stored as a constant, to keep the graph small.
+    """
+    graph = tf.get_default_graph()
+    tables = _sinusoid_tables.setdefault(graph, {})
+    key = (num_positions, channels, min_timescale, max_timescale)
+    if key not in tables:
+        num_timescales = channels // 2
+        log_timescale_increment = (
+            math.log(float(max_timescale) / float(min_timescale)) /
+            (num_timescales - 1))
+        with tf.control_dependencies(None), graph.name_scope(None), \
+                tf.name_scope('sinusoid_table') as scope:
+            inv_timescales = min_timescale * tf.exp(
+                tf.range(num_timescales, dtype=tf.float64) *
+                -log_timescale_increment)
+            scaled_time = tf.expand_dims(
+                tf.range(num_positions, dtype=tf.float64), 1) \
+                * tf.expand_dims(inv_timescales, 0)
+            table = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)],
+                              axis=1)
+            tables[key] = tf.cast(table, tf.float32, name=scope)
+    return tables[key]
+
+
 class SinusoidsSegmentalPositionEmbedder(EmbedderBase):
     def __init__(self, hparams=None):
         EmbedderBase.__init__(self, hparams=hparams)
@@ -268,6 +302,8 @@ class SinusoidsSegmentalPositionEmbedder(EmbedderBase):
         We use a geometric sequence of timescales starting with
         min_timescale and ending with max_timescale. The number of different
         timescales is equal to channels/2.
+        Segment ids must be less than max_segments, i.e. a template of
+        `blank_num` blanks needs `max_segments >= 2 * blank_num + 1`.
         """
         hparams = {
             'name': 'sinusoid_segmental_posisiton_embedder',
@@ -275,29 +311,35 @@ class SinusoidsSegmentalPositionEmbedder(EmbedderBase):
             'max_timescale': 1.0e4,
             'trainable': False,
             'base': 256,
+            'max_segments': 32,
         }
         return hparams
 
     def _build(self, length, channels, segment_ids, offsets):
         """
+        The signal of position `base * segment_id + offset` is looked up
+        from a table of `max_segments * base` positions, built once and
+        shared by all the embedders of the graph with the same channels.
+        An InvalidArgumentError is raised for positions out of the table.
         :param length: an int
         :param channels: an int
-        :param segment_id: [batch_size, length]
-        :param segment_offset: [batch_size, length]
+        :param segment_id: [batch_size, length], less than `max_segments`
+        :param segment_offset: [batch_size, length], less than `base`
         :return: [batch_size, length, channels]
         """
         # TODO(wanrong): check if segment_ids is of shape [batch_size, length]
-        position = tf.to_float(tf.add(tf.multiply(tf.cast(256, tf.int64), segment_ids),
-                                      offsets))
-        num_timescales = channels // 2
-        min_timescale = 1.0
-        max_timescale = 1.0e4
-        log_timescale_increment = (
-            math.log(float(max_timescale) / float(min_timescale)) /
-            (tf.to_float(num_timescales) - 1))
-        inv_timescales = min_timescale * tf.exp(
-            tf.to_float(tf.range(num_timescales)) * -log_timescale_increment)
-        scaled_time = tf.expand_dims(position, 2) * inv_timescales
-        signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=2)
+        base = self._hparams.base
+        num_positions = self._hparams.max_segments * base
+        position = tf.add(tf.multiply(tf.cast(base, tf.int64), tf.to_int64(segment_ids)),
+                          tf.to_int64(offsets))
+        table = _sinusoid_table(num_positions, channels,
+                                self._hparams.min_timescale,
+                                self._hparams.max_timescale)
+        assert_in_table = tf.assert_less(
+            position, tf.cast(num_positions, tf.int64),
+            message='Positions out of the table, increase `max_segments`')
+        with tf.control_dependencies([assert_in_table]):
+            position = tf.identity(position)
+        signal = tf.gather(table, position)
         signal = tf.reshape(signal, shape=[-1, length, channels])
-        return signal
\ No newline at end of file
+        return signal
@@ -53,6 +53,14 @@ class TransformerEncoder(EncoderBase):
                     position_embedders.SinusoidsPositionEmbedder(\
                     self._hparams.position_embedder.hparams)
 
+            # Built once here instead of in every call, so that a layer
+            # computed again with "recompute_grad" reuses the same networks.
+            self.poswise_networks = []
+            for i in range(self._hparams.num_blocks):
+                with tf.variable_scope('layer_{}'.format(i)):
+                    self.poswise_networks.append(FeedForwardNetwork(
+                        hparams=self._hparams['poswise_feedforward']))
+
         if self._hparams.use_embedding:
             if isinstance(embedding, tf.Variable):
                 self._embedding = embedding
@@ -106,6 +114,18 @@ class TransformerEncoder(EncoderBase):
                 # constructor, "dim" and "initializer" in the configuration
                 # are ignored.
                 "embedding": texar.core.layers.default_embedding_hparams(),
+
+                # Whether the self attention projects with a single fused
+                # `qkv` variable, see
+                # :func:`~texar.core.attentions.multihead_attention`.
+                "fused_attention": False,
+
+                # Whether the activations of every layer are computed again
+                # in the backward pass of training instead of kept, see
+                # :func:`~texar.core.layers.recompute_grad`. The dropout masks
+                # are then drawn from a seed per layer.
+                "recompute_grad": False,
+
                 # Name of the encoder.
                 "name": "transformer_encoder"
             }
@@ -127,6 +147,8 @@ class TransformerEncoder(EncoderBase):
             'poswise_feedforward':None,
             'target_space_id': None,
             'num_units': 512,
+            'fused_attention': False,
+            'recompute_grad': False,
         }
 
     #pylint:disable=arguments-differ
@@ -165,38 +187,19 @@ class TransformerEncoder(EncoderBase):
         pad_remover = utils.transformer_utils.PadRemover(encoder_padding)
         for i in range(self._hparams.num_blocks):
             with tf.variable_scope("layer_{}".format(i)):
-                with tf.variable_scope('self_attention'):
-                    selfatt_output = attentions.multihead_attention(
-                        queries=layers.layer_normalize(x),
-                        memory=None,
-                        memory_attention_bias=encoder_self_attention_bias,
-                        num_heads=self._hparams.num_heads,
-                        dropout_rate=self._hparams.attention_dropout,
-                        num_units=self._hparams.num_units,
-                        scope='multihead_attention'
-                    )
-                    x = x + tf.layers.dropout(
-                        selfatt_output,
-                        rate=self._hparams.residual_dropout,
-                        training=context.global_mode_train()
-                    )
-                poswise_network = FeedForwardNetwork(
-                    hparams=self._hparams['poswise_feedforward'])
-                with tf.variable_scope(poswise_network.variable_scope):
-                    y = layers.layer_normalize(x)
-                    original_shape = shape_list(y)
-                    y = tf.reshape(y, [-1, self._hparams.num_units])
-                    y = tf.expand_dims(pad_remover.remove(y), axis=0)
-                    #[1, batch_size*seq_length, hidden_dim]
-                    sub_output = tf.layers.dropout(
-                        poswise_network(y),
-                        rate=self._hparams.residual_dropout,
-                        training=context.global_mode_train()
-                    )
-                    sub_output = tf.reshape(pad_remover.restore(tf.squeeze(\
-                        sub_output, axis=0)), original_shape \
-                    )
-                    x = x + sub_output
+                if self._hparams.recompute_grad:
+                    # dropout masks from a seed, to be the same when the
+                    # layer is computed again in the backward pass
+                    seed = tf.random_uniform(
+                        [2], maxval=tf.int64.max, dtype=tf.int64)
+                    def _layer(x, i=i, seed=seed):
+                        return self._layer(
+                            i, x, encoder_self_attention_bias, pad_remover,
+                            dropout_fn=layers.seeded_dropout(seed))
+                    x = layers.recompute_grad(_layer, [x])
+                else:
+                    x = self._layer(i, x, encoder_self_attention_bias,
+                                    pad_remover)
 
         self.stack_output = x
         encoder_output = layers.layer_normalize(x)
@@ -206,3 +209,46 @@ class TransformerEncoder(EncoderBase):
             self._built = True
 
         return encoder_output, encoder_decoder_attention_bias
+
+    def _layer(self, i, x, encoder_self_attention_bias, pad_remover,
+               dropout_fn=None):
+        """The `i`-th layer of the stack, in its variable scope.
+        `dropout_fn`, if given, applies all the dropout of the layer.
+        """
+        if dropout_fn is None:
+            def _dropout(inputs, rate):
+                return tf.layers.dropout(inputs, rate=rate,
+                                         training=context.global_mode_train())
+        else:
+            _dropout = dropout_fn
+        with tf.variable_scope('self_attention'):
+            selfatt_output = attentions.multihead_attention(
+                queries=layers.layer_normalize(x),
+                memory=None,
+                memory_attention_bias=encoder_self_attention_bias,
+                num_heads=self._hparams.num_heads,
+                dropout_rate=self._hparams.attention_dropout,
+                num_units=self._hparams.num_units,
+                scope='multihead_attention',
+                fused=self._hparams.fused_attention,
+                dropout_fn=dropout_fn,
+            )
+            x = x + _dropout(selfatt_output, self._hparams.residual_dropout)
+        poswise_network = self.poswise_networks[i]
+        # a scope entered by object does not inherit the reuse of the
+        # enclosing one, e.g., in a later call of the module
+        with tf.variable_scope(poswise_network.variable_scope,
+                               reuse=tf.get_variable_scope().reuse):
+            y = layers.layer_normalize(x)
+            original_shape = shape_list(y)
+            y = tf.reshape(y, [-1, self._hparams.num_units])
+            y = tf.expand_dims(pad_remover.remove(y), axis=0)
+            #[1, batch_size*seq_length, hidden_dim]
+            sub_output = _dropout(
+                poswise_network(y, dropout_fn=dropout_fn),
+                self._hparams.residual_dropout)
+            sub_output = tf.reshape(pad_remover.restore(tf.squeeze(\
+                sub_output, axis=0)), original_shape \
+            )
+            x = x + sub_output
+        return x
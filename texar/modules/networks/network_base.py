@@ -76,11 +76,14 @@ class FeedForwardNetworkBase(ModuleBase):
             "name": "NN"
         }
 
-    def _build(self, inputs, mode=None):
+    def _build(self, inputs, mode=None, dropout_fn=None):
         """
 
         Args:
             inputs:
+            dropout_fn (optional): A function `dropout_fn(inputs, rate)`
+                applied in place of the `Dropout` layers, e.g., from
+                :func:`~texar.core.layers.seeded_dropout`.
 
         Returns:
         """
@@ -88,7 +91,10 @@ class FeedForwardNetworkBase(ModuleBase):
 
         prev_outputs = inputs
         for layer_id, layer in enumerate(self._layers):
-            if isinstance(layer, tf.layers.Dropout) or \
+            if dropout_fn is not None and \
+                    isinstance(layer, tf.layers.Dropout):
+                outputs = dropout_fn(prev_outputs, layer.rate)
+            elif isinstance(layer, tf.layers.Dropout) or \
                     isinstance(layer, tf.layers.BatchNormalization):
                 outputs = layer(prev_outputs, training=training)
             else:
@@ -75,6 +75,19 @@ def _expand_to_beam_size(tensor, beam_size):
     return tf.tile(tensor, tile_dims)
 
 
+def _map_states(fn, states, beam_invariant_keys, key=None):
+    """Applies :attr:`fn` to every tensor in the (possibly nested) dict
+    :attr:`states`, except the tensors under keys in
+    :attr:`beam_invariant_keys`, which are returned unchanged.
+    """
+    if isinstance(states, dict):
+        return {k: _map_states(fn, v, beam_invariant_keys, k)
+                for k, v in states.items()}
+    if key in beam_invariant_keys:
+        return states
+    return fn(states)
+
+
 def get_state_shape_invariants(tensor):
     """Returns the shape of the tensor but sets middle dims to None."""
     shape = tensor.shape.as_list()
@@ -107,7 +120,9 @@ def compute_batch_indices(batch_size, beam_size):
 
 def compute_topk_scores_and_seq(sequences, scores, scores_to_gather, flags,
                                                                 beam_size, batch_size, prefix="default",
-                                                                states_to_gather=None):
+                                                                states_to_gather=None,
+                                                                beam_index=None,
+                                                                beam_invariant_keys=()):
     """Given sequences and scores, will gather the top k=beam size sequences.
 
     This function is used to grow alive, and finished. It takes sequences,
@@ -136,6 +151,14 @@ def compute_topk_scores_and_seq(sequences, scores, scores_to_gather, flags,
         batch_size: int
         prefix: string that will prefix unique names for the ops run.
         states_to_gather: dict (possibly nested) of decoding states.
+        beam_index: Optional tensor of the beams each sequence in sequences
+            was grown from. [batch_size, sequences_beam_size]. If given,
+            states_to_gather are of the beams, [batch_size, beam_size, ...],
+            and are gathered at the beams the topk sequences were grown from,
+            so that each state is gathered only once per step.
+        beam_invariant_keys: keys in states_to_gather of the states that are
+            equal for all the beams of a batch element, which are not
+            gathered.
     Returns:
         Tuple of
         (topk_seq [batch_size, beam_size, decode_length],
@@ -164,8 +187,16 @@ def compute_topk_scores_and_seq(sequences, scores, scores_to_gather, flags,
     topk_flags = gather(flags, "_topk_flags")
     topk_gathered_scores = gather(scores_to_gather, "_topk_scores")
     if states_to_gather:
-        topk_gathered_states = nest.map_structure(
-                lambda state: gather(state, "_topk_states"), states_to_gather)
+        state_coordinates = top_coordinates
+        if beam_index is not None:
+            # Follows the backpointers of the topk sequences to the beams
+            # holding their states.
+            state_coordinates = tf.stack(
+                    [batch_pos, gather(beam_index, "_topk_beam_index")], axis=2)
+        topk_gathered_states = _map_states(
+                lambda state: tf.gather_nd(state, state_coordinates,
+                                           name=(prefix + "_topk_states")),
+                states_to_gather, beam_invariant_keys)
     else:
         topk_gathered_states = states_to_gather
     return topk_seq, topk_gathered_scores, topk_flags, topk_gathered_states
@@ -179,7 +210,10 @@ def beam_search(symbols_to_logits_fn,
                                 alpha,
                                 eos_id,
                                 states=None,
-                                stop_early=True):
+                                stop_early=True,
+                                beam_invariant_keys=(),
+                                two_stage_topk=False,
+                                per_example_stop=False):
     """Beam search with length penalties.
 
     Requires a function that can take the currently decoded sybmols and return
@@ -220,6 +254,20 @@ def beam_search(symbols_to_logits_fn,
         states: dict (possibly nested) of decoding states.
         eos_id: ID for end of sentence.
         stop_early: a boolean - stop once best sequence is provably determined.
+        beam_invariant_keys: keys in `states` of the states that are equal for
+                all the beams of a batch element, e.g., the encoder output.
+                These are kept at batch granularity: symbols_to_logits_fn gets
+                them as [batch_size, ...] together with the other states as
+                [batch_size * beam_size, ...], and must broadcast each over
+                the beam_size consecutive rows of its batch element. They are
+                never reordered between beams.
+        two_stage_topk: a boolean - take the top 2*beam_size words of every beam
+                first, and then the top 2*beam_size among these candidates,
+                instead of sorting the beam_size*vocab_size scores at once. The
+                results are the same.
+        per_example_stop: a boolean - stop updating the finished sequences of
+                each batch element once its best sequence is provably
+                determined, rather than once that of the whole batch is.
     Returns:
         Tuple of
         (decoded beams [batch_size, beam_size, decode_length]
@@ -236,8 +284,9 @@ def beam_search(symbols_to_logits_fn,
     alive_seq = _expand_to_beam_size(initial_ids, beam_size)
     alive_seq = tf.expand_dims(alive_seq, axis=2)    # (batch_size, beam_size, 1)
     if states:
-        states = nest.map_structure(
-                lambda state: _expand_to_beam_size(state, beam_size), states)
+        states = _map_states(
+                lambda state: _expand_to_beam_size(state, beam_size), states,
+                beam_invariant_keys)
     else:
         states = {}
 
@@ -288,7 +337,8 @@ def beam_search(symbols_to_logits_fn,
                 curr_finished_seq, curr_finished_scores, curr_finished_scores,
                 curr_finished_flags, beam_size, batch_size, "grow_finished")
 
-    def grow_alive(curr_seq, curr_scores, curr_log_probs, curr_finished, states):
+    def grow_alive(curr_seq, curr_scores, curr_log_probs, curr_finished, states,
+                   topk_beam_index):
         """Given sequences and scores, will gather the top k=beam size sequences.
 
         Args:
@@ -299,19 +349,24 @@ def beam_search(symbols_to_logits_fn,
                 [batch_size, beam_size]
             curr_finished: Finished flags for each of these sequences.
                 [batch_size, beam_size]
-            states: dict (possibly nested) of decoding states.
+            states: dict (possibly nested) of decoding states of the alive
+                beams. [batch_size, beam_size, ...]
+            topk_beam_index: the alive beams that curr_seq were grown from.
+                [batch_size, beam_size * 2]
         Returns:
             Tuple of
                 (Topk sequences based on scores,
                  log probs of these sequences,
-                 Finished flags of these sequences)
+                 Finished flags of these sequences,
+                 dict of decoding states of these sequences)
         """
         # Set the scores of the finished seq in curr_seq to large negative
         # values
         curr_scores += tf.to_float(curr_finished) * -INF
         return compute_topk_scores_and_seq(curr_seq, curr_scores, curr_log_probs,
                                            curr_finished, beam_size, batch_size,
-                                           "grow_alive", states)
+                                           "grow_alive", states, topk_beam_index,
+                                           beam_invariant_keys)
 
     def grow_topk(i, alive_seq, alive_log_probs, states):
         r"""Inner beam seach loop.
@@ -337,17 +392,19 @@ def beam_search(symbols_to_logits_fn,
                  The log probs of these sequences,
                  The scores with length penalty of these sequences,
                  Flags indicating which of these sequences have finished decoding,
-                 dict of transformed decoding states)
+                 dict of transformed decoding states of the alive beams,
+                 The alive beams these sequences were grown from)
         """
         # Get the logits for all the possible next symbols
         flat_ids = tf.reshape(alive_seq, [batch_size * beam_size, -1])
 
         # (batch_size * beam_size, decoded_length)
         if states:
-            flat_states = nest.map_structure(_merge_beam_dim, states)
+            flat_states = _map_states(_merge_beam_dim, states, beam_invariant_keys)
             flat_logits, flat_states = symbols_to_logits_fn(flat_ids, i, flat_states)
-            states = nest.map_structure(
-                    lambda t: _unmerge_beam_dim(t, batch_size, beam_size), flat_states)
+            states = _map_states(
+                    lambda t: _unmerge_beam_dim(t, batch_size, beam_size),
+                    flat_states, beam_invariant_keys)
         else:
             flat_logits = symbols_to_logits_fn(flat_ids)
         logits = tf.reshape(flat_logits, [batch_size, beam_size, -1])
@@ -362,23 +419,39 @@ def beam_search(symbols_to_logits_fn,
         length_penalty = tf.pow(((5. + tf.to_float(i + 1)) / 6.), alpha)
 
         curr_scores = log_probs / length_penalty
-        # Flatten out (beam_size, vocab_size) probs in to a list of possibilites
-        flat_curr_scores = tf.reshape(curr_scores, [-1, beam_size * vocab_size])
+        batch_pos = compute_batch_indices(batch_size, beam_size * 2)
 
-        topk_scores, topk_ids = tf.nn.top_k(flat_curr_scores, k=beam_size * 2)
+        if two_stage_topk:
+            # No beam has more than 2*beam of the topk, so the topk are among
+            # the top 2*beam words of each beam. Ties are broken by the beam
+            # and then the word, as sorting all the scores at once does.
+            beam_k = min(beam_size * 2, vocab_size)
+            beam_topk_scores, beam_topk_ids = tf.nn.top_k(curr_scores, k=beam_k)
+            flat_beam_topk_scores = tf.reshape(
+                    beam_topk_scores, [-1, beam_size * beam_k])
+            topk_scores, topk_indexes = tf.nn.top_k(
+                    flat_beam_topk_scores, k=beam_size * 2)
+            topk_beam_index = topk_indexes // beam_k
+            topk_ids = tf.gather_nd(
+                    tf.reshape(beam_topk_ids, [-1, beam_size * beam_k]),
+                    tf.stack([batch_pos, topk_indexes], axis=2))
+        else:
+            # Flatten out (beam_size, vocab_size) probs in to a list of possibilites
+            flat_curr_scores = tf.reshape(curr_scores, [-1, beam_size * vocab_size])
+
+            topk_scores, topk_ids = tf.nn.top_k(flat_curr_scores, k=beam_size * 2)
+
+            # Work out what beam the top probs are in.
+            topk_beam_index = topk_ids // vocab_size
+            topk_ids %= vocab_size    # Unflatten the ids
 
         # Recovering the log probs because we will need to send them back
         topk_log_probs = topk_scores * length_penalty
 
-        # Work out what beam the top probs are in.
-        topk_beam_index = topk_ids // vocab_size
-        topk_ids %= vocab_size    # Unflatten the ids
-
         # The next three steps are to create coordinates for tf.gather_nd to pull
         # out the correct seqences from id's that we need to grow.
         # We will also use the coordinates to gather the booleans of the beam items
         # that survived.
-        batch_pos = compute_batch_indices(batch_size, beam_size * 2)
 
         # top beams will give us the actual coordinates to do the gather.
         # stacking will create a tensor of dimension batch * beam * 2, where the
@@ -388,16 +461,16 @@ def beam_search(symbols_to_logits_fn,
         # Gather up the most probable 2*beams both for the ids and finished_in_alive
         # bools
         topk_seq = tf.gather_nd(alive_seq, topk_coordinates)
-        if states:
-            states = nest.map_structure(
-                    lambda state: tf.gather_nd(state, topk_coordinates), states)
+        # The states are not gathered here, but only once the new alive beams
+        # are known, see `grow_alive`.
 
         # Append the most probable alive
         topk_seq = tf.concat([topk_seq, tf.expand_dims(topk_ids, axis=2)], axis=2)
 
         topk_finished = tf.equal(topk_ids, eos_id)
 
-        return topk_seq, topk_log_probs, topk_scores, topk_finished, states
+        return (topk_seq, topk_log_probs, topk_scores, topk_finished, states,
+                topk_beam_index)
 
     def inner_loop(i, alive_seq, alive_log_probs, finished_seq, finished_scores,
                                  finished_flags, states):
@@ -445,21 +518,65 @@ def beam_search(symbols_to_logits_fn,
                  dict of final decoding states)
         """
 
+        if per_example_stop:
+            # The batch elements whose best sequences are determined
+            # already, whose finished sequences are kept as they are.
+            stopped = _bound_is_met(alive_log_probs, finished_scores,
+                                    finished_flags)
+            stopped_seq = tf.concat(
+                    [finished_seq,
+                     tf.zeros([batch_size, beam_size, 1], tf.int32)], axis=2)
+            stopped_scores, stopped_flags = finished_scores, finished_flags
+
         # Each inner loop, we carry out three steps:
         # 1. Get the current topk items.
         # 2. Extract the ones that have finished and haven't finished
         # 3. Recompute the contents of finished based on scores.
-        topk_seq, topk_log_probs, topk_scores, topk_finished, states = grow_topk(
-                i, alive_seq, alive_log_probs, states)
+        (topk_seq, topk_log_probs, topk_scores, topk_finished, states,
+         topk_beam_index) = grow_topk(i, alive_seq, alive_log_probs, states)
         alive_seq, alive_log_probs, _, states = grow_alive(
-                topk_seq, topk_scores, topk_log_probs, topk_finished, states)
+                topk_seq, topk_scores, topk_log_probs, topk_finished, states,
+                topk_beam_index)
         finished_seq, finished_scores, finished_flags, _ = grow_finished(
                 finished_seq, finished_scores, finished_flags, topk_seq, topk_scores,
                 topk_finished)
 
+        if per_example_stop:
+            finished_seq = tf.where(stopped, stopped_seq, finished_seq)
+            finished_scores = tf.where(stopped, stopped_scores, finished_scores)
+            finished_flags = tf.where(stopped, stopped_flags, finished_flags)
+
         return (i + 1, alive_seq, alive_log_probs, finished_seq, finished_scores,
                         finished_flags, states)
 
+    def _bound_is_met(alive_log_probs, finished_scores, finished_in_finished):
+        """Checks, for each batch element, whether the lowest scoring item in
+        finished has a greater score than the highest prob item in alive divided
+        by the max length penalty.
+
+        Returns:
+            Bools. [batch_size]
+        """
+        max_length_penalty = tf.pow(((5. + tf.to_float(decode_length)) / 6.), alpha)
+        # The best possible score of the most likley alive sequence
+        lower_bound_alive_scores = alive_log_probs[:, 0] / max_length_penalty
+
+        # Now to compute the lowest score of a finished sequence in finished
+        # If the sequence isn't finished, we multiply it's score by 0. since
+        # scores are all -ve, taking the min will give us the score of the lowest
+        # finished item.
+        lowest_score_of_fininshed_in_finished = tf.reduce_min(
+                finished_scores * tf.to_float(finished_in_finished), axis=1)
+        # If none of the sequences have finished, then the min will be 0 and
+        # we have to replace it by -ve INF if it is. The score of any seq in alive
+        # will be much higher than -ve INF and the termination condition will not
+        # be met.
+        lowest_score_of_fininshed_in_finished += (
+                (1. - tf.to_float(tf.reduce_any(finished_in_finished, 1))) * -INF)
+
+        return tf.greater(lowest_score_of_fininshed_in_finished,
+                          lower_bound_alive_scores)
+
     def _is_finished(i, unused_alive_seq, alive_log_probs, unused_finished_seq,
                                      finished_scores, finished_in_finished, unused_states):
         """Checking termination condition.
@@ -481,26 +598,9 @@ def beam_search(symbols_to_logits_fn,
         """
         if not stop_early:
             return tf.less(i, decode_length)
-        max_length_penalty = tf.pow(((5. + tf.to_float(decode_length)) / 6.), alpha)
-        # The best possible score of the most likley alive sequence
-        lower_bound_alive_scores = alive_log_probs[:, 0] / max_length_penalty
-
-        # Now to compute the lowest score of a finished sequence in finished
-        # If the sequence isn't finished, we multiply it's score by 0. since
-        # scores are all -ve, taking the min will give us the score of the lowest
-        # finished item.
-        lowest_score_of_fininshed_in_finished = tf.reduce_min(
-                finished_scores * tf.to_float(finished_in_finished), axis=1)
-        # If none of the sequences have finished, then the min will be 0 and
-        # we have to replace it by -ve INF if it is. The score of any seq in alive
-        # will be much higher than -ve INF and the termination condition will not
-        # be met.
-        lowest_score_of_fininshed_in_finished += (
-                (1. - tf.to_float(tf.reduce_any(finished_in_finished, 1))) * -INF)
-
         bound_is_met = tf.reduce_all(
-                tf.greater(lowest_score_of_fininshed_in_finished,
-                                     lower_bound_alive_scores))
+                _bound_is_met(alive_log_probs, finished_scores,
+                              finished_in_finished))
 
         return tf.logical_and(
                 tf.less(i, decode_length), tf.logical_not(bound_is_met))
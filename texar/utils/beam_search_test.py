@@ -0,0 +1,132 @@
+"""
+Unit tests for beam search.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# pylint: disable=no-member, invalid-name
+
+import numpy as np
+
+import tensorflow as tf
+
+from texar.utils import beam_search
+
+class BeamSearchTest(tf.test.TestCase):
+    """Tests :func:`texar.utils.beam_search.beam_search`.
+    """
+
+    def setUp(self):
+        tf.test.TestCase.setUp(self)
+        self._batch_size = 3
+        self._beam_size = 4
+        self._vocab_size = 11
+        self._decode_length = 8
+        self._eos_id = 2
+
+        rng = np.random.RandomState(1)
+        dim = 6
+        self._embedding = tf.constant(
+            rng.randn(self._vocab_size, dim).astype(np.float32))
+        self._output_weights = tf.constant(
+            rng.randn(dim, self._vocab_size).astype(np.float32))
+        self._memory = tf.constant(
+            rng.randn(self._batch_size, 5, dim).astype(np.float32))
+
+    def _states(self, memory):
+        dim = self._embedding.shape[1].value
+        return {
+            'memory': memory,
+            'layer_0': {
+                'self_keys': tf.zeros([tf.shape(memory)[0], 0, dim]),
+                'memory_keys': tf.reduce_sum(memory, axis=1),
+            },
+        }
+
+    def _symbols_to_logits_fn(self, ids, step, cache):
+        """A toy decoder attending to all the decoded ids in its cache.
+        """
+        inputs = tf.nn.embedding_lookup(self._embedding, ids[:, -1])
+        layer_cache = cache['layer_0']
+        layer_cache['self_keys'] = tf.concat(
+            [layer_cache['self_keys'], tf.expand_dims(inputs, 1)], axis=1)
+        memory_outputs = tf.reduce_mean(cache['memory'], axis=1) \
+            + layer_cache['memory_keys']
+        outputs = inputs + tf.reduce_mean(layer_cache['self_keys'], axis=1)
+        # the memory may be shared by the beams of a batch element
+        dim = self._embedding.shape[1].value
+        outputs = tf.reshape(outputs, [tf.shape(memory_outputs)[0], -1, dim])
+        outputs = tf.tanh(outputs + tf.expand_dims(memory_outputs, 1))
+        outputs = tf.reshape(outputs, [-1, dim])
+        logits = tf.matmul(outputs, self._output_weights)
+        # makes the sequences finish at different steps
+        logits += tf.one_hot(self._eos_id, self._vocab_size) \
+            * tf.to_float(step) * 0.3
+        return logits, cache
+
+    def _beam_search(self, memory=None, **kwargs):
+        if memory is None:
+            memory = self._memory
+        return beam_search.beam_search(
+            self._symbols_to_logits_fn,
+            tf.fill([tf.shape(memory)[0]], 1),
+            self._beam_size,
+            self._decode_length,
+            self._vocab_size,
+            alpha=0.6,
+            eos_id=self._eos_id,
+            states=self._states(memory),
+            **kwargs)
+
+    def test_beam_invariant_states(self):
+        """Tests that states kept out of beam reordering give the same
+        results.
+        """
+        outputs, log_probs = self._beam_search()
+        outputs_inv, log_probs_inv = self._beam_search(
+            beam_invariant_keys=('memory', 'memory_keys'))
+
+        with self.test_session() as sess:
+            outputs_, log_probs_, outputs_inv_, log_probs_inv_ = sess.run(
+                [outputs, log_probs, outputs_inv, log_probs_inv])
+            self.assertEqual(outputs_.shape[:2],
+                             (self._batch_size, self._beam_size))
+            np.testing.assert_array_equal(outputs_, outputs_inv_)
+            np.testing.assert_allclose(log_probs_, log_probs_inv_, rtol=1e-5)
+
+    def test_two_stage_topk(self):
+        """Tests that the two-stage topk gives the same results.
+        """
+        outputs, log_probs = self._beam_search()
+        outputs_2, log_probs_2 = self._beam_search(two_stage_topk=True)
+
+        with self.test_session() as sess:
+            outputs_, log_probs_, outputs_2_, log_probs_2_ = sess.run(
+                [outputs, log_probs, outputs_2, log_probs_2])
+            np.testing.assert_array_equal(outputs_, outputs_2_)
+            np.testing.assert_allclose(log_probs_, log_probs_2_, rtol=1e-5)
+
+    def test_per_example_stop(self):
+        """Tests that, with `per_example_stop`, the results of each batch
+        element are those of searching it alone.
+        """
+        outputs, log_probs = self._beam_search(per_example_stop=True)
+        single_results = [self._beam_search(self._memory[idx:idx+1])
+                          for idx in range(self._batch_size)]
+
+        with self.test_session() as sess:
+            outputs_, log_probs_, single_results_ = sess.run(
+                [outputs, log_probs, single_results])
+            for idx, (single_outputs_, single_log_probs_) in \
+                    enumerate(single_results_):
+                length = single_outputs_.shape[2]
+                np.testing.assert_array_equal(
+                    outputs_[idx, :, :length], single_outputs_[0])
+                np.testing.assert_array_equal(outputs_[idx, :, length:], 0)
+                np.testing.assert_allclose(
+                    log_probs_[idx], single_log_probs_[0], rtol=1e-5)
+
+if __name__ == "__main__":
+    tf.test.main()
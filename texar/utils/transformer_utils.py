@@ -16,10 +16,18 @@ __all__ = [
     "_batching_scheme",
     "smoothing_cross_entropy",
     "prepare_template",
+    "prepare_template_np",
     "fill_template",
+    "fill_template_np",
+    "fill_template_graph",
     "generate_prediction_offsets",
     "generate_prediction_segment_ids",
-    "update_template_pack"
+    "update_template_pack",
+    "stack_answer_packs",
+    "blank_while_loop",
+    "lowest_scores_mask",
+    "generate_mask_predict_inputs",
+    "chunked_projection_loss"
 ]
 
 
@@ -206,7 +214,8 @@ def smoothing_cross_entropy(logits,
                             vocab_size,
                             confidence,
                             gaussian=False,
-                            zero_pad=True):
+                            zero_pad=True,
+                            analytic=False):
     """Cross entropy with label smoothing to limit over-confidence.
     Args:
         logits: Tensor of size [batch_size, ?, vocab_size]
@@ -220,6 +229,10 @@ def smoothing_cross_entropy(logits,
             in the smoothed labels. By setting this, we replicate the
             numeric calculation of tensor2tensor, which doesn't set the
             <BOS> token in the vocabulary.
+        analytic: computes the same loss from the log-sum-exp, the sum and
+            the true-label (and padding) logits of every position, instead
+            of building the `[batch_size, ?, vocab_size]` smoothed labels.
+            Ignored if `gaussian` is true.
     Returns:
         the cross entropy loss.
     """
@@ -230,6 +243,11 @@ def smoothing_cross_entropy(logits,
         else:
             low_confidence = (1.0 - confidence) / tf.to_float(vocab_size - 1)
 
+        if analytic and not gaussian:
+            return _analytic_smoothing_cross_entropy(
+                logits, labels, vocab_size, confidence, low_confidence,
+                zero_pad)
+
         if gaussian and confidence > 0.0:
             labels = tf.cast(labels, tf.float32)
             normal_dist = tf.distributions.Normal(loc=labels, scale=confidence)
@@ -259,34 +277,92 @@ def smoothing_cross_entropy(logits,
         logits=logits, labels=soft_targets)
 
 
-def parse_segment(lengths, masks):
-    def _parse_segment(lengths, masks):
-        """
-        mask:        [[0, 0, 0, 1, 1, 0, 0, 0, 1, 1, 0],
-                      [0, 0, 1, 1, 1, 1, 0, 0, 1, 1, 0]] <- 1 is masked out
-        segment_ids: [[0, 0, 0, 1, 1, 2, 2, 2, 3, 3, 4],
-                      [0, 0, 1, 1, 1, 1, 2, 2, 3, 3, 4]] <- start from 0
-        offsets:     [[0, 1, 2, 0, 1, 0, 1, 2, 0, 1, 0],
-                      [0, 1, 0, 1, 2, 3, 0, 1, 0, 1, 0]]
-        :param masks:
-        :return: segment_ids, offsets
-        """
-        segment_ids = np.full_like(masks, 0)
-        offsets = np.full_like(masks, 0)
-        batch_size = masks.shape[0]
-        for i in range(batch_size):
-            mask = masks[i]
-            segment_ids[i][0] = 0
-            for j in range(1, lengths[i]):
-                if mask[j] == mask[j-1]:
-                    segment_ids[i][j] = segment_ids[i][j-1]
-                    offsets[i][j] = offsets[i][j-1] + 1
-                else:
-                    segment_ids[i][j] = segment_ids[i][j-1] + 1
-                    offsets[i][j] = 0
-        return segment_ids, offsets
-
-    return tf.py_func(_parse_segment, [lengths, masks], [masks.dtype, masks.dtype])
+def _analytic_smoothing_cross_entropy(logits, labels, vocab_size, confidence,
+                                      low_confidence, zero_pad):
+    """The loss of :func:`smoothing_cross_entropy` with the smoothed labels
+    `t`, i.e., `sum_j t_j * (logsumexp(logits) - logits_j)`, expanded as
+    `sum(t) * logsumexp(logits) - sum_j t_j * logits_j`, where `t_j` is
+    `low_confidence` but for the true label, and the padding if `zero_pad`.
+    """
+    labels = tf.cast(labels, tf.int32)
+    flat_logits = tf.reshape(logits, [-1, tf.shape(logits)[-1]])
+    flat_labels = tf.reshape(labels, [-1])
+    label_logits = tf.reshape(
+        tf.gather_nd(flat_logits, tf.stack(
+            [tf.range(tf.shape(flat_labels)[0]), flat_labels], axis=1)),
+        tf.shape(labels))
+
+    # the true label gets `confidence` instead of `low_confidence`
+    target_sum = tf.to_float(vocab_size) * low_confidence + \
+        (confidence - low_confidence)
+    weighted_logits = low_confidence * tf.reduce_sum(logits, axis=-1) + \
+        (confidence - low_confidence) * label_logits
+    if zero_pad:
+        # and the padding gets zero, even if it is the true label
+        pad_confidence = tf.where(
+            tf.equal(labels, 0),
+            tf.fill(tf.shape(labels), tf.cast(confidence, logits.dtype)),
+            tf.fill(tf.shape(labels), tf.cast(low_confidence, logits.dtype)))
+        target_sum -= pad_confidence
+        weighted_logits -= pad_confidence * logits[:, :, 0]
+
+    # As in the gradient of `softmax_cross_entropy_with_logits`, i.e.,
+    # `softmax(logits) - t`, the smoothed labels are taken to sum to one,
+    # which they do not with `zero_pad`.
+    logsumexp = tf.reduce_logsumexp(logits, axis=-1)
+    return logsumexp + tf.stop_gradient((target_sum - 1.) * logsumexp) - \
+        weighted_logits
+
+
+def _parse_segment_reference(lengths, masks):
+    """
+    mask:        [[0, 0, 0, 1, 1, 0, 0, 0, 1, 1, 0],
+                  [0, 0, 1, 1, 1, 1, 0, 0, 1, 1, 0]] <- 1 is masked out
+    segment_ids: [[0, 0, 0, 1, 1, 2, 2, 2, 3, 3, 4],
+                  [0, 0, 1, 1, 1, 1, 2, 2, 3, 3, 4]] <- start from 0
+    offsets:     [[0, 1, 2, 0, 1, 0, 1, 2, 0, 1, 0],
+                  [0, 1, 0, 1, 2, 3, 0, 1, 0, 1, 0]]
+    :param masks:
+    :return: segment_ids, offsets
+    """
+    segment_ids = np.full_like(masks, 0)
+    offsets = np.full_like(masks, 0)
+    batch_size = masks.shape[0]
+    for i in range(batch_size):
+        mask = masks[i]
+        segment_ids[i][0] = 0
+        for j in range(1, lengths[i]):
+            if mask[j] == mask[j-1]:
+                segment_ids[i][j] = segment_ids[i][j-1]
+                offsets[i][j] = offsets[i][j-1] + 1
+            else:
+                segment_ids[i][j] = segment_ids[i][j-1] + 1
+                offsets[i][j] = 0
+    return segment_ids, offsets
+
+
+def _parse_segment_np(lengths, masks):
+    """Vectorized counterpart of :func:`_parse_segment_reference`. A new
+    segment starts wherever the mask value changes, so segment ids are the
+    running count of transitions and offsets the distance to the last one.
+    """
+    positions = np.arange(masks.shape[1])
+    valid = positions < np.asarray(lengths)[:, np.newaxis]
+    changed = np.zeros(masks.shape, dtype=bool)
+    changed[:, 1:] = masks[:, 1:] != masks[:, :-1]
+    changed &= valid
+    segment_ids = np.cumsum(changed, axis=1)
+    offsets = positions - np.maximum.accumulate(
+        np.where(changed, positions, 0), axis=1)
+    segment_ids[~valid] = 0
+    offsets[~valid] = 0
+    return segment_ids.astype(masks.dtype), offsets.astype(masks.dtype)
+
+
+def parse_segment(lengths, masks, in_graph=False):
+    if in_graph:
+        return _parse_segment_graph(lengths, masks)
+    return tf.py_func(_parse_segment_np, [lengths, masks], [masks.dtype, masks.dtype])
 
 
 def _pad_array_list(arrays, lens, pad_id):
@@ -347,84 +423,238 @@ def _prepare_squeezed_template(inputs, masks, start_positions, end_positions, ma
     return templates, template_masks
 
 
-def generate_equal_length_mask(inputs, lengths, mask_num, mask_len, mask_id, eoa_id, pad_id):
+def _generate_equal_length_mask_graph(inputs, lengths, blank_num, blank_length,
+                                      mask_id, boa_id, eoa_id, pad_id, seed=None):
+    """Masks `blank_num` blanks of `blank_length` tokens each, sampling the
+    blank positions of the whole batch in one draw.
+
+    The slack of each example, i.e., the number of unmasked content tokens
+    beyond the one required between two blanks, is split with stratified
+    offsets: the i-th blank is shifted by `floor((i + u_i) / blank_num *
+    (slack + 1))` with `u_i ~ U[0, 1)`, which is non-decreasing in `i`, so
+    blanks never overlap and keep the first and last tokens (`<BOS>` and
+    `<EOS>`) unmasked. Examples must hold at least
+    `blank_num * (blank_length + 1) + 1` tokens; running the returned ops on
+    a shorter example raises an `InvalidArgumentError` rather than letting
+    its blanks cover `<EOS>` or padding.
+
+    Returns the same structures as :func:`generate_dynamic_mask`, with all
+    answers of fixed shape `[batch_size, blank_length + 2]`.
     """
-    inputs and lengths are numpy arrays!
+    batch_size = tf.shape(inputs)[0]
+    max_len = tf.shape(inputs)[1]
+    lengths = tf.to_int64(lengths)
+
+    slack = lengths - 1 - blank_num * (blank_length + 1)
+    check_length = tf.assert_non_negative(
+        slack, message='Examples are too short for %d blanks of length %d'
+                       % (blank_num, blank_length))
+    with tf.control_dependencies([check_length]):
+        slack = tf.identity(slack)
+    strata = tf.random_uniform([batch_size, blank_num], dtype=tf.float64, seed=seed)
+    strata = (tf.range(blank_num, dtype=tf.float64) + strata) / blank_num
+    shifts = tf.to_int64(tf.floor(strata * tf.to_double(tf.expand_dims(slack, 1) + 1)))
+    start_positions = \
+        1 + shifts + tf.range(blank_num, dtype=tf.int64) * (blank_length + 1)
+    end_positions = start_positions + blank_length
+
+    positions = tf.range(max_len, dtype=tf.int64)[tf.newaxis, tf.newaxis, :]
+    masks = tf.logical_and(positions >= tf.expand_dims(start_positions, 2),
+                           positions < tf.expand_dims(end_positions, 2))
+    masks = tf.to_int64(tf.reduce_any(masks, axis=1))
+
+    # [batch_size, blank_num, blank_length]
+    gather_pos = tf.expand_dims(start_positions, 2) + \
+        tf.range(blank_length, dtype=tf.int64)
+    batch_ids = tf.tile(tf.reshape(tf.range(batch_size), [-1, 1, 1]),
+                        [1, blank_num, blank_length])
+    gathered = tf.gather_nd(
+        inputs, tf.stack([batch_ids, tf.to_int32(gather_pos)], axis=3))
+    boas = tf.fill([batch_size, 1], tf.cast(boa_id, tf.int64))
+    eoas = tf.fill([batch_size, 1], tf.cast(eoa_id, tf.int64))
+    answers = [tf.concat([boas, tf.to_int64(gathered[:, i]), eoas], axis=1)
+               for i in range(blank_num)]
+
+    after_pad_ans_lens = tf.fill([blank_num], tf.cast(blank_length, tf.int64))
+    true_ans_lens = tf.fill([batch_size, blank_num], tf.cast(blank_length, tf.int32))
+    templates, template_masks = _prepare_squeezed_template_graph(
+        inputs, masks, start_positions, end_positions, mask_id, pad_id)
+    return masks, answers, after_pad_ans_lens, true_ans_lens, templates, \
+           template_masks, start_positions, end_positions
+
+
+def generate_equal_length_mask(inputs, lengths, mask_num, mask_len, mask_id, eoa_id,
+                               pad_id, boa_id=None, seed=None):
+    """
+    inputs and lengths are tensors!
     mask_num = 2, having two masked out segment
-    mask_length = 2, min length of each masked out segment
+    mask_length = 2, length of each masked out segment
     inputs:[[3, 5, 4, 4, 2, 1, 3, 3, 2, 5, 1],
             [2, 1, 4, 3, 5, 1, 5, 4, 3, 1, 5]]
     mask:  [[0, 0, 0, 1, 1, 0, 0, 0, 1, 1, 0],
-            [0, 0, 1, 1, 1, 1, 0, 0, 1, 1, 0]] <- 1 is masked out
-    """
-    def _parse_answer(inputs, start_pos, end_pos, eoa_id):
-        rst = None
-        batch_size = inputs.shape[0]
-        for i in range(batch_size):
-            tmp_answer = np.append(inputs[i, start_pos[i]:end_pos[i]], eoa_id)[np.newaxis, :]
-            rst = tmp_answer if rst is None else np.concatenate((rst, tmp_answer), axis=0)
-        return rst
+            [0, 1, 1, 0, 0, 0, 0, 1, 1, 0, 0]] <- 1 is masked out
+    answers: a list of `mask_num` tensors of shape [batch_size, mask_len + 1],
+        ending with `eoa_id`, or of shape [batch_size, mask_len + 2] starting
+        with `boa_id` if it is given.
+    See :func:`_generate_equal_length_mask_graph` for the sampling scheme.
+    """
+    masks, answers, _, _, templates, template_masks, _, _ = \
+        _generate_equal_length_mask_graph(
+            inputs, lengths, mask_num, mask_len, mask_id,
+            eoa_id if boa_id is None else boa_id, eoa_id, pad_id, seed=seed)
+    if boa_id is None:
+        answers = [answer[:, 1:] for answer in answers]
+    return masks, answers, templates, template_masks
 
-    # TODO(wanrong): OUT-OF-RANGE bound check, tf.argmin(length) >= masknum * (1 + mask_length)
-    def _fill_mask(mask_not_generated, mask_length, prev_end_pos,
-                   lengths, masks, start_positions, end_positions):
-        """
-        :param mask_not_generated: number of mask not generated(excluding this one)
-        :param prev_end_pos: open range
-        :param masks:
-        :return: after loop start_positions will be of shape [max_num, batch_size]
-        """
-        cur_start_pos = np.full_like(prev_end_pos, 1)
-        batch_size = cur_start_pos.shape[0]
-        for i in range(batch_size):
-            cur_start_pos[i] = \
-                np.random.randint(prev_end_pos[i] + 1,
-                                  lengths[i] - mask_not_generated * (1 + mask_length) + 1,
-                                  size=1)
-        cur_end_pos = cur_start_pos + mask_length
-        if start_positions.size == 0:
-            start_positions = cur_start_pos[np.newaxis, :]
-            end_positions = cur_end_pos[np.newaxis, :]
-        else:
-            start_positions = \
-                np.concatenate((start_positions, cur_start_pos[np.newaxis, :]), axis=0)
-            end_positions = \
-                np.concatenate((end_positions, cur_end_pos[np.newaxis, :]), axis=0)
 
-        for i in range(batch_size):
-            masks[i, cur_start_pos[i]: cur_end_pos[i]] = 1
-        return mask_not_generated - 1, cur_end_pos, masks, start_positions, end_positions
+def _fill_dynamic_mask_reference(inputs, lengths, present_rate, boa_id,
+                                 eoa_id, pad_id, partition_num):
+    """Per-example reference implementation of the dynamic masking engine.
+    Kept for testing and benchmarking :func:`_fill_dynamic_mask_np`, which
+    produces bit-identical outputs.
+    """
+    # TODO(wanrong): bound check
+    def _get_split_pos(masked_num):
+        # split masked_num into partition_num segments
+        if masked_num <= 1:
+            return [1] * (partition_num - 1)
+
+        splitted = np.array_split(range(masked_num), partition_num)
+        split_positions = [a.size for a in splitted]
+        for i in range(1, partition_num):
+            split_positions[i] += split_positions[i - 1]
+        return np.insert(split_positions, 0, 0, axis=0)
+
+    batch_size = inputs.shape[0]
+    masked_nums = ((lengths - 2) * (1 - present_rate)).astype(np.int64)  # [batch_size]
+    split_positions = \
+        [_get_split_pos(masked_num) for masked_num in masked_nums]  # [batch_size, partition_num+1]
+
+    # calculate the length of each mask segment
+    mask_lengths = np.zeros(shape=(batch_size, partition_num), dtype=np.int64)
+    left_len = np.zeros(shape=(batch_size, partition_num + 1), dtype=np.int64)  # add a -1 at the end
+    for bid, split_position in enumerate(split_positions):
+        for idx, (prev, cur) in enumerate(zip(split_position[:-1], split_position[1:])):
+            mask_lengths[bid][idx] = cur - prev
+        left_len[bid][-1] = 0  # leave <EOS> unmasked
+        for idx, cur_len in reversed(list(enumerate(mask_lengths[bid]))):
+            left_len[bid][idx] = left_len[bid][idx+1] + cur_len + 1
+    left_len = left_len[:, :-1]  # remove last column
+
+    # splitting
+    start_positions = np.zeros(shape=(batch_size, 1))
+    end_positions = np.zeros(shape=(batch_size, 1))
+    answers = np.zeros((batch_size, 0))
+    partitions = np.array([])
+    masks = np.full_like(inputs, 0)
+    after_pad_ans_lens = np.zeros(shape=partition_num)
+    boa = np.full(shape=(batch_size, 1), fill_value=boa_id)
+    for i in range(1, partition_num + 1):
+        idx = i - 1  # ignore padding 0 in start/end_positions
+        # get start and end position for current mask
+        cur_start_pos = np.zeros(shape=(batch_size, 1), dtype=np.int64)
+        cur_end_pos = np.zeros(shape=(batch_size, 1), dtype=np.int64)
+        cur_answers = []
+        for bid in range(batch_size):
+            s = end_positions[bid][idx] + 1
+            e = lengths[bid] - left_len[bid][idx] + 1
+            cur_start_pos[bid][0] = s + (e - s) / (partition_num + 1)
+            cur_end_pos[bid][0] = cur_start_pos[bid][0] + mask_lengths[bid][idx]
+            cur_answers.append(
+                np.append(inputs[bid][cur_start_pos[bid][0]:cur_end_pos[bid][0]], eoa_id))
+            # update mask
+            for j in range(cur_start_pos[bid][0], cur_end_pos[bid][0]):
+                masks[bid][j] = 1  # set masked element to 1
+        start_positions = np.concatenate((start_positions, cur_start_pos), axis=1)
+        end_positions = np.concatenate((end_positions, cur_end_pos), axis=1)
+
+        # pad cur_answers to same length
+        cur_padded_ans, cur_max_len = _pad_array_list(cur_answers, mask_lengths[:, idx], pad_id)
+        cur_padded_ans = np.concatenate((boa, cur_padded_ans), axis=1)
+        after_pad_ans_lens[idx] = cur_max_len
+        answers = np.concatenate((answers, cur_padded_ans), axis=1)
+
+        # generate current partition index
+        cur_idx = np.full_like(cur_padded_ans[0], idx)
+        partitions = np.concatenate((partitions, cur_idx), axis=0)
+
+    return masks, start_positions[:, 1:].astype(np.int64),\
+           end_positions[:, 1:].astype(np.int64),\
+           answers.astype(np.int64), after_pad_ans_lens.astype(np.int64), \
+           mask_lengths.astype(np.int32), partitions.astype(np.int32)
+
+
+def _fill_dynamic_mask_np(inputs, lengths, present_rate, boa_id,
+                          eoa_id, pad_id, partition_num):
+    """Batch-vectorized masking engine of :func:`generate_dynamic_mask`.
 
-    mask_id = tf.Variable(mask_id, dtype=tf.int64)
-    pad_id = tf.Variable(pad_id, dtype=tf.int64)
-    eoa_id = tf.Variable(eoa_id, dtype=tf.int64)
-    mask_not_generated = tf.Variable(mask_num, dtype=tf.int64)
-    mask_length = tf.Variable(mask_len, dtype=tf.int64)
-    prev_end_pos = tf.ones_like(inputs)[:, 0]
-    start_positions = tf.Variable([], dtype=tf.int64)
-    end_positions = tf.Variable([], dtype=tf.int64)
-    masks = tf.zeros_like(inputs)
-    answers = []
-    for i in range(mask_num):
-        mask_not_generated, prev_end_pos, masks, start_positions, end_positions = \
-            tf.py_func(_fill_mask,
-                       [mask_not_generated, mask_length, prev_end_pos,
-                        lengths, masks, start_positions, end_positions],
-                       [tf.int64, tf.int64, prev_end_pos.dtype, tf.int64,
-                        tf.int64])
-        cur_answer = tf.py_func(_parse_answer,
-                                [inputs, prev_end_pos - mask_length, prev_end_pos, eoa_id],
-                                inputs.dtype)
-        answers.append(cur_answer)
+    Every quantity is computed with whole-batch array operations; the only
+    Python loop left runs over the `partition_num` blanks, since the start
+    of a blank depends on the end of the previous one.
 
-    templates, template_masks = \
-        _prepare_squeezed_template(inputs, masks, tf.transpose(start_positions, perm=[1, 0]),
-                                   tf.transpose(end_positions, perm=[1, 0]), mask_id, pad_id)
-    return masks, answers, templates, template_masks
+    :param inputs: [batch_size, max_seq_len]
+    :param lengths: [batch_size]
+    :return: masks, start_positions, end_positions, answers,
+        after_pad_ans_lens, true_ans_lens, partitions. See
+        :func:`_fill_dynamic_mask_reference` for the semantics.
+    """
+    batch_size, max_seq_len = inputs.shape
+    batch_ids = np.arange(batch_size)
+    blank_ids = np.arange(partition_num)
+    masked_nums = ((lengths - 2) * (1 - present_rate)).astype(np.int64)  # [batch_size]
+
+    # split masked_nums into partition_num segments as `np.array_split` does:
+    # the first `masked_num % partition_num` segments get one more token
+    mask_lengths = masked_nums[:, np.newaxis] // partition_num + \
+        (blank_ids < masked_nums[:, np.newaxis] % partition_num)
+    mask_lengths[masked_nums <= 1] = 0  # [batch_size, partition_num]
+
+    # tokens left to the right of each mask segment, <EOS> unmasked
+    left_len = np.cumsum((mask_lengths + 1)[:, ::-1], axis=1)[:, ::-1]
+
+    start_positions = np.zeros((batch_size, partition_num), dtype=np.int64)
+    end_positions = np.zeros((batch_size, partition_num), dtype=np.int64)
+    prev_end_pos = np.zeros(batch_size)
+    answers, ans_lens = [], []
+    for idx in range(partition_num):
+        s = prev_end_pos + 1
+        e = lengths - left_len[:, idx] + 1
+        start_positions[:, idx] = s + (e - s) / (partition_num + 1)
+        end_positions[:, idx] = start_positions[:, idx] + mask_lengths[:, idx]
+        prev_end_pos = end_positions[:, idx]
+
+        # [<BOA>, answer, <EOA>, <PAD>...], padded to the longest answer
+        max_len = np.amax(mask_lengths[:, idx])
+        steps = np.arange(max_len + 1)
+        positions = np.clip(start_positions[:, idx, np.newaxis] + steps,
+                            0, max_seq_len - 1)
+        cur_lengths = mask_lengths[:, idx, np.newaxis]
+        cur_answers = np.where(steps < cur_lengths,
+                               inputs[batch_ids[:, np.newaxis], positions],
+                               np.where(steps == cur_lengths, eoa_id, pad_id))
+        answers.append(np.full((batch_size, 1), boa_id, dtype=np.int64))
+        answers.append(cur_answers.astype(np.int64))
+        ans_lens.append(max_len)
+
+    # a +1/-1 at each blank boundary, whose running sum marks masked tokens
+    boundaries = np.zeros((batch_size, max_seq_len + 1), dtype=np.int64)
+    np.add.at(boundaries, (batch_ids[:, np.newaxis], start_positions), 1)
+    np.add.at(boundaries, (batch_ids[:, np.newaxis], end_positions), -1)
+    masks = (np.cumsum(boundaries, axis=1)[:, :-1] > 0).astype(inputs.dtype)
+
+    after_pad_ans_lens = np.array(ans_lens, dtype=np.int64)
+    partitions = np.repeat(blank_ids, after_pad_ans_lens + 2)
+    return masks, start_positions, end_positions, \
+           np.concatenate(answers, axis=1), after_pad_ans_lens, \
+           mask_lengths.astype(np.int32), partitions.astype(np.int32)
 
 
 def generate_dynamic_mask(inputs, lengths, present_rate, mask_id, boa_id,
-                          eoa_id, pad_id, partition_num):
+                          eoa_id, pad_id, partition_num, in_graph=False):
+    if in_graph:
+        return _generate_dynamic_mask_graph(inputs, lengths, present_rate, mask_id,
+                                            boa_id, eoa_id, pad_id, partition_num)
+
     def _fill_mask(inputs, lengths, present_rate, eoa_id, pad_id, partition_num):
         """
         The input batch has the same mask pattern, randoms through max_seq_length in lengths.
@@ -435,75 +665,8 @@ def generate_dynamic_mask(inputs, lengths, present_rate, mask_id, boa_id,
         start_pos and end_pos marks out ranges for answers
         """
         def _fill_mask_py_func(inputs, lengths, present_rate, eoa_id, pad_id, partition_num):
-            # TODO(wanrong): bound check
-            def _get_split_pos(masked_num):
-                # split masked_num into partition_num segments
-                if masked_num <= 1:
-                    return [1] * (partition_num - 1)
-
-                splitted = np.array_split(range(masked_num), partition_num)
-                split_positions = [a.size for a in splitted]
-                for i in range(1, partition_num):
-                    split_positions[i] += split_positions[i - 1]
-                return np.insert(split_positions, 0, 0, axis=0)
-
-            batch_size = inputs.shape[0]
-            masked_nums = ((lengths - 2) * (1 - present_rate)).astype(np.int64)  # [batch_size]
-            split_positions = \
-                [_get_split_pos(masked_num) for masked_num in masked_nums]  # [batch_size, partition_num+1]
-
-            # calculate the length of each mask segment
-            mask_lengths = np.zeros(shape=(batch_size, partition_num), dtype=np.int64)
-            left_len = np.zeros(shape=(batch_size, partition_num + 1), dtype=np.int64)  # add a -1 at the end
-            for bid, split_position in enumerate(split_positions):
-                for idx, (prev, cur) in enumerate(zip(split_position[:-1], split_position[1:])):
-                    mask_lengths[bid][idx] = cur - prev
-                left_len[bid][-1] = 0  # leave <EOS> unmasked
-                for idx, cur_len in reversed(list(enumerate(mask_lengths[bid]))):
-                    left_len[bid][idx] = left_len[bid][idx+1] + cur_len + 1
-            left_len = left_len[:, :-1]  # remove last column
-
-            # splitting
-            start_positions = np.zeros(shape=(batch_size, 1))
-            end_positions = np.zeros(shape=(batch_size, 1))
-            answers = np.zeros((batch_size, 0))
-            partitions = np.array([])
-            masks = np.full_like(inputs, 0)
-            after_pad_ans_lens = np.zeros(shape=partition_num)
-            boa = np.full(shape=(batch_size, 1), fill_value=boa_id)
-            for i in range(1, partition_num + 1):
-                idx = i - 1  # ignore padding 0 in start/end_positions
-                # get start and end position for current mask
-                cur_start_pos = np.zeros(shape=(batch_size, 1), dtype=np.int64)
-                cur_end_pos = np.zeros(shape=(batch_size, 1), dtype=np.int64)
-                cur_answers = []
-                for bid in range(batch_size):
-                    s = end_positions[bid][idx] + 1
-                    e = lengths[bid] - left_len[bid][idx] + 1
-                    cur_start_pos[bid][0] = s + (e - s) / (partition_num + 1)
-                    cur_end_pos[bid][0] = cur_start_pos[bid][0] + mask_lengths[bid][idx]
-                    cur_answers.append(
-                        np.append(inputs[bid][cur_start_pos[bid][0]:cur_end_pos[bid][0]], eoa_id))
-                    # update mask
-                    for j in range(cur_start_pos[bid][0], cur_end_pos[bid][0]):
-                        masks[bid][j] = 1  # set masked element to 1
-                start_positions = np.concatenate((start_positions, cur_start_pos), axis=1)
-                end_positions = np.concatenate((end_positions, cur_end_pos), axis=1)
-
-                # pad cur_answers to same length
-                cur_padded_ans, cur_max_len = _pad_array_list(cur_answers, mask_lengths[:, idx], pad_id)
-                cur_padded_ans = np.concatenate((boa, cur_padded_ans), axis=1)
-                after_pad_ans_lens[idx] = cur_max_len
-                answers = np.concatenate((answers, cur_padded_ans), axis=1)
-
-                # generate current partition index
-                cur_idx = np.full_like(cur_padded_ans[0], idx)
-                partitions = np.concatenate((partitions, cur_idx), axis=0)
-
-            return masks, start_positions[:, 1:].astype(np.int64),\
-                   end_positions[:, 1:].astype(np.int64),\
-                   answers.astype(np.int64), after_pad_ans_lens.astype(np.int64), \
-                   mask_lengths.astype(np.int32), partitions.astype(np.int32)
+            return _fill_dynamic_mask_np(inputs, lengths, present_rate, boa_id,
+                                         eoa_id, pad_id, partition_num)
 
         eoa_id = tf.Variable(eoa_id, dtype=tf.int64)
         present_rate = tf.Variable(present_rate, dtype=tf.float32)
@@ -528,11 +691,13 @@ def generate_dynamic_mask(inputs, lengths, present_rate, mask_id, boa_id,
 
 
 def generate_prediction_offsets(inputs, max_length):
+    """Offsets of an all-unmasked sequence, i.e., `range(max_length)` for
+    every example.
+    """
     batch_size = tf.shape(inputs)[0]
     max_length = tf.cast(max_length, dtype=tf.int32)
-    _, offsets = parse_segment(tf.fill([batch_size], max_length),
-                               tf.fill([batch_size, max_length], 0))
-    return tf.cast(offsets, dtype=tf.int64)
+    offsets = tf.expand_dims(tf.range(max_length, dtype=tf.int64), 0)
+    return tf.tile(offsets, tf.stack([batch_size, 1]))
 
 
 def generate_prediction_segment_ids(inputs, segment_id, max_length):
@@ -559,7 +724,143 @@ def _get_start_end_pos(mask_by_word, mask_id):
                       [tf.int64, tf.int64])
 
 
-def prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id):
+def _parse_segment_graph(lengths, masks):
+    """Native-op counterpart of :func:`parse_segment`: a new segment starts
+    wherever the mask value changes, and offsets count from that start.
+    """
+    batch_size = tf.shape(masks)[0]
+    max_len = tf.shape(masks)[1]
+    valid = tf.sequence_mask(lengths, max_len)
+    changed = tf.concat(
+        [tf.zeros([batch_size, 1], dtype=tf.bool),
+         tf.not_equal(masks[:, 1:], masks[:, :-1])], axis=1)
+    segment_ids = tf.cumsum(tf.to_int32(tf.logical_and(changed, valid)), axis=1)
+    positions = tf.tile(tf.expand_dims(tf.range(max_len), 0), [batch_size, 1])
+    flat_ids = segment_ids + tf.expand_dims(tf.range(batch_size) * max_len, 1)
+    segment_starts = tf.unsorted_segment_min(
+        tf.reshape(positions, [-1]), tf.reshape(flat_ids, [-1]),
+        batch_size * max_len)
+    offsets = positions - tf.gather(segment_starts, flat_ids)
+    zeros = tf.zeros_like(segment_ids)
+    segment_ids = tf.where(valid, segment_ids, zeros)
+    offsets = tf.where(valid, offsets, zeros)
+    return tf.cast(segment_ids, masks.dtype), tf.cast(offsets, masks.dtype)
+
+
+def _prepare_squeezed_template_graph(inputs, masks, start_positions,
+                                     end_positions, mask_id, pad_id):
+    """Native-op counterpart of :func:`_prepare_squeezed_template`. Every
+    blank [start, end) is replaced by a single `mask_id`, and the kept
+    tokens are scattered to their shifted positions.
+    """
+    batch_size = tf.shape(inputs)[0]
+    positions = tf.range(tf.shape(inputs)[1], dtype=tf.int64)
+    starts = tf.expand_dims(start_positions, 2)  # [batch_size, blank_num, 1]
+    ends = tf.expand_dims(end_positions, 2)
+    blank_lens = end_positions - start_positions
+    in_blank = tf.logical_and(positions >= starts, positions < ends)
+    kept = tf.logical_not(tf.reduce_any(in_blank, axis=1))
+    removed_before = tf.reduce_sum(
+        tf.minimum(tf.maximum(positions - starts, 0), ends - starts), axis=1)
+    blanks_before = tf.reduce_sum(tf.to_int64(starts <= positions), axis=1)
+    new_positions = positions - removed_before + blanks_before
+
+    kept_coords = tf.where(kept)
+    kept_indices = tf.stack(
+        [kept_coords[:, 0], tf.gather_nd(new_positions, kept_coords)], axis=1)
+    blank_num = tf.shape(start_positions)[1]
+    mask_positions = start_positions - tf.cumsum(blank_lens, axis=1, exclusive=True) \
+        + tf.range(blank_num, dtype=tf.int64)
+    batch_ids = tf.tile(tf.expand_dims(tf.range(tf.to_int64(batch_size)), 1),
+                        [1, blank_num])
+    mask_indices = tf.reshape(tf.stack([batch_ids, mask_positions], axis=2), [-1, 2])
+    indices = tf.concat([kept_indices, mask_indices], axis=0)
+
+    template_lengths = tf.to_int64(tf.shape(inputs)[1]) \
+        - tf.reduce_sum(blank_lens, axis=1) + tf.to_int64(blank_num)
+    shape = tf.stack([tf.to_int64(batch_size), tf.reduce_max(template_lengths)])
+    valid = tf.sequence_mask(template_lengths, shape[1])
+    paddings = tf.fill(tf.to_int32(shape), tf.cast(pad_id, tf.int64))
+    mask_values = tf.fill([batch_size * blank_num], tf.cast(mask_id, tf.int64))
+    templates = tf.scatter_nd(
+        indices, tf.concat([tf.gather_nd(inputs, kept_coords), mask_values], 0),
+        shape)
+    template_masks = tf.scatter_nd(
+        indices, tf.concat([tf.gather_nd(masks, kept_coords),
+                            tf.ones_like(mask_values)], 0),
+        shape)
+    return tf.where(valid, templates, paddings), \
+        tf.where(valid, template_masks, paddings)
+
+
+def _generate_dynamic_mask_graph(inputs, lengths, present_rate, mask_id,
+                                 boa_id, eoa_id, pad_id, partition_num):
+    """Native-op counterpart of :func:`generate_dynamic_mask`; follows the
+    arithmetic of :func:`_fill_dynamic_mask_np` step by step so that both
+    paths produce the same blanks.
+    """
+    batch_size = tf.shape(inputs)[0]
+    max_len = tf.shape(inputs)[1]
+    lengths = tf.to_int64(lengths)
+    masked_nums = tf.to_double(lengths - 2) * \
+        tf.to_double(1. - tf.to_float(present_rate))
+    masked_nums = tf.to_int64(masked_nums)
+
+    blank_ids = tf.range(partition_num, dtype=tf.int64)
+    masked_nums_ = tf.expand_dims(masked_nums, 1)
+    mask_lengths = masked_nums_ // partition_num + tf.to_int64(
+        blank_ids < masked_nums_ % partition_num)
+    mask_lengths = tf.where(
+        tf.tile(masked_nums_ <= 1, [1, partition_num]),
+        tf.zeros_like(mask_lengths), mask_lengths)
+    left_lens = tf.cumsum(mask_lengths + 1, axis=1, reverse=True)
+
+    batch_ids = tf.expand_dims(tf.range(batch_size), 1)
+    positions = tf.range(max_len, dtype=tf.int64)
+    prev_end = tf.zeros([batch_size], dtype=tf.float64)
+    masks = tf.zeros([batch_size, max_len], dtype=tf.bool)
+    answers, start_positions, end_positions, ans_lens = [], [], [], []
+    for i in range(partition_num):
+        start = prev_end + 1.
+        end = tf.to_double(lengths - left_lens[:, i] + 1)
+        start = tf.to_int64(start + (end - start) / (partition_num + 1))
+        mask_len = mask_lengths[:, i]
+        end = start + mask_len
+        prev_end = tf.to_double(end)
+        start_positions.append(start)
+        end_positions.append(end)
+        masks = tf.logical_or(masks, tf.logical_and(
+            positions >= tf.expand_dims(start, 1),
+            positions < tf.expand_dims(end, 1)))
+
+        ans_len = tf.reduce_max(mask_len)
+        ans_lens.append(ans_len)
+        width = tf.to_int32(ans_len) + 1
+        steps = tf.tile(tf.expand_dims(tf.range(ans_len + 1), 0), [batch_size, 1])
+        gather_pos = tf.clip_by_value(
+            tf.expand_dims(start, 1) + steps, 0, tf.to_int64(max_len) - 1)
+        gathered = tf.gather_nd(inputs, tf.stack(
+            [tf.tile(batch_ids, [1, width]), tf.to_int32(gather_pos)], axis=2))
+        mask_len_ = tf.tile(tf.expand_dims(mask_len, 1), [1, width])
+        answer = tf.where(
+            steps < mask_len_, gathered,
+            tf.where(tf.equal(steps, mask_len_),
+                     tf.fill(tf.shape(gathered), tf.cast(eoa_id, tf.int64)),
+                     tf.fill(tf.shape(gathered), tf.cast(pad_id, tf.int64))))
+        answers.append(tf.concat(
+            [tf.fill([batch_size, 1], tf.cast(boa_id, tf.int64)), answer], axis=1))
+
+    masks = tf.to_int64(masks)
+    start_positions = tf.stack(start_positions, axis=1)
+    end_positions = tf.stack(end_positions, axis=1)
+    templates, template_masks = _prepare_squeezed_template_graph(
+        inputs, masks, start_positions, end_positions, mask_id, pad_id)
+    return masks, answers, tf.stack(ans_lens), tf.to_int32(mask_lengths), \
+           templates, template_masks, start_positions, end_positions
+
+
+def prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id,
+                     in_graph=False):
     """
     mask_id = 7
     pad_id = 6
@@ -572,18 +873,32 @@ def prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id):
                     [[2, 5], [3, 1]]] <- used as decode outputs(targets) in training
     :param masked_inputs:
     :param mask_id:
+    :param in_graph: build the templates with native TF ops only, instead of
+        `tf.py_func` callbacks, so that the graph can be serialized and placed
+        on any device.
+    :param args: holds `present_rate` and `blank_num`. If `args.mask_strategy`
+        is `"equal_length"`, blanks instead hold `args.blank_length` tokens
+        each, see :func:`generate_equal_length_mask`; `present_rate` is then
+        unused and the answers have a fixed shape.
     :return: masked_inputs, segment_ids, answers
     """
     inputs = data_batch['text_ids']
     lengths = data_batch['length']
-    masks, answers, after_pad_ans_lens, true_ans_lens, templates, template_masks,\
-        start_positions, end_positions = \
-        generate_dynamic_mask(inputs, lengths, args.present_rate, mask_id, boa_id,
-                              eoa_id, pad_id, args.blank_num)
+    if getattr(args, 'mask_strategy', 'random') == 'equal_length':
+        masks, answers, after_pad_ans_lens, true_ans_lens, templates, template_masks,\
+            start_positions, end_positions = \
+            _generate_equal_length_mask_graph(inputs, lengths, args.blank_num,
+                                              args.blank_length, mask_id, boa_id,
+                                              eoa_id, pad_id)
+    else:
+        masks, answers, after_pad_ans_lens, true_ans_lens, templates, template_masks,\
+            start_positions, end_positions = \
+            generate_dynamic_mask(inputs, lengths, args.present_rate, mask_id, boa_id,
+                                  eoa_id, pad_id, args.blank_num, in_graph=in_graph)
 
     template_lengths = tf.fill(tf.shape(lengths), tf.shape(templates)[1])
     template_segment_ids, template_offsets = \
-        parse_segment(template_lengths, template_masks)
+        parse_segment(template_lengths, template_masks, in_graph=in_graph)
     all_masked_out = tf.cast(tf.fill(tf.shape(inputs), mask_id), dtype=tf.int64)
     masked_inputs = tf.where(tf.equal(masks, tf.ones_like(inputs)),
                              all_masked_out, inputs)
@@ -615,6 +930,49 @@ def prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id):
     return template_pack, answer_packs
 
 
+def prepare_template_np(inputs, lengths, present_rate, blank_num,
+                        mask_id, boa_id, eoa_id, pad_id):
+    """NumPy counterpart of :func:`prepare_template`, for building the packs
+    offline. Takes a batch of `text_ids` and `length` as arrays and returns
+    `template_pack` and `answer_packs` holding the same arrays that
+    :func:`prepare_template` evaluates to.
+    """
+    masks, start_positions, end_positions, answers, after_pad_ans_lens, \
+        true_ans_lens, _ = _fill_dynamic_mask_np(
+            inputs, lengths, np.float32(present_rate), boa_id, eoa_id, pad_id,
+            blank_num)
+    templates, template_masks = _parse_template(
+        inputs, masks, start_positions, end_positions, mask_id, pad_id)
+    templates = templates.astype(np.int64).reshape(inputs.shape[0], -1)
+    template_masks = template_masks.astype(np.int64).reshape(inputs.shape[0], -1)
+    template_lengths = np.full(lengths.shape, templates.shape[1], dtype=np.int32)
+    template_segment_ids, template_offsets = \
+        _parse_segment_np(template_lengths, template_masks)
+    template_pack = {
+        'masks': masks,
+        'text_ids': np.where(masks == 1, mask_id, inputs).astype(np.int64),
+        'segment_ids': template_segment_ids,
+        'offsets': template_offsets,
+        'templates': templates,
+        'start_positions': start_positions,
+        'end_positions': end_positions,
+        'template_lengths': template_lengths
+    }
+
+    answer_packs = []
+    split_positions = np.cumsum(after_pad_ans_lens + 2)[:-1]
+    for idx, answer in enumerate(np.split(answers, split_positions, axis=1)):
+        mask_len = answer.shape[1]
+        answer_packs.append({
+            'text_ids': answer,
+            'segment_ids': np.full(answer.shape, idx * 2 + 1, dtype=np.int64),
+            'offsets': np.tile(np.arange(mask_len, dtype=np.int64), (answer.shape[0], 1)),
+            'lengths': true_ans_lens[:, idx]
+        })
+
+    return template_pack, answer_packs
+
+
 def _split_template(template, mask_start_positions, mask_end_positions):
     """
     template: [3, 5, 4, 7, 7, 1, 3, 3, 7, 7, 1]
@@ -664,7 +1022,7 @@ def _merge_segments(template_segments, fillings, eoa_id, pad_id, eos_id):
     return rst
 
 
-def fill_template(template_pack, predictions, eoa_id, pad_id, eos_id):
+def _fill_template_reference(template_pack, predictions, eoa_id, pad_id, eos_id):
     """
     :param template: [batch_size, max_seq_len]
     :param mask: [batch_size, max_seq_len]
@@ -697,7 +1055,131 @@ def fill_template(template_pack, predictions, eoa_id, pad_id, eos_id):
     return rst
 
 
-def update_template_pack(template_pack, filling, mask_id, eoa_id, pad_id):
+def fill_template_np(template_pack, predictions, eoa_id, pad_id, eos_id):
+    """Fills the blanks of the templates with the predictions, with whole-batch
+    array operations.
+
+    Each prediction is cut at its first `eoa_id` or `eos_id`, and its
+    `pad_id` tokens are dropped. Every kept token is then written to its
+    output position, computed from running counts of the kept template and
+    filling tokens before it.
+
+    :param template_pack: a template pack evaluated to numpy arrays.
+    :param predictions: a list of `[batch_size, unfixed_len]` arrays, one
+        for each blank.
+    :return: filled: `[batch_size, max_filled_len]`, padded with `pad_id`;
+        lengths: `[batch_size]`.
+    """
+    templates = np.asarray(template_pack['text_ids'])
+    start_positions = np.asarray(template_pack['start_positions'])
+    end_positions = np.asarray(template_pack['end_positions'])
+    batch_size, max_len = templates.shape
+    batch_ids = np.arange(batch_size)[:, np.newaxis]
+    fill_num = len(predictions)
+    assert fill_num in [start_positions.shape[1], start_positions.shape[1] + 1]
+
+    positions = np.arange(max_len)
+    kept = ~np.any((positions >= start_positions[:, :, np.newaxis]) &
+                   (positions < end_positions[:, :, np.newaxis]), axis=1)
+    kept_cnt = np.concatenate([np.zeros((batch_size, 1), dtype=np.int64),
+                               np.cumsum(kept, axis=1)], axis=1)
+    # filling i goes right after the template segment ending at fill_pos[:, i]
+    fill_pos = np.concatenate([start_positions, np.full((batch_size, 1), max_len)],
+                              axis=1)[:, :fill_num]
+
+    fill_kept = []
+    for prediction in predictions:
+        prediction = np.asarray(prediction)
+        stopped = np.cumsum((prediction == eoa_id) | (prediction == eos_id), axis=1) > 0
+        fill_kept.append(~stopped & (prediction != pad_id))
+    fill_lens = np.stack([kept_.sum(axis=1) for kept_ in fill_kept], axis=1)
+    fills_before = np.cumsum(fill_lens, axis=1) - fill_lens
+
+    lengths = kept_cnt[:, -1] + fill_lens.sum(axis=1)
+    filled = np.full((batch_size, np.amax(lengths)), pad_id, dtype=templates.dtype)
+    template_dest = kept_cnt[:, :-1] + np.sum(
+        fill_lens[:, :, np.newaxis] * (fill_pos[:, :, np.newaxis] <= positions), axis=1)
+    filled[np.broadcast_to(batch_ids, kept.shape)[kept], template_dest[kept]] = \
+        templates[kept]
+    for idx, (prediction, kept_) in enumerate(zip(predictions, fill_kept)):
+        dest = kept_cnt[batch_ids[:, 0], fill_pos[:, idx]] + fills_before[:, idx]
+        dest = dest[:, np.newaxis] + np.cumsum(kept_, axis=1) - kept_
+        filled[np.broadcast_to(batch_ids, kept_.shape)[kept_], dest[kept_]] = \
+            np.asarray(prediction)[kept_]
+    return filled, lengths
+
+
+def fill_template_graph(template_pack, predictions, eoa_id, pad_id, eos_id):
+    """In-graph counterpart of :func:`fill_template_np`, taking a template
+    pack and predictions as tensors.
+
+    :return: filled: `[batch_size, max_filled_len]`, padded with `pad_id`;
+        lengths: `[batch_size]`.
+    """
+    templates = template_pack['text_ids']
+    start_positions = template_pack['start_positions']
+    end_positions = template_pack['end_positions']
+    batch_size = tf.shape(templates)[0]
+    max_len = tf.to_int64(tf.shape(templates)[1])
+    fill_num = len(predictions)
+
+    positions = tf.range(max_len)
+    kept = tf.logical_not(tf.reduce_any(tf.logical_and(
+        positions >= tf.expand_dims(start_positions, 2),
+        positions < tf.expand_dims(end_positions, 2)), axis=1))
+    kept_ = tf.to_int64(kept)
+    kept_cnt = tf.cumsum(kept_, axis=1, exclusive=True)
+    total_kept = tf.reduce_sum(kept_, axis=1)
+    fill_pos = tf.concat([start_positions, tf.fill([batch_size, 1], max_len)],
+                         axis=1)[:, :fill_num]
+
+    fill_kept = []
+    for prediction in predictions:
+        stop = tf.logical_or(tf.equal(prediction, tf.cast(eoa_id, prediction.dtype)),
+                             tf.equal(prediction, tf.cast(eos_id, prediction.dtype)))
+        stopped = tf.cumsum(tf.to_int32(stop), axis=1) > 0
+        fill_kept.append(tf.logical_and(
+            tf.logical_not(stopped),
+            tf.not_equal(prediction, tf.cast(pad_id, prediction.dtype))))
+    fill_lens = tf.stack([tf.reduce_sum(tf.to_int64(kept_), axis=1)
+                          for kept_ in fill_kept], axis=1)
+    fills_before = tf.cumsum(fill_lens, axis=1, exclusive=True)
+    lengths = total_kept + tf.reduce_sum(fill_lens, axis=1)
+
+    template_dest = kept_cnt + tf.reduce_sum(
+        tf.expand_dims(fill_lens, 2) *
+        tf.to_int64(tf.expand_dims(fill_pos, 2) <= positions), axis=1)
+    coords = tf.where(kept)
+    indices = [tf.stack([coords[:, 0], tf.gather_nd(template_dest, coords)], axis=1)]
+    values = [tf.gather_nd(templates, coords)]
+    kept_cnt = tf.concat([kept_cnt, tf.expand_dims(total_kept, 1)], axis=1)
+    for idx, (prediction, kept_) in enumerate(zip(predictions, fill_kept)):
+        dest = _batch_gather(kept_cnt, fill_pos[:, idx:idx + 1]) + fills_before[:, idx:idx + 1]
+        dest += tf.cumsum(tf.to_int64(kept_), axis=1, exclusive=True)
+        coords = tf.where(kept_)
+        indices.append(tf.stack([coords[:, 0], tf.gather_nd(dest, coords)], axis=1))
+        values.append(tf.cast(tf.gather_nd(prediction, coords), templates.dtype))
+
+    width = tf.reduce_max(lengths)
+    filled = tf.scatter_nd(tf.concat(indices, axis=0), tf.concat(values, axis=0),
+                           tf.stack([tf.to_int64(batch_size), width]))
+    paddings = tf.fill(tf.shape(filled), tf.cast(pad_id, templates.dtype))
+    filled = tf.where(tf.sequence_mask(lengths, width), filled, paddings)
+    return filled, lengths
+
+
+def fill_template(template_pack, predictions, eoa_id, pad_id, eos_id):
+    """
+    :param template: [batch_size, max_seq_len]
+    :param mask: [batch_size, max_seq_len]
+    :param predictions: a list of tensors
+    :return: a list of filled sequences, see :func:`fill_template_np`
+    """
+    filled, lengths = fill_template_np(template_pack, predictions, eoa_id, pad_id, eos_id)
+    return [ids[:length].tolist() for ids, length in zip(filled, lengths)]
+
+
+def _update_template_pack_reference(template_pack, filling, mask_id, eoa_id, pad_id):
     def _fill_segment(masked_by_word_template, filling, start_pos, end_pos, eoa_id, pad_id):
         def _fill_segment_py_func(masked_by_word_templates, fillings, start_pos, end_pos, eoa_id, pad_id):
             masked_by_word_templates = masked_by_word_templates.tolist()
@@ -743,4 +1225,336 @@ def update_template_pack(template_pack, filling, mask_id, eoa_id, pad_id):
         'masks': masks,
         'template_lengths': template_lengths
     }
-    return return_pack
\ No newline at end of file
+    return return_pack
+
+
+def _batch_gather(params, indices):
+    """Gathers `params[b, indices[b, j]]` into `[batch_size, width]`."""
+    batch_ids = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                        tf.stack([1, tf.shape(indices)[1]]))
+    return tf.gather_nd(params, tf.stack([batch_ids, tf.to_int32(indices)], axis=2))
+
+
+def _splice_graph(values, fillings, start_pos, end_pos, fill_lens, width):
+    """Replaces `values[b, start_pos[b]:end_pos[b]]` with
+    `fillings[b, :fill_lens[b]]` by index arithmetic, writing each row into a
+    buffer of `width` positions.
+
+    :return: the spliced buffer, whose positions past the end of a row hold
+        arbitrary values of that row, and the row lengths.
+    """
+    batch_size = tf.shape(values)[0]
+    positions = tf.tile(tf.expand_dims(tf.range(width, dtype=tf.int64), 0),
+                        tf.stack([batch_size, 1]))
+    start_pos = tf.expand_dims(start_pos, 1)
+    shifts = fill_lens - (end_pos - start_pos[:, 0])
+    src = tf.where(positions < start_pos, positions,
+                   positions - tf.expand_dims(shifts, 1))
+    src = tf.clip_by_value(src, 0, tf.to_int64(tf.shape(values)[1]) - 1)
+    src_fill = tf.clip_by_value(positions - start_pos, 0,
+                                tf.to_int64(tf.shape(fillings)[1]) - 1)
+    in_filling = tf.logical_and(positions >= start_pos,
+                                positions < start_pos + tf.expand_dims(fill_lens, 1))
+    rst = tf.where(in_filling,
+                   _batch_gather(tf.cast(fillings, values.dtype), src_fill),
+                   _batch_gather(values, src))
+    lengths = tf.to_int64(tf.shape(values)[1]) + shifts
+    return rst, lengths
+
+
+def update_template_pack(template_pack, filling, mask_id, eoa_id, pad_id,
+                         capacity=None):
+    """Fills the first blank by splicing the filling into both `text_ids` and
+    the squeezed `templates`, and shifts the positions of the remaining
+    blanks by the change in length, so nothing is rescanned for mask
+    tokens. Segment ids and offsets are then derived from the new template
+    masks with :func:`_parse_segment_graph`.
+
+    The result equals that of :func:`_update_template_pack_reference`, which
+    re-derives the pack from the spliced text with `tf.py_func`. If
+    `capacity` is given, `text_ids` and `templates` are written into buffers
+    of that many positions instead of the tightest width, as if the text
+    were padded to `capacity`. This gives them a static width, e.g., for
+    use in a `tf.while_loop`.
+    """
+    text_ids = template_pack['text_ids']
+    templates = template_pack['templates']
+    start_positions = template_pack['start_positions']
+    end_positions = template_pack['end_positions']
+    batch_size = tf.shape(text_ids)[0]
+    text_width = tf.to_int64(tf.shape(text_ids)[1])
+    blank_num = tf.to_int64(tf.shape(start_positions)[1])
+
+    filling = tf.cast(filling, text_ids.dtype)
+    is_eoa = tf.equal(filling, tf.cast(eoa_id, filling.dtype))
+    fill_lens = tf.where(
+        tf.reduce_any(is_eoa, axis=1),
+        tf.argmax(tf.to_int32(is_eoa), axis=1),
+        tf.fill([batch_size], tf.to_int64(tf.shape(filling)[1])))
+    start, end = start_positions[:, 0], end_positions[:, 0]
+    shifts = tf.expand_dims(fill_lens - (end - start), 1)
+
+    # text_ids: splice, pad the shorter rows with `pad_id`
+    text_lengths = text_width + shifts[:, 0]
+    new_text_width = tf.reduce_max(text_lengths) if capacity is None \
+        else tf.constant(capacity, dtype=tf.int64)
+    positions = tf.tile(tf.expand_dims(tf.range(new_text_width), 0),
+                        tf.stack([batch_size, 1]))
+    new_text_ids, _ = _splice_graph(text_ids, filling, start, end, fill_lens,
+                                    new_text_width)
+    paddings = tf.fill(tf.shape(new_text_ids), tf.cast(pad_id, text_ids.dtype))
+    new_text_ids = tf.where(positions < tf.expand_dims(text_lengths, 1),
+                            new_text_ids, paddings)
+
+    start_positions = start_positions[:, 1:] + shifts
+    end_positions = end_positions[:, 1:] + shifts
+    masks = tf.reduce_any(tf.logical_and(
+        tf.expand_dims(positions, 1) >= tf.expand_dims(start_positions, 2),
+        tf.expand_dims(positions, 1) < tf.expand_dims(end_positions, 2)), axis=1)
+    masks = tf.to_int64(masks)
+
+    # templates: the first blank is the mask token at `start`. Each row is
+    # followed by the padding of its text, whose template mask is 0, and
+    # then by `pad_id`
+    blank_lens = end_positions - start_positions
+    content_lengths = text_width - (end - start) - tf.reduce_sum(blank_lens, axis=1) \
+        + blank_num - 1 + fill_lens
+    template_lengths_ = new_text_width - tf.reduce_sum(blank_lens, axis=1) \
+        + blank_num - 1
+    template_width = tf.reduce_max(template_lengths_) if capacity is None \
+        else tf.constant(capacity, dtype=tf.int64)
+    template_positions = tf.tile(
+        tf.expand_dims(tf.range(template_width), 0), tf.stack([batch_size, 1]))
+    new_templates, _ = _splice_graph(templates, filling, start, start + 1,
+                                     fill_lens, template_width)
+    paddings = tf.fill(tf.shape(new_templates), tf.cast(pad_id, templates.dtype))
+    new_templates = tf.where(
+        template_positions < tf.expand_dims(content_lengths, 1),
+        new_templates, paddings)
+    mask_positions = start_positions - tf.cumsum(blank_lens, axis=1, exclusive=True) \
+        + tf.range(blank_num - 1)
+    is_mask_token = tf.reduce_any(tf.equal(
+        tf.expand_dims(template_positions, 1), tf.expand_dims(mask_positions, 2)),
+        axis=1)
+    new_template_masks = tf.where(
+        template_positions < tf.expand_dims(template_lengths_, 1),
+        tf.to_int64(is_mask_token), paddings)
+
+    template_lengths = tf.fill(tf.shape(template_pack['template_lengths']),
+                               tf.to_int32(template_width))
+    template_segment_ids, template_offsets = \
+        _parse_segment_graph(template_lengths, new_template_masks)
+    return {
+        'text_ids': new_text_ids,
+        'segment_ids': template_segment_ids,
+        'offsets': template_offsets,
+        'templates': new_templates,
+        'start_positions': start_positions,
+        'end_positions': end_positions,
+        'masks': masks,
+        'template_lengths': template_lengths
+    }
+
+
+def stack_answer_packs(answer_packs, pad_id):
+    """Pads the answer packs to a common width and stacks them, so that the
+    blanks can be iterated over with :func:`blank_while_loop`.
+
+    :return: a dict of `text_ids`, `segment_ids` and `offsets` of shape
+        `[blank_num, batch_size, width]`, `lengths` of shape
+        `[blank_num, batch_size]`, and `widths` of shape `[blank_num]`
+        holding the width of each original answer.
+    """
+    widths = [tf.shape(pack['text_ids'])[1] for pack in answer_packs]
+    max_width = tf.reduce_max(tf.stack(widths))
+    stacked = {}
+    for key in ['text_ids', 'segment_ids', 'offsets']:
+        stacked[key] = tf.stack([
+            tf.pad(pack[key], [[0, 0], [0, max_width - width]],
+                   constant_values=tf.cast(pad_id, pack[key].dtype))
+            for pack, width in zip(answer_packs, widths)])
+    stacked['lengths'] = tf.stack([pack['lengths'] for pack in answer_packs])
+    stacked['widths'] = tf.stack(widths)
+    return stacked
+
+
+def blank_while_loop(step_fn, template_pack, blank_num, mask_id, eoa_id, pad_id,
+                     elems=None, capacity=None):
+    """Runs `step_fn` on each blank in turn, filling the blanks of
+    `template_pack` one after another with :func:`update_template_pack`.
+
+    Blanks after the first run in a `tf.while_loop`, so the graph holds two
+    copies of `step_fn` for any `blank_num` instead of one per blank. The
+    first blank runs outside the loop so that the variables of `step_fn` are
+    not created inside a control-flow construct.
+
+    :param step_fn: a callable `step_fn(template_pack, elem)` returning
+        `(output, filling)`. `output` is a tensor of the same shape for all
+        blanks, and `filling` the ids that fill the current blank, cut at
+        the first `eoa_id`.
+    :param elems: a dict of tensors of leading dimension `blank_num`, e.g.,
+        as returned by :func:`stack_answer_packs`. `step_fn` receives the
+        slice of the current blank, or `None` if `elems` is `None`.
+    :param capacity: passed to :func:`update_template_pack`. By default the
+        template pack keeps the tightest width in every iteration.
+    :return: the outputs of all blanks, stacked into `[blank_num, ...]`.
+    """
+    def _slice(idx):
+        if elems is None:
+            return None
+        return {key: value[idx] for key, value in elems.items()}
+
+    output, filling = step_fn(template_pack, _slice(0))
+    outputs = tf.expand_dims(output, 0)
+    if blank_num == 1:
+        return outputs
+    template_pack = update_template_pack(template_pack, filling, mask_id,
+                                         eoa_id, pad_id, capacity=capacity)
+
+    def _body(idx, template_pack, outputs):
+        output, filling = step_fn(template_pack, _slice(idx))
+        outputs = tf.concat([outputs, tf.expand_dims(output, 0)], axis=0)
+        template_pack = update_template_pack(template_pack, filling, mask_id,
+                                             eoa_id, pad_id, capacity=capacity)
+        return idx + 1, template_pack, outputs
+
+    shape_invariants = {key: tf.TensorShape([None] * value.shape.ndims)
+                        for key, value in template_pack.items()}
+    _, _, outputs = tf.while_loop(
+        lambda idx, *_: idx < blank_num,
+        _body,
+        loop_vars=(tf.constant(1), template_pack, outputs),
+        shape_invariants=(tf.TensorShape([]), shape_invariants,
+                          tf.TensorShape([None]).concatenate(output.shape)))
+    return outputs
+
+
+def lowest_scores_mask(scores, lengths, num):
+    """Marks the `num` lowest `scores` among the first `lengths` positions of
+    every row, e.g., the least confident predictions to mask again in
+    mask-predict decoding. Ties are broken by position.
+
+    :param scores: `[batch_size, max_length]`
+    :param lengths: `[batch_size]`
+    :param num: `[batch_size]`
+    :return: a bool tensor of shape `[batch_size, max_length]`.
+    """
+    max_length = tf.shape(scores)[1]
+    valid = tf.sequence_mask(lengths, max_length)
+    scores = tf.where(valid, scores, tf.fill(tf.shape(scores), np.inf))
+    positions = tf.range(max_length)
+    # the rank of a position is the number of positions with lower scores,
+    # or with the same score and before it
+    before = tf.less(tf.expand_dims(positions, 0), tf.expand_dims(positions, 1))
+    lower = tf.logical_or(
+        tf.less(tf.expand_dims(scores, 1), tf.expand_dims(scores, 2)),
+        tf.logical_and(
+            tf.equal(tf.expand_dims(scores, 1), tf.expand_dims(scores, 2)),
+            before))
+    ranks = tf.reduce_sum(tf.to_int32(lower), axis=2)
+    return tf.logical_and(valid, tf.less(ranks, tf.expand_dims(num, 1)))
+
+
+def generate_mask_predict_inputs(text_ids, lengths, mask_id, seed=None):
+    """Masks out a random number, from 1 to `lengths`, of random positions
+    among the first `lengths` ones of every row, to train the
+    non-autoregressive decoding of
+    :meth:`~texar.modules.TemplateTransformerDecoder.nat_decode`.
+
+    :return: `(masked_ids, masks)`, where `masks` is a bool tensor marking
+        the masked positions.
+    """
+    shape = tf.shape(text_ids)
+    num = 1 + tf.to_int32(tf.floor(
+        tf.random_uniform([shape[0]], seed=seed) * tf.to_float(lengths)))
+    masks = lowest_scores_mask(
+        tf.random_uniform(shape, seed=None if seed is None else seed + 1),
+        lengths, num)
+    masked_ids = tf.where(
+        masks, tf.fill(shape, tf.cast(mask_id, text_ids.dtype)), text_ids)
+    return masked_ids, masks
+
+
+def chunked_projection_loss(outputs, labels, kernel, bias, loss_fn,
+                            chunk_size):
+    """Projects `outputs` to the vocabulary and computes the loss of `labels`
+    `chunk_size` positions at a time, so that only the logits of one chunk
+    are alive at once. The gradients are computed by projecting every chunk
+    again, instead of keeping the `[batch_size, length, vocab_size]` logits
+    from the forward pass.
+
+    :param outputs: `[batch_size, length, hidden_dim]`
+    :param labels: `[batch_size, length]`
+    :param kernel: `[vocab_size, hidden_dim]`, e.g., the tied embedding.
+    :param bias: `[vocab_size]`, or `None`.
+    :param loss_fn: maps the logits `[batch_size, chunk_size, vocab_size]`
+        and the labels `[batch_size, chunk_size]` of a chunk to the loss
+        `[batch_size, chunk_size]`, e.g., :func:`smoothing_cross_entropy`.
+    :param chunk_size: an int, the number of positions of a chunk.
+    :return: the loss, `[batch_size, length]`.
+    """
+    with tf.name_scope("chunked_projection_loss"):
+        length = tf.shape(outputs)[1]
+        num_chunks = (length + chunk_size - 1) // chunk_size
+        hidden_dim = tf.shape(outputs)[2]
+
+        def _chunk_loss(step, outputs, params):
+            start = step * chunk_size
+            chunk_labels = labels[:, start:start + chunk_size]
+            logits = tf.matmul(tf.reshape(outputs, [-1, hidden_dim]),
+                               params[0], transpose_b=True)
+            if len(params) > 1:
+                logits += params[1]
+            logits = tf.reshape(
+                logits, tf.concat([tf.shape(chunk_labels), [-1]], axis=0))
+            return loss_fn(logits, chunk_labels)
+
+        @tf.custom_gradient
+        def _loss(outputs, *params):
+            # The chunks are concatenated along the first axis of the tensor
+            # arrays, i.e., the time.
+            def _forward(step, losses):
+                start = step * chunk_size
+                loss = _chunk_loss(
+                    step, outputs[:, start:start + chunk_size], params)
+                return step + 1, losses.write(step, tf.transpose(loss))
+
+            _, losses = tf.while_loop(
+                lambda step, _: step < num_chunks,
+                _forward,
+                loop_vars=(tf.constant(0), tf.TensorArray(
+                    outputs.dtype, size=num_chunks, infer_shape=False)))
+
+            def _grad(grad_loss):
+                def _backward(step, grad_outputs, grad_params):
+                    start = step * chunk_size
+                    # identities inside the loop, so that the gradients
+                    # stop at them instead of leaving the loop
+                    chunk_outputs = tf.identity(
+                        outputs[:, start:start + chunk_size])
+                    chunk_params = [tf.identity(param) for param in params]
+                    grads = tf.gradients(
+                        _chunk_loss(step, chunk_outputs, chunk_params),
+                        [chunk_outputs] + chunk_params,
+                        grad_ys=grad_loss[:, start:start + chunk_size])
+                    grad_outputs = grad_outputs.write(
+                        step, tf.transpose(grads[0], [1, 0, 2]))
+                    grad_params = [grad_param + grad for grad_param, grad
+                                   in zip(grad_params, grads[1:])]
+                    return step + 1, grad_outputs, grad_params
+
+                _, grad_outputs, grad_params = tf.while_loop(
+                    lambda step, *_: step < num_chunks,
+                    _backward,
+                    loop_vars=(tf.constant(0),
+                               tf.TensorArray(outputs.dtype, size=num_chunks,
+                                              infer_shape=False),
+                               [tf.zeros_like(param) for param in params]))
+                return [tf.transpose(grad_outputs.concat(), [1, 0, 2])] + \
+                    list(grad_params)
+
+            return tf.transpose(losses.concat()), _grad
+
+        params = [kernel] if bias is None else [kernel, bias]
+        return _loss(outputs, *[tf.convert_to_tensor(param)
+                                for param in params])
@@ -2,8 +2,14 @@ import math
 import argparse
 import numpy as np
 import tensorflow as tf
-from texar.utils.transformer_utils import generate_random_mask, generate_equal_length_mask,\
-    prepare_template, _split_template, _merge_segments, fill_template
+from texar.utils.transformer_utils import generate_dynamic_mask, generate_equal_length_mask,\
+    prepare_template, _split_template, _merge_segments, fill_template, \
+    _fill_dynamic_mask_np, _fill_dynamic_mask_reference, update_template_pack, \
+    prepare_template_np, _parse_segment_np, _parse_segment_reference, \
+    _update_template_pack_reference, _fill_template_reference, fill_template_np, \
+    fill_template_graph, stack_answer_packs, blank_while_loop, lowest_scores_mask, \
+    generate_mask_predict_inputs, smoothing_cross_entropy, \
+    chunked_projection_loss
 
 
 class Hyperparams:
@@ -34,21 +40,52 @@ def test_generate_equal_length_mask():
     mask_length = 2
     mask_num = 2
     mask_id = 7
+    boa_id = 9
     eos_id = 8
+    pad_id = 0
     inputs = tf.Variable([[3, 5, 4, 4, 2, 1, 3, 3, 2, 5, 1],
-                          [2, 1, 4, 3, 5, 1, 5, 4, 3, 1, 5]], dtype=tf.int64)
-    lengths = tf.Variable([11, 11], dtype=tf.int64)
+                          [2, 1, 4, 3, 5, 1, 5, 4, 3, 1, 5],
+                          [2, 1, 4, 3, 5, 1, 6, 0, 0, 0, 0]], dtype=tf.int64)
+    lengths = tf.Variable([11, 9, 7], dtype=tf.int64)
 
-    masks, answers, templates, _ = \
-        generate_equal_length_mask(inputs, lengths, mask_num, mask_length, mask_id, eos_id)
+    masks, answers, templates, template_masks = \
+        generate_equal_length_mask(inputs, lengths, mask_num, mask_length, mask_id,
+                                   eos_id, pad_id, boa_id=boa_id)
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
-        inputs_, masks_, answers_, templates_ = sess.run([inputs, masks, answers, templates])
-        print(inputs_)
-        print(masks_)
-        print(answers_)
-        print(templates_)
-# test_generate_equal_length_mask()
+        for _ in range(20):
+            inputs_, lengths_, masks_, answers_, templates_, template_masks_ = \
+                sess.run([inputs, lengths, masks, answers, templates, template_masks])
+            for i, (text, length, mask) in enumerate(zip(inputs_, lengths_, masks_)):
+                starts = np.where(np.diff(np.concatenate([[0], mask])) == 1)[0]
+                assert len(starts) == mask_num
+                assert mask.sum() == mask_num * mask_length
+                assert mask[0] == 0 and mask[length - 1:].sum() == 0
+                for idx, start in enumerate(starts):
+                    np.testing.assert_array_equal(
+                        answers_[idx][i],
+                        [boa_id] + text[start:start + mask_length].tolist() + [eos_id])
+                template = [w for w, m in zip(text, mask) if not m]
+                for start in starts[::-1]:
+                    template.insert(start - mask[:start].sum(), mask_id)
+                assert templates_[i][:len(template)].tolist() == template
+                assert template_masks_[i].sum() == mask_num
+
+
+def test_generate_equal_length_mask_too_short():
+    inputs = tf.constant([[3, 5, 4, 4, 2, 1, 3, 8],
+                          [2, 1, 4, 8, 0, 0, 0, 0]], dtype=tf.int64)
+    lengths = tf.constant([8, 4], dtype=tf.int64)
+    masks, _, _, _ = generate_equal_length_mask(
+        inputs, lengths, 2, 2, 7, 8, 0, boa_id=9)
+    with tf.Session() as sess:
+        try:
+            sess.run(masks)
+        except tf.errors.InvalidArgumentError:
+            pass
+        else:
+            raise AssertionError('a row shorter than 2 * (2 + 1) + 1 '
+                                 'tokens was masked silently')
 
 
 def test_prepare_template():
@@ -149,18 +186,20 @@ def test_fill_template_with_tensor():
 # test_fill_template_with_tensor()
 
 
-def test_generate_random_mask():
+def test_generate_dynamic_mask():
     inputs = tf.Variable([[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
                           [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]], dtype=tf.int64)
     lengths = tf.Variable([11, 11], dtype=tf.int32)
     present_rate = 0.2
     mask_id = 99
+    boa_id = 11
     eoa_id = 22
     pad_id = 33
     partition_num = 3
-    masks, answers, ans_len, templates, template_masks = \
-        generate_random_mask(inputs, lengths, present_rate,
-                             mask_id, eoa_id, pad_id, partition_num)
+    masks, answers, ans_len, true_ans_len, templates, template_masks, \
+        start_positions, end_positions = \
+        generate_dynamic_mask(inputs, lengths, present_rate, mask_id, boa_id,
+                              eoa_id, pad_id, partition_num)
 
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
@@ -170,4 +209,315 @@ def test_generate_random_mask():
         print("answers:\n", answers)
         print("templates:\n", templates)
         print("template_masks:\n", template_masks)
-# test_generate_random_mask()
+        assert len(answers) == partition_num
+        assert np.all(np.sum(templates == mask_id, axis=1) == partition_num)
+# test_generate_dynamic_mask()
+
+
+def test_fill_dynamic_mask_np():
+    rng = np.random.RandomState(1234)
+    for batch_size in [1, 7, 64]:
+        for blank_num in [1, 2, 3, 5]:
+            max_seq_length = 4 * blank_num + 10
+            lengths = rng.randint(2, max_seq_length + 1, size=batch_size)
+            inputs = rng.randint(5, 100, size=(batch_size, max_seq_length))
+            for present_rate in [0.3, 0.5, 0.7]:
+                args = (inputs.astype(np.int64), lengths.astype(np.int32),
+                        np.float32(present_rate), 1, 2, 0, blank_num)
+                expected = _fill_dynamic_mask_reference(*args)
+                rst = _fill_dynamic_mask_np(*args)
+                for exp, got in zip(expected, rst):
+                    assert exp.dtype == got.dtype
+                    np.testing.assert_array_equal(exp, got)
+
+
+def test_prepare_template_in_graph():
+    rng = np.random.RandomState(1234)
+    inputs = tf.placeholder(tf.int64, [None, None])
+    length = tf.placeholder(tf.int32, [None])
+    data_batch = {
+        'text_ids': inputs,
+        'length': length
+    }
+    args = Hyperparams()
+    args.present_rate = 0.5
+    args.blank_num = 2
+    fetches = []
+    for in_graph in [False, True]:
+        template_pack, answer_packs = \
+            prepare_template(data_batch, args, 22, 100, 99, 33, in_graph=in_graph)
+        fetches.append([template_pack, answer_packs])
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        feed_dict = {
+            inputs: rng.randint(0, 20, size=(4, 16)),
+            length: [16, 15, 16, 14]
+        }
+        rtns, rtns_in_graph = sess.run(fetches, feed_dict=feed_dict)
+        for pack, pack_in_graph in zip(rtns[:1] + rtns[1], rtns_in_graph[:1] + rtns_in_graph[1]):
+            for key, value in pack.items():
+                np.testing.assert_array_equal(value, pack_in_graph[key])
+
+
+def test_prepare_template_equal_length():
+    rng = np.random.RandomState(1234)
+    inputs = rng.randint(0, 20, size=(4, 16))
+    length = np.array([16, 15, 16, 9], dtype=np.int32)
+    args = Hyperparams()
+    args.present_rate = 0.5
+    args.blank_num = 2
+    args.mask_strategy = 'equal_length'
+    args.blank_length = 3
+    template_pack, answer_packs = prepare_template(
+        {'text_ids': tf.constant(inputs, dtype=tf.int64), 'length': tf.constant(length)},
+        args, 22, 100, 99, 33)
+    for answer_pack in answer_packs:
+        assert answer_pack['text_ids'].shape.as_list() == [4, 5]
+
+    with tf.Session() as sess:
+        template_pack_, answer_packs_ = sess.run([template_pack, answer_packs])
+        assert template_pack_['masks'].sum() == 4 * 2 * 3
+        assert template_pack_['templates'].shape == (4, 16 - 2 * 3 + 2)
+        for idx, answer_pack in enumerate(answer_packs_):
+            starts = template_pack_['start_positions'][:, idx]
+            for i, start in enumerate(starts):
+                np.testing.assert_array_equal(
+                    answer_pack['text_ids'][i], [100] + inputs[i, start:start + 3].tolist() + [99])
+            np.testing.assert_array_equal(answer_pack['lengths'], [3] * 4)
+            np.testing.assert_array_equal(answer_pack['segment_ids'], idx * 2 + 1)
+
+
+def test_prepare_template_np():
+    rng = np.random.RandomState(1234)
+    inputs = rng.randint(0, 20, size=(4, 16))
+    length = np.array([16, 15, 16, 9], dtype=np.int32)
+    args = Hyperparams()
+    args.present_rate = 0.5
+    args.blank_num = 3
+    template_pack, answer_packs = prepare_template(
+        {'text_ids': tf.constant(inputs, dtype=tf.int64), 'length': tf.constant(length)},
+        args, 22, 100, 99, 33)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        rtns = sess.run([template_pack] + answer_packs)
+    template_pack_np, answer_packs_np = \
+        prepare_template_np(inputs, length, args.present_rate, args.blank_num, 22, 100, 99, 33)
+    for pack, pack_np in zip(rtns, [template_pack_np] + answer_packs_np):
+        for key, value in pack.items():
+            assert value.dtype == pack_np[key].dtype
+            np.testing.assert_array_equal(value, pack_np[key])
+
+
+def test_parse_segment_np():
+    masks = np.array([[0, 0, 0, 1, 1, 0, 0, 0, 1, 1, 0],
+                      [0, 0, 1, 1, 1, 1, 0, 0, 1, 1, 0]])
+    segment_ids, offsets = _parse_segment_np(np.array([11, 8]), masks)
+    np.testing.assert_array_equal(segment_ids, [[0, 0, 0, 1, 1, 2, 2, 2, 3, 3, 4],
+                                                [0, 0, 1, 1, 1, 1, 2, 2, 0, 0, 0]])
+    np.testing.assert_array_equal(offsets, [[0, 1, 2, 0, 1, 0, 1, 2, 0, 1, 0],
+                                            [0, 1, 0, 1, 2, 3, 0, 1, 0, 0, 0]])
+
+    rng = np.random.RandomState(1234)
+    for batch_size, max_len in [(1, 1), (7, 13), (64, 40)]:
+        masks = rng.randint(0, 2, size=(batch_size, max_len)).astype(np.int64)
+        lengths = rng.randint(0, max_len + 1, size=batch_size).astype(np.int32)
+        for exp, got in zip(_parse_segment_reference(lengths, masks),
+                            _parse_segment_np(lengths, masks)):
+            assert exp.dtype == got.dtype
+            np.testing.assert_array_equal(exp, got)
+
+
+def test_update_template_pack():
+    rng = np.random.RandomState(1234)
+    inputs = tf.placeholder(tf.int64, [None, None])
+    length = tf.placeholder(tf.int32, [None])
+    fillings = tf.placeholder(tf.int64, [None, None])
+    args = Hyperparams()
+    args.present_rate = 0.5
+    args.blank_num = 3
+    template_pack, _ = prepare_template(
+        {'text_ids': inputs, 'length': length}, args, 22, 100, 99, 0)
+    packs, expected_packs = [], []
+    pack = expected_pack = template_pack
+    for idx in range(args.blank_num):
+        pack = update_template_pack(pack, fillings[:, idx * 4: (idx + 1) * 4], 22, 99, 0)
+        expected_pack = _update_template_pack_reference(
+            expected_pack, fillings[:, idx * 4: (idx + 1) * 4], 22, 99, 0)
+        packs.append(pack)
+        expected_packs.append(expected_pack)
+    capacity_pack = update_template_pack(template_pack, fillings[:, :4], 22, 99, 0,
+                                         capacity=40)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        # fillings of 0 to 4 tokens, cut by <eoa>=99
+        fillings_ = rng.randint(1, 20, size=(5, 12))
+        fillings_[rng.rand(5, 12) < 0.3] = 99
+        feed_dict = {
+            inputs: rng.randint(1, 20, size=(5, 20)),
+            length: [20, 18, 20, 15, 19],
+            fillings: fillings_
+        }
+        rtns, expected_rtns, capacity_rtns = \
+            sess.run([packs, expected_packs, capacity_pack], feed_dict=feed_dict)
+        for pack, expected_pack in zip(rtns, expected_rtns):
+            for key, value in expected_pack.items():
+                np.testing.assert_array_equal(pack[key], value)
+        for key in ['text_ids', 'templates', 'segment_ids', 'offsets', 'masks']:
+            assert capacity_rtns[key].shape == (5, 40)
+            width = rtns[0][key].shape[1]
+            np.testing.assert_array_equal(capacity_rtns[key][:, :width], rtns[0][key])
+
+
+def test_blank_while_loop():
+    rng = np.random.RandomState(1234)
+    inputs = tf.placeholder(tf.int64, [None, None])
+    length = tf.placeholder(tf.int32, [None])
+    args = Hyperparams()
+    args.present_rate = 0.5
+    args.blank_num = 4
+    template_pack, answer_packs = prepare_template(
+        {'text_ids': inputs, 'length': length}, args, 22, 100, 99, 0, in_graph=True)
+
+    def _step(cur_template_pack, hole):
+        width = hole['widths']
+        answer = hole['text_ids'][:, :width]
+        output = tf.stack([tf.reduce_sum(cur_template_pack['templates']),
+                           tf.reduce_sum(cur_template_pack['segment_ids'] *
+                                         cur_template_pack['offsets']),
+                           tf.reduce_sum(answer),
+                           tf.to_int64(tf.reduce_sum(hole['lengths']))])
+        return output, answer[:, 1:]
+
+    outputs = blank_while_loop(_step, template_pack, args.blank_num, 22, 99, 0,
+                               elems=stack_answer_packs(answer_packs, 0))
+    expected_outputs = []
+    cur_template_pack = template_pack
+    for hole in answer_packs:
+        hole = dict(hole, widths=tf.shape(hole['text_ids'])[1])
+        output, filling = _step(cur_template_pack, hole)
+        expected_outputs.append(output)
+        cur_template_pack = update_template_pack(cur_template_pack, filling, 22, 99, 0)
+
+    with tf.Session() as sess:
+        feed_dict = {
+            inputs: rng.randint(1, 20, size=(5, 30)),
+            length: [30, 28, 30, 25, 29]
+        }
+        outputs_, expected_outputs_ = sess.run([outputs, expected_outputs],
+                                               feed_dict=feed_dict)
+        np.testing.assert_array_equal(outputs_, expected_outputs_)
+
+
+def test_fill_template_np():
+    template_pack = {
+        'text_ids': np.array([[3, 5, 4, 7, 7, 1, 3, 3, 7, 7, 1],
+                              [2, 1, 7, 7, 6, 2, 5, 7, 7, 4, 5]]),
+        'start_positions': np.array([[3, 8], [2, 7]]),
+        'end_positions': np.array([[5, 10], [4, 9]])
+    }
+    eoa_id, pad_id, eos_id = 9, 0, 10
+    predictions = [np.array([[4, 2, 9, 0], [4, 0, 3, 1]]),
+                   np.array([[2, 5, 10], [9, 3, 1]])]
+    filled, lengths = fill_template_np(template_pack, predictions, eoa_id, pad_id, eos_id)
+    np.testing.assert_array_equal(filled, [[3, 5, 4, 4, 2, 1, 3, 3, 2, 5, 1],
+                                           [2, 1, 4, 3, 1, 6, 2, 5, 4, 5, 0]])
+    np.testing.assert_array_equal(lengths, [11, 10])
+
+    rng = np.random.RandomState(1234)
+    args = Hyperparams()
+    args.present_rate = 0.5
+    args.blank_num = 3
+    inputs = rng.randint(1, 20, size=(6, 20))
+    length = np.array([20, 18, 20, 15, 19, 12], dtype=np.int32)
+    template_pack, _ = prepare_template_np(
+        inputs, length, args.present_rate, args.blank_num, 22, 100, 99, 0)
+    predictions = []
+    for _ in range(args.blank_num):
+        prediction = rng.randint(0, 20, size=(6, rng.randint(1, 8)))
+        prediction[rng.rand(*prediction.shape) < 0.2] = 99
+        predictions.append(prediction)
+    filled, lengths = fill_template_np(template_pack, predictions, 99, 0, 20)
+    expected = _fill_template_reference(template_pack, predictions, 99, 0, 20)
+    assert [ids[:l].tolist() for ids, l in zip(filled, lengths)] == expected
+
+    template_pack_ = {key: tf.constant(value) for key, value in template_pack.items()}
+    filled_graph, lengths_graph = fill_template_graph(
+        template_pack_, [tf.constant(prediction) for prediction in predictions], 99, 0, 20)
+    with tf.Session() as sess:
+        filled_graph, lengths_graph = sess.run([filled_graph, lengths_graph])
+    np.testing.assert_array_equal(filled_graph, filled)
+    np.testing.assert_array_equal(lengths_graph, lengths)
+
+
+def test_lowest_scores_mask():
+    scores = tf.constant([[0.3, -1., 2., 0.3, -5.],
+                          [1., 1., 1., 1., 1.],
+                          [4., 3., 2., 1., 0.]])
+    lengths = tf.constant([4, 5, 0])
+    num = tf.constant([3, 2, 1])
+    masks = lowest_scores_mask(scores, lengths, num)
+
+    rng = np.random.RandomState(1234)
+    text_ids = tf.constant(rng.randint(3, 20, size=(6, 8)))
+    masked_lengths = tf.constant([8, 5, 1, 0, 3, 6])
+    masked_ids, masked = generate_mask_predict_inputs(
+        text_ids, masked_lengths, 22, seed=1)
+    with tf.Session() as sess:
+        masks_, text_ids_, masked_ids_, masked_ = sess.run(
+            [masks, text_ids, masked_ids, masked])
+    np.testing.assert_array_equal(masks_, [[1, 1, 0, 1, 0],
+                                           [1, 1, 0, 0, 0],
+                                           [0, 0, 0, 0, 0]])
+    np.testing.assert_array_equal(masked_ids_, np.where(masked_, 22, text_ids_))
+    for row, length in zip(masked_, [8, 5, 1, 0, 3, 6]):
+        assert not row[length:].any()
+        assert row.sum() >= min(length, 1)
+
+
+def test_analytic_smoothing_cross_entropy():
+    rng = np.random.RandomState(1234)
+    logits = tf.constant(rng.randn(3, 5, 11).astype(np.float32))
+    labels = tf.constant(rng.randint(0, 11, size=(3, 5)))
+    losses, grads = [], []
+    for zero_pad in [True, False]:
+        for analytic in [False, True]:
+            loss = smoothing_cross_entropy(logits, labels, 11, 0.9,
+                                           zero_pad=zero_pad, analytic=analytic)
+            losses.append(loss)
+            grads.append(tf.gradients(tf.reduce_sum(loss), logits)[0])
+    with tf.Session() as sess:
+        losses_, grads_ = sess.run([losses, grads])
+    for idx in [0, 2]:
+        np.testing.assert_allclose(losses_[idx], losses_[idx + 1], rtol=1e-5)
+        np.testing.assert_allclose(grads_[idx], grads_[idx + 1], atol=1e-6)
+
+
+def test_chunked_projection_loss():
+    rng = np.random.RandomState(1234)
+    outputs = tf.constant(rng.randn(3, 7, 8).astype(np.float32))
+    labels = tf.constant(rng.randint(0, 11, size=(3, 7)))
+    kernel = tf.constant(rng.randn(11, 8).astype(np.float32))
+    bias = tf.constant(rng.randn(11).astype(np.float32))
+
+    def _loss_fn(logits, labels):
+        return smoothing_cross_entropy(logits, labels, 11, 0.9)
+
+    logits = tf.reshape(
+        tf.matmul(tf.reshape(outputs, [-1, 8]), kernel, transpose_b=True),
+        [3, 7, 11]) + bias
+    loss = _loss_fn(logits, labels)
+    # the last chunk is shorter
+    chunked_loss = chunked_projection_loss(
+        outputs, labels, kernel, bias, _loss_fn, chunk_size=3)
+    grads = tf.gradients(tf.reduce_sum(loss * loss), [outputs, kernel, bias])
+    chunked_grads = tf.gradients(tf.reduce_sum(chunked_loss * chunked_loss),
+                                 [outputs, kernel, bias])
+    with tf.Session() as sess:
+        loss_, chunked_loss_, grads_, chunked_grads_ = sess.run(
+            [loss, chunked_loss, grads, chunked_grads])
+    np.testing.assert_allclose(loss_, chunked_loss_, rtol=1e-5)
+    for grad_, chunked_grad_ in zip(grads_, chunked_grads_):
+        np.testing.assert_allclose(grad_, chunked_grad_, rtol=1e-4, atol=1e-5)
@@ -45,9 +45,11 @@ def _main(_):
         hparams['loss_hparams'], hparams['d_opt'], hparams['args']
 
     # Data
-    train_data = tx.data.MonoTextData(train_dataset_hparams)
-    valid_data = tx.data.MonoTextData(valid_dataset_hparams)
-    test_data = tx.data.MonoTextData(test_dataset_hparams)
+    data_class = tx.data.InfillingTextData if args.pipeline_template \
+        else tx.data.MonoTextData
+    train_data = data_class(train_dataset_hparams)
+    valid_data = data_class(valid_dataset_hparams)
+    test_data = data_class(test_dataset_hparams)
     iterator = tx.data.FeedableDataIterator(
         {'train_g': train_data, 'train_d': train_data,
          'val': valid_data, 'test': test_data})
@@ -58,8 +60,12 @@ def _main(_):
     eoa_id = train_data.vocab.token_to_id_map_py['<EOA>']
     eos_id = train_data.vocab.token_to_id_map_py[SpecialTokens.EOS]
     pad_id = train_data.vocab.token_to_id_map_py['<PAD>']
-    template_pack, answer_packs = \
-        tx.utils.prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id)
+    if args.pipeline_template:
+        template_pack, answer_packs = data_class.unpack(data_batch, args.blank_num)
+    else:
+        template_pack, answer_packs = \
+            tx.utils.prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id,
+                                      in_graph=args.in_graph_template)
 
     gamma = tf.placeholder(dtype=tf.float32, shape=[], name='gamma')
     lambda_g = tf.placeholder(dtype=tf.float32, shape=[], name='lambda_g')
@@ -67,7 +73,8 @@ def _main(_):
     # Model architecture
     embedder = tx.modules.WordEmbedder(vocab_size=train_data.vocab.size,
                                        hparams=args.word_embedding_hparams)
-    position_embedder = position_embedders.SinusoidsSegmentalPositionEmbedder()
+    position_embedder = position_embedders.SinusoidsSegmentalPositionEmbedder(
+        hparams=args.position_embedder_hparams)
     encoder = tx.modules.UnidirectionalRNNEncoder(hparams=encoder_hparams)
     decoder = tx.modules.BasicPositionalRNNDecoder(vocab_size=train_data.vocab.size,
                                                    hparams=decoder_hparams,
@@ -84,9 +91,7 @@ def _main(_):
     clas_embedder = tx.modules.WordEmbedder(vocab_size=train_data.vocab.size,
                                             hparams=args.word_embedding_hparams)
 
-    cetp_loss, d_class_loss, g_class_loss = None, None, None
-    cur_template_pack = template_pack
-    for idx, hole in enumerate(answer_packs):
+    def _encode(cur_template_pack):
         template = cur_template_pack['templates']
         template_word_embeds = embedder(template)
         template_length = shape_list(template)[1]
@@ -100,7 +105,10 @@ def _main(_):
             enc_input_embedded,
             sequence_length=data_batch["length"])
 
-        dcdr_init_states = connector(ecdr_states)
+        return connector(ecdr_states)
+
+    def _hole_losses(cur_template_pack, hole):
+        dcdr_init_states = _encode(cur_template_pack)
 
         dec_input = hole['text_ids'][:, :-1]
         dec_input_word_embeds = embedder(dec_input)
@@ -116,9 +124,8 @@ def _main(_):
             hole['text_ids'][:, 1:],
             train_data.vocab.size,
             loss_hparams['label_confidence'],
+            analytic=loss_hparams['analytic_smoothing'],
         )
-        cetp_loss = cur_loss if cetp_loss is None \
-            else tf.concat([cetp_loss, cur_loss], -1)
 
         soft_outputs_, _, soft_length_, = decoder(
             helper=gumbel_helper, initial_state=dcdr_init_states)
@@ -129,8 +136,6 @@ def _main(_):
             sequence_length=hole["lengths"]+1)
         loss_d_clas = tf.nn.sigmoid_cross_entropy_with_logits(
             labels=tf.to_float(tf.ones_like(data_batch['length'])), logits=clas_logits)
-        d_class_loss = loss_d_clas if d_class_loss is None \
-            else tf.concat([d_class_loss, loss_d_clas], -1)
 
         # Classification loss for the generator, based on soft samples
         soft_logits, soft_preds = classifier(
@@ -138,15 +143,42 @@ def _main(_):
             sequence_length=soft_length_)
         loss_g_clas = tf.nn.sigmoid_cross_entropy_with_logits(
             labels=tf.to_float(tf.zeros_like(data_batch['length'])), logits=soft_logits)
-        g_class_loss = loss_g_clas if g_class_loss is None \
-            else tf.concat([g_class_loss, loss_g_clas], -1)
-
-        cur_template_pack = tx.utils.update_template_pack(cur_template_pack,
-                                                          hole['text_ids'][:, 1:],
-                                                          mask_id, eoa_id, pad_id)
-    cetp_loss = tf.reduce_mean(cetp_loss)
-    d_class_loss = tf.reduce_mean(d_class_loss)
-    g_class_loss = tf.reduce_mean(g_class_loss)
+        return cur_loss, loss_d_clas, loss_g_clas
+
+    if args.loop_blanks:
+        def _loop_step(cur_template_pack, hole):
+            width = hole['widths']
+            hole = {'text_ids': hole['text_ids'][:, :width], 'lengths': hole['lengths']}
+            cur_loss, loss_d_clas, loss_g_clas = _hole_losses(cur_template_pack, hole)
+            output = tf.stack([tf.reduce_sum(cur_loss), tf.to_float(tf.size(cur_loss)),
+                               tf.reduce_sum(loss_d_clas), tf.reduce_sum(loss_g_clas),
+                               tf.to_float(tf.size(loss_d_clas))])
+            return output, hole['text_ids'][:, 1:]
+
+        loss_sums = tx.utils.blank_while_loop(
+            _loop_step, template_pack, args.blank_num, mask_id, eoa_id, pad_id,
+            elems=tx.utils.stack_answer_packs(answer_packs, pad_id))
+        loss_sums = tf.reduce_sum(loss_sums, axis=0)
+        cetp_loss = loss_sums[0] / loss_sums[1]
+        d_class_loss = loss_sums[2] / loss_sums[4]
+        g_class_loss = loss_sums[3] / loss_sums[4]
+    else:
+        cetp_loss, d_class_loss, g_class_loss = None, None, None
+        cur_template_pack = template_pack
+        for hole in answer_packs:
+            cur_loss, loss_d_clas, loss_g_clas = _hole_losses(cur_template_pack, hole)
+            cetp_loss = cur_loss if cetp_loss is None \
+                else tf.concat([cetp_loss, cur_loss], -1)
+            d_class_loss = loss_d_clas if d_class_loss is None \
+                else tf.concat([d_class_loss, loss_d_clas], -1)
+            g_class_loss = loss_g_clas if g_class_loss is None \
+                else tf.concat([g_class_loss, loss_g_clas], -1)
+            cur_template_pack = tx.utils.update_template_pack(cur_template_pack,
+                                                              hole['text_ids'][:, 1:],
+                                                              mask_id, eoa_id, pad_id)
+        cetp_loss = tf.reduce_mean(cetp_loss)
+        d_class_loss = tf.reduce_mean(d_class_loss)
+        g_class_loss = tf.reduce_mean(g_class_loss)
 
     global_step = tf.Variable(0, trainable=False)
     if args.learning_rate_strategy == 'static':
@@ -176,23 +208,8 @@ def _main(_):
     train_op_d = tx.core.get_train_op(d_loss, d_vars, hparams=d_opt_hparams)
 
     # Inference
-    predictions = []
-    cur_test_pack = template_pack
-    for idx, hole in enumerate(answer_packs):
-        template = cur_test_pack['templates']
-        template_word_embeds = embedder(template)
-        template_length = shape_list(template)[1]
-        channels = shape_list(template_word_embeds)[2]
-        template_pos_embeds = position_embedder(template_length, channels,
-                                                cur_test_pack['segment_ids'],
-                                                cur_test_pack['offsets'])
-        enc_input_embedded = template_word_embeds + template_pos_embeds
-
-        _, ecdr_states = encoder(
-            enc_input_embedded,
-            sequence_length=data_batch["length"])
-
-        dcdr_init_states = connector(ecdr_states)
+    def _hole_predictions(cur_test_pack):
+        dcdr_init_states = _encode(cur_test_pack)
 
         decoder.set_segment_id(1)
         outputs_infer, _, _ = decoder(
@@ -201,10 +218,27 @@ def _main(_):
             end_token=eoa_id,
             embedding=embedder,
             initial_state=dcdr_init_states)
-        predictions.append(outputs_infer.sample_id)
-        cur_test_pack = tx.utils.update_template_pack(cur_test_pack,
-                                                      outputs_infer.sample_id,
-                                                      mask_id, eoa_id, pad_id)
+        return outputs_infer.sample_id
+
+    if args.loop_blanks:
+        def _loop_step(cur_test_pack, _):
+            preds = _hole_predictions(cur_test_pack)
+            # pads with <EOA>, so that the filling is cut where decoding stopped
+            preds = tf.pad(preds, [[0, 0], [0, args.max_decode_len + 2 - tf.shape(preds)[1]]],
+                           constant_values=eoa_id)
+            return preds, preds
+
+        predictions = tf.unstack(tx.utils.blank_while_loop(
+            _loop_step, template_pack, args.blank_num, mask_id, eoa_id, pad_id),
+            num=args.blank_num)
+    else:
+        predictions = []
+        cur_test_pack = template_pack
+        for _ in answer_packs:
+            preds = _hole_predictions(cur_test_pack)
+            predictions.append(preds)
+            cur_test_pack = tx.utils.update_template_pack(cur_test_pack, preds,
+                                                          mask_id, eoa_id, pad_id)
 
     eval_saver = tf.train.Saver(max_to_keep=5)
 
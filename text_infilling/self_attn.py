@@ -26,6 +26,8 @@ import codecs
 import numpy as np
 import tensorflow as tf
 import texar as tx
+from texar.modules.embedders import position_embedders
+from texar.utils.shapes import shape_list
 from matplotlib import pyplot as plt
 
 plt.switch_backend('agg')
@@ -44,9 +46,15 @@ def _main(_):
         hparams['loss_hparams'], hparams['args']
 
     # Data
-    train_data = tx.data.MonoTextData(train_dataset_hparams)
-    valid_data = tx.data.MonoTextData(valid_dataset_hparams)
-    test_data = tx.data.MonoTextData(test_dataset_hparams)
+    if args.template_shards_dir:
+        data_class = tx.data.TemplateShardData
+    elif args.pipeline_template:
+        data_class = tx.data.InfillingTextData
+    else:
+        data_class = tx.data.MonoTextData
+    train_data = data_class(train_dataset_hparams)
+    valid_data = data_class(valid_dataset_hparams)
+    test_data = data_class(test_dataset_hparams)
     iterator = tx.data.TrainTestDataIterator(train=train_data,
                                              val=valid_data,
                                              test=test_data)
@@ -56,34 +64,149 @@ def _main(_):
     eoa_id = train_data.vocab.token_to_id_map_py['<EOA>']
     eos_id = train_data.vocab.token_to_id_map_py['<EOS>']
     pad_id = train_data.vocab.token_to_id_map_py['<PAD>']
-    template_pack, answer_packs = \
-        tx.utils.prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id)
+    if args.template_shards_dir or args.pipeline_template:
+        template_pack, answer_packs = data_class.unpack(data_batch, args.blank_num)
+    else:
+        template_pack, answer_packs = \
+            tx.utils.prepare_template(data_batch, args, mask_id, boa_id, eoa_id, pad_id,
+                                      in_graph=args.in_graph_template)
 
     # Model architecture
+    decoder_hparams['pad_idx'] = pad_id
     embedder = tx.modules.WordEmbedder(vocab_size=train_data.vocab.size,
                                        hparams=args.word_embedding_hparams)
     decoder = \
         tx.modules.TemplateTransformerDecoder(embedding=embedder._embedding,
                                               hparams=decoder_hparams)
 
-    cetp_loss = None
-    cur_template_pack = template_pack
-    for hole in answer_packs:
-        logits, preds = decoder(decoder_input_pack=hole,
-                                template_input_pack=cur_template_pack,
-                                encoder_decoder_attention_bias=None,
-                                args=args)
-        cur_loss = tx.utils.smoothing_cross_entropy(
+    if args.speculative_draft > 0:
+        # the RNN model of seq2seq.py, drafting the tokens to verify
+        draft_embedder = tx.modules.WordEmbedder(vocab_size=train_data.vocab.size,
+                                                 hparams=args.word_embedding_hparams)
+        draft_position_embedder = position_embedders.SinusoidsSegmentalPositionEmbedder(
+            hparams=args.position_embedder_hparams)
+        draft_encoder = tx.modules.UnidirectionalRNNEncoder(
+            hparams=hparams['draft_encoder_hparams'])
+        draft_decoder = tx.modules.BasicPositionalRNNDecoder(
+            vocab_size=train_data.vocab.size,
+            hparams=hparams['draft_decoder_hparams'],
+            position_embedder=draft_position_embedder)
+        draft_decoder.set_segment_id(1)
+        draft_connector = tx.modules.connectors.ForwardConnector(
+            draft_decoder.cell.state_size)
+
+        def _draft_encode(cur_template_pack):
+            template = cur_template_pack['templates']
+            template_word_embeds = draft_embedder(template)
+            template_length = shape_list(template)[1]
+            channels = shape_list(template_word_embeds)[2]
+            template_pos_embeds = draft_position_embedder(template_length, channels,
+                                                          cur_template_pack['segment_ids'],
+                                                          cur_template_pack['offsets'])
+            _, ecdr_states = draft_encoder(
+                template_word_embeds + template_pos_embeds,
+                sequence_length=data_batch["length"])
+            return draft_connector(ecdr_states)
+
+        draft_loss = None
+        cur_template_pack = template_pack
+        for hole in answer_packs:
+            outputs, _, _ = draft_decoder(
+                initial_state=_draft_encode(cur_template_pack),
+                decoding_strategy="train_greedy",
+                inputs=draft_embedder(hole['text_ids'][:, :-1]),
+                sequence_length=hole["lengths"]+1)
+            cur_loss = tx.utils.smoothing_cross_entropy(
+                outputs.logits,
+                hole['text_ids'][:, 1:],
+                train_data.vocab.size,
+                loss_hparams['label_confidence'],
+                analytic=loss_hparams['analytic_smoothing'])
+            draft_loss = cur_loss if draft_loss is None \
+                else tf.concat([draft_loss, cur_loss], -1)
+            cur_template_pack = tx.utils.update_template_pack(cur_template_pack,
+                                                              hole['text_ids'][:, 1:],
+                                                              mask_id, eoa_id, pad_id)
+        draft_loss = tf.reduce_mean(draft_loss)
+
+    def _smoothing_loss(logits, labels):
+        return tx.utils.smoothing_cross_entropy(
             logits,
-            hole['text_ids'][:, 1:],
+            labels,
             train_data.vocab.size,
-            loss_hparams['label_confidence'])
-        cetp_loss = cur_loss if cetp_loss is None \
-            else tf.concat([cetp_loss, cur_loss], -1)
-        cur_template_pack = tx.utils.update_template_pack(cur_template_pack,
-                                                          hole['text_ids'][:, 1:],
-                                                          mask_id, eoa_id, pad_id)
-    cetp_loss = tf.reduce_mean(cetp_loss)
+            loss_hparams['label_confidence'],
+            analytic=loss_hparams['analytic_smoothing'])
+
+    def _hole_loss(cur_template_pack, hole):
+        logits, _ = decoder(decoder_input_pack=hole,
+                            template_input_pack=cur_template_pack,
+                            encoder_decoder_attention_bias=None,
+                            args=args)
+        if loss_hparams['projection_chunk_size'] > 0:
+            return decoder.chunked_loss(decoder.decoder_output,
+                                        hole['text_ids'][:, 1:],
+                                        _smoothing_loss,
+                                        loss_hparams['projection_chunk_size'])
+        return _smoothing_loss(logits, hole['text_ids'][:, 1:])
+
+    if args.nat_iterations > 0:
+        # every blank is conditioned on the original template, as in
+        # `nat_decode`, and some of its tokens are masked out to predict
+        cetp_loss, mask_num = 0., 0.
+        for hole in answer_packs:
+            targets = hole['text_ids'][:, 1:]
+            masked_ids, masks = tx.utils.generate_mask_predict_inputs(
+                targets, hole['lengths'], mask_id)
+            logits, _ = decoder(decoder_input_pack={
+                                    'text_ids': masked_ids,
+                                    'segment_ids': hole['segment_ids'][:, 1:],
+                                    'offsets': hole['offsets'][:, 1:],
+                                    'lengths': hole['lengths'] + 1},
+                                template_input_pack=template_pack,
+                                encoder_decoder_attention_bias=None,
+                                args=args,
+                                non_autoregressive=True)
+            cur_loss = tx.utils.smoothing_cross_entropy(
+                logits, targets, train_data.vocab.size,
+                loss_hparams['label_confidence'],
+                analytic=loss_hparams['analytic_smoothing'])
+            cetp_loss += tf.reduce_sum(cur_loss * tf.to_float(masks))
+            mask_num += tf.reduce_sum(tf.to_float(masks))
+        cetp_loss /= tf.maximum(mask_num, 1.)
+        length_logits = decoder.predict_lengths(
+            template_input_pack=template_pack,
+            encoder_decoder_attention_bias=None,
+            blank_num=args.blank_num,
+            bos_id=boa_id)
+        lengths = tf.minimum(
+            tf.stack([hole['lengths'] for hole in answer_packs], axis=1),
+            args.max_decode_len - 1)
+        cetp_loss += tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=lengths, logits=length_logits))
+    elif args.loop_blanks:
+        def _loop_step(cur_template_pack, hole):
+            width = hole['widths']
+            hole = {key: hole[key][:, :width]
+                    for key in ['text_ids', 'segment_ids', 'offsets']}
+            cur_loss = _hole_loss(cur_template_pack, hole)
+            output = tf.stack([tf.reduce_sum(cur_loss), tf.to_float(tf.size(cur_loss))])
+            return output, hole['text_ids'][:, 1:]
+
+        loss_sums = tx.utils.blank_while_loop(
+            _loop_step, template_pack, args.blank_num, mask_id, eoa_id, pad_id,
+            elems=tx.utils.stack_answer_packs(answer_packs, pad_id))
+        cetp_loss = tf.reduce_sum(loss_sums[:, 0]) / tf.reduce_sum(loss_sums[:, 1])
+    else:
+        cetp_loss = None
+        cur_template_pack = template_pack
+        for hole in answer_packs:
+            cur_loss = _hole_loss(cur_template_pack, hole)
+            cetp_loss = cur_loss if cetp_loss is None \
+                else tf.concat([cetp_loss, cur_loss], -1)
+            cur_template_pack = tx.utils.update_template_pack(cur_template_pack,
+                                                              hole['text_ids'][:, 1:],
+                                                              mask_id, eoa_id, pad_id)
+        cetp_loss = tf.reduce_mean(cetp_loss)
 
     global_step = tf.Variable(0, trainable=False)
     if args.learning_rate_strategy == 'static':
@@ -101,13 +224,31 @@ def _main(_):
                                        beta1=opt_hparams['Adam_beta1'],
                                        beta2=opt_hparams['Adam_beta2'],
                                        epsilon=opt_hparams['Adam_epsilon'])
-    train_op = optimizer.minimize(cetp_loss, global_step)
+    if args.speculative_draft > 0:
+        # the draft model shares no variables with the transformer
+        train_op = optimizer.minimize(cetp_loss + draft_loss, global_step)
+    else:
+        train_op = optimizer.minimize(cetp_loss, global_step)
 
     offsets = tx.utils.generate_prediction_offsets(data_batch['text_ids'],
                                                    args.max_decode_len + 1)
-    predictions = []
-    cur_test_pack = template_pack
-    for idx, hole in enumerate(answer_packs):
+    def _hole_predictions(cur_test_pack):
+        if args.speculative_draft > 0:
+            draft_initial_state = _draft_encode(cur_test_pack)
+            max_length = args.max_decode_len + args.speculative_draft + 1
+            preds = decoder.speculative_decode(
+                template_input_pack=cur_test_pack,
+                encoder_decoder_attention_bias=None,
+                segment_ids=tx.utils.generate_prediction_segment_ids(
+                    data_batch['text_ids'], 1, max_length),
+                offsets=tx.utils.generate_prediction_offsets(
+                    data_batch['text_ids'], max_length),
+                bos_id=boa_id,
+                eos_id=eoa_id,
+                draft_fn=lambda ids, lengths, num_tokens: draft_decoder.draft(
+                    draft_initial_state, draft_embedder, ids, lengths, num_tokens),
+                num_draft_tokens=args.speculative_draft)
+            return preds['sampled_ids'][:, 0]
         segment_ids = \
             tx.utils.generate_prediction_segment_ids(data_batch['text_ids'],
                                                      1,  # segment_id will always be 1
@@ -119,10 +260,46 @@ def _main(_):
             offsets=offsets,
             bos_id=boa_id,
             eos_id=eoa_id)
-        predictions.append(preds['sampled_ids'][:, 0])
-        cur_test_pack = tx.utils.update_template_pack(cur_test_pack,
-                                                      preds['sampled_ids'][:, 0],
-                                                      mask_id, eoa_id, pad_id)
+        return preds['sampled_ids'][:, 0]
+
+    if args.nat_iterations > 0:
+        preds = decoder.nat_decode(
+            template_input_pack=template_pack,
+            encoder_decoder_attention_bias=None,
+            blank_num=args.blank_num,
+            bos_id=boa_id,
+            eos_id=eoa_id,
+            mask_id=mask_id,
+            iterations=args.nat_iterations)
+        predictions = tf.unstack(preds['sampled_ids'], num=args.blank_num, axis=1)
+    elif args.parallel_blanks:
+        preds = decoder.parallel_decode(
+            template_input_pack=template_pack,
+            encoder_decoder_attention_bias=None,
+            blank_num=args.blank_num,
+            offsets=offsets,
+            bos_id=boa_id,
+            eos_id=eoa_id)
+        predictions = tf.unstack(preds['sampled_ids'], num=args.blank_num, axis=1)
+    elif args.loop_blanks:
+        def _loop_step(cur_test_pack, _):
+            preds = _hole_predictions(cur_test_pack)
+            # pads with <EOA>, so that the filling is cut where decoding stopped
+            preds = tf.pad(preds, [[0, 0], [0, args.max_decode_len + 1 - tf.shape(preds)[1]]],
+                           constant_values=eoa_id)
+            return preds, preds
+
+        predictions = tf.unstack(tx.utils.blank_while_loop(
+            _loop_step, template_pack, args.blank_num, mask_id, eoa_id, pad_id),
+            num=args.blank_num)
+    else:
+        predictions = []
+        cur_test_pack = template_pack
+        for _ in answer_packs:
+            preds = _hole_predictions(cur_test_pack)
+            predictions.append(preds)
+            cur_test_pack = tx.utils.update_template_pack(cur_test_pack, preds,
+                                                          mask_id, eoa_id, pad_id)
 
     def _train_epochs(session, cur_epoch, mode='train'):
         iterator.switch_to_train_data(session)
@@ -6,7 +6,7 @@ import argparse
 import copy
 import os
 
-from texar.data import SpecialTokens
+from texar.data import SpecialTokens, template_shard_file_pattern
 
 
 class Hyperparams:
@@ -18,6 +18,27 @@ class Hyperparams:
         self.help = "the hyperparams dictionary to use"
 
 
+def _template_shard_hparams(dataset_hparams, args, split):
+    """
+        reads the precomputed packs of the split instead of the raw text,
+        see bin/make_template_shards.py
+    """
+    return {
+        "num_epochs": dataset_hparams["num_epochs"],
+        "seed": args.random_seed,
+        "shuffle": dataset_hparams["shuffle"],
+        "dataset": {
+            "files": template_shard_file_pattern(
+                args.template_shards_dir, args.filename_prefix + split,
+                args.mask_rate, args.blank_num),
+            "blank_num": args.blank_num,
+            "vocab_file": args.vocab_file,
+            "bos_token": SpecialTokens.BOS,
+            "eos_token": SpecialTokens.EOS,
+        },
+    }
+
+
 def load_hyperparams():
     """
         main function to define hyperparams
@@ -27,6 +48,10 @@ def load_hyperparams():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--mask_rate', type=float, default=0.5)
     argparser.add_argument('--blank_num', type=int, default=1)
+    argparser.add_argument('--mask_strategy', type=str, default='random',
+                           help='random or equal_length')
+    argparser.add_argument('--blank_length', type=int, default=1,
+                           help='tokens per blank if mask_strategy is equal_length')
     argparser.add_argument('--batch_size', type=int, default=400)
     argparser.add_argument('--test_batch_size', type=int, default=10)
     argparser.add_argument('--max_seq_length', type=int, default=16)
@@ -53,6 +78,43 @@ def load_hyperparams():
     argparser.add_argument('--bos_pad', type=int, default=0,
                            help='use all-zero embedding for bos')
     argparser.add_argument('--random_seed', type=int, default=1234)
+    argparser.add_argument('--in_graph_template', type=int, default=0,
+                           help='build templates with native TF ops, no py_func')
+    argparser.add_argument('--pipeline_template', type=int, default=0,
+                           help='build templates in the tf.data input pipeline')
+    argparser.add_argument('--num_parallel_calls', type=int, default=4,
+                           help='parallel calls of the template building stage')
+    argparser.add_argument('--loop_blanks', type=int, default=0,
+                           help='iterate over blanks with tf.while_loop instead of '
+                                'building the model once per blank')
+    argparser.add_argument('--parallel_blanks', type=int, default=0,
+                           help='decode all blanks at once at inference, each '
+                                'conditioned on the original template')
+    argparser.add_argument('--nat_iterations', type=int, default=0,
+                           help='if positive, train a non-autoregressive decoder '
+                                'and fill the blanks with this many mask-predict '
+                                'passes at inference')
+    argparser.add_argument('--speculative_draft', type=int, default=0,
+                           help='if positive, train an RNN draft model alongside, '
+                                'and decode by verifying this many drafted tokens '
+                                'per pass of the transformer')
+    argparser.add_argument('--fused_attention', type=int, default=0,
+                           help='project the attention queries, keys and values '
+                                'with fused variables')
+    argparser.add_argument('--recompute_grad', type=int, default=0,
+                           help='compute the activations of every decoder layer '
+                                'again in the backward pass instead of keeping '
+                                'them, to train deeper or longer in less memory')
+    argparser.add_argument('--remove_padding', type=int, default=0,
+                           help='skip the padded positions of the blanks in the '
+                                'decoder feed-forward networks, and the padding '
+                                'of the templates in attention')
+    argparser.add_argument('--template_attention_window', type=int, default=0,
+                           help='if positive, every blank attends only to this '
+                                'many template tokens around it, besides the '
+                                'masks and the first token of every segment')
+    argparser.add_argument('--template_shards_dir', type=str, default='',
+                           help='read precomputed templates from this directory')
     argparser.add_argument('--beam_width', type=int, default=2)
     argparser.add_argument('--affine_bias', type=int, default=0)
     argparser.parse_args(namespace=args)
@@ -119,6 +181,22 @@ def load_hyperparams():
         'batch_size': args.test_batch_size,
         'allow_smaller_final_batch': True,
     }
+    if args.template_shards_dir:
+        train_dataset_hparams = _template_shard_hparams(
+            train_dataset_hparams, args, 'train')
+        eval_dataset_hparams = _template_shard_hparams(
+            eval_dataset_hparams, args, 'valid')
+        test_dataset_hparams = _template_shard_hparams(
+            test_dataset_hparams, args, 'test')
+    elif args.pipeline_template:
+        for dataset_hparams in [train_dataset_hparams, eval_dataset_hparams,
+                                test_dataset_hparams]:
+            dataset_hparams['dataset']['present_rate'] = args.present_rate
+            dataset_hparams['dataset']['blank_num'] = args.blank_num
+            dataset_hparams['dataset']['mask_strategy'] = args.mask_strategy
+            dataset_hparams['dataset']['blank_length'] = args.blank_length
+            dataset_hparams['num_parallel_calls'] = args.num_parallel_calls
+            dataset_hparams['prefetch_buffer_size'] = 1
     args.word_embedding_hparams = {
         'name': 'lookup_table',
         'dim': args.hidden_dim,
@@ -130,6 +208,10 @@ def load_hyperparams():
             },
         }
     }
+    args.position_embedder_hparams = {
+        # the segment ids of templates with `blank_num` blanks
+        'max_segments': 2 * args.blank_num + 1,
+    }
     encoder_hparams = {
         'multiply_embedding_mode': "sqrt_depth",
         'embedding_dropout': 0.1,
@@ -183,13 +265,45 @@ def load_hyperparams():
         },
     }
     decoder_hparams = copy.deepcopy(encoder_hparams)
+    decoder_hparams['position_embedder']['hparams'] = \
+        args.position_embedder_hparams
     decoder_hparams['share_embed_and_transform'] = True
     decoder_hparams['transform_with_bias'] = args.affine_bias
     decoder_hparams['maximum_decode_length'] = args.max_decode_len
     decoder_hparams['beam_width'] = args.beam_width
     decoder_hparams['sampling_method'] = 'argmax'
+    decoder_hparams['non_autoregressive'] = args.nat_iterations > 0
+    decoder_hparams['fused_attention'] = bool(args.fused_attention)
+    decoder_hparams['recompute_grad'] = bool(args.recompute_grad)
+    decoder_hparams['remove_padding'] = bool(args.remove_padding)
+    decoder_hparams['template_attention_window'] = \
+        args.template_attention_window
+    draft_cell = {
+        "type": "LSTMBlockCell",
+        "kwargs": {
+            "num_units": args.hidden_dim,
+            "forget_bias": 0.
+        },
+        "dropout": {"output_keep_prob": 1-0.1},
+        "num_layers": 1
+    }
+    draft_encoder_hparams = {
+        "rnn_cell": draft_cell,
+        "name": "draft_rnn_encoder"
+    }
+    draft_decoder_hparams = {
+        "rnn_cell": draft_cell,
+        "max_decoding_length_train": args.max_seq_length+2,
+        "max_decoding_length_infer": args.max_seq_length+2,
+        "name": "draft_rnn_decoder"
+    }
     loss_hparams = {
         'label_confidence': 0.9,
+        # computes the smoothed loss without the [batch, time, vocab] labels
+        'analytic_smoothing': True,
+        # if positive, projects to the vocabulary and computes the loss this
+        # many positions at a time, to not keep the logits of whole blanks
+        'projection_chunk_size': 0,
     }
 
     opt_hparams = {
@@ -223,6 +337,8 @@ def load_hyperparams():
         'test_dataset_hparams': test_dataset_hparams,
         'encoder_hparams': encoder_hparams,
         'decoder_hparams': decoder_hparams,
+        'draft_encoder_hparams': draft_encoder_hparams,
+        'draft_decoder_hparams': draft_decoder_hparams,
         'loss_hparams': loss_hparams,
         'opt_hparams': opt_hparams,
         'opt_vars': opt_vars,
@@ -5,7 +5,7 @@ configurate the hyperparameters, based on command line arguments.
 import argparse
 import os
 
-from texar.data import SpecialTokens
+from texar.data import SpecialTokens, template_shard_file_pattern
 
 
 class Hyperparams:
@@ -17,6 +17,27 @@ class Hyperparams:
         self.help = "the hyperparams dictionary to use"
 
 
+def _template_shard_hparams(dataset_hparams, args, split):
+    """
+        reads the precomputed packs of the split instead of the raw text,
+        see bin/make_template_shards.py
+    """
+    return {
+        "num_epochs": dataset_hparams["num_epochs"],
+        "seed": args.random_seed,
+        "shuffle": dataset_hparams["shuffle"],
+        "dataset": {
+            "files": template_shard_file_pattern(
+                args.template_shards_dir, args.filename_prefix + split,
+                args.mask_rate, args.blank_num),
+            "blank_num": args.blank_num,
+            "vocab_file": args.vocab_file,
+            "bos_token": SpecialTokens.BOS,
+            "eos_token": SpecialTokens.EOS,
+        },
+    }
+
+
 def load_hyperparams():
     """
         main function to define hyperparams
@@ -26,6 +47,10 @@ def load_hyperparams():
     argparser = argparse.ArgumentParser()
     argparser.add_argument('--mask_rate', type=float, default=0.5)
     argparser.add_argument('--blank_num', type=int, default=1)
+    argparser.add_argument('--mask_strategy', type=str, default='random',
+                           help='random or equal_length')
+    argparser.add_argument('--blank_length', type=int, default=1,
+                           help='tokens per blank if mask_strategy is equal_length')
     argparser.add_argument('--batch_size', type=int, default=400)  # 4096
     argparser.add_argument('--test_batch_size', type=int, default=10)
     argparser.add_argument('--max_seq_length', type=int, default=16)  # 256
@@ -49,6 +74,17 @@ def load_hyperparams():
     argparser.add_argument('--bos_pad', type=int, default=0,
                            help='use all-zero embedding for bos')
     argparser.add_argument('--random_seed', type=int, default=1234)
+    argparser.add_argument('--in_graph_template', type=int, default=0,
+                           help='build templates with native TF ops, no py_func')
+    argparser.add_argument('--pipeline_template', type=int, default=0,
+                           help='build templates in the tf.data input pipeline')
+    argparser.add_argument('--num_parallel_calls', type=int, default=4,
+                           help='parallel calls of the template building stage')
+    argparser.add_argument('--loop_blanks', type=int, default=0,
+                           help='iterate over blanks with tf.while_loop instead of '
+                                'building the model once per blank')
+    argparser.add_argument('--template_shards_dir', type=str, default='',
+                           help='read precomputed templates from this directory')
     argparser.add_argument('--beam_width', type=int, default=2)
     argparser.parse_args(namespace=args)
 
@@ -115,6 +151,22 @@ def load_hyperparams():
         'batch_size': args.test_batch_size,
         'allow_smaller_final_batch': True,
     }
+    if args.template_shards_dir:
+        train_dataset_hparams = _template_shard_hparams(
+            train_dataset_hparams, args, 'train')
+        eval_dataset_hparams = _template_shard_hparams(
+            eval_dataset_hparams, args, 'valid')
+        test_dataset_hparams = _template_shard_hparams(
+            test_dataset_hparams, args, 'test')
+    elif args.pipeline_template:
+        for dataset_hparams in [train_dataset_hparams, eval_dataset_hparams,
+                                test_dataset_hparams]:
+            dataset_hparams['dataset']['present_rate'] = args.present_rate
+            dataset_hparams['dataset']['blank_num'] = args.blank_num
+            dataset_hparams['dataset']['mask_strategy'] = args.mask_strategy
+            dataset_hparams['dataset']['blank_length'] = args.blank_length
+            dataset_hparams['num_parallel_calls'] = args.num_parallel_calls
+            dataset_hparams['prefetch_buffer_size'] = 1
     args.word_embedding_hparams = {
         'name': 'lookup_table',
         'dim': args.hidden_dim,
@@ -126,6 +178,10 @@ def load_hyperparams():
             },
         }
     }
+    args.position_embedder_hparams = {
+        # the segment ids of templates with `blank_num` blanks
+        'max_segments': 2 * args.blank_num + 1,
+    }
     cell = {
         "type": "LSTMBlockCell",
         "kwargs": {
@@ -170,6 +226,8 @@ def load_hyperparams():
 
     loss_hparams = {
         'label_confidence': 0.9,
+        # computes the smoothed loss without the [batch, time, vocab] labels
+        'analytic_smoothing': True,
     }
 
     opt_hparams = {